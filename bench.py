@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the fuzzer's hot paths.
+
+  python bench.py scanner <path_to_c_source_or_directory>
+
+compares the linear-time function scanner in pair.py against the legacy
+backtracking FUNC_REGEX it replaced, reporting throughput (MB/s), how many
+functions each one finds, and how many files the regex gave up on.
+
+  python bench.py corpus <dir> --files 200 --functions 50 --commits 100
+
+writes a synthetic C code base (a git repository, with a history of small
+commits) for the benchmarks below, and
+
+  python bench.py pipeline [<dir>] --trees 200 --commits 50 --latency lognormal:0.5:0.4
+
+runs indexing, specimen selection, a `tree` run and a `review` run end to
+end against mockserver.py, reporting indexing MB/s, specimens/s, LLM calls/s
+and p50/p99 call latency. Without a directory a corpus is generated first.
+
+  python bench.py startup [<dir>] --runs 20
+
+times how long review.py's offline commands (index, sample) take to start,
+i.e. to import what they need and parse their arguments, against a target of
+STARTUP_TARGET_MS, then runs them on the corpus to check that they never
+import the LLM modules.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import regex
+
+import pair
+from telemetry import percentile
+from pair import find_c_files, scan_functions
+
+# The regex pair.py used before the scanner, kept here as the baseline.
+LEGACY_FUNC_REGEX = regex.compile(r'''
+(?P<full>
+    ^\s*                                   # Start-of-line optional whitespace
+    (?P<comment>(?:/\*.*?\*/\s*|//.*?\n\s*)*)  # Optional preceding comments (block or line)
+    (?:static\s+)?                         # Optional "static" keyword
+    (?:inline\s+)?                         # Optional "inline" keyword
+    (?P<ret>[a-zA-Z_][a-zA-Z0-9_\*\s]+?)\s+  # Return type (non-greedy)
+    (?P<name>[a-zA-Z_][a-zA-Z0-9_]*)\s*      # Function name
+    \([^)]*\)\s*                           # Parameter list (anything until the first ')')
+    \{                                     # Opening brace of function body
+    (?:                                    # Non-capturing group for body content:
+         [^{}]*                           #   Any characters except braces
+         (?:\{[^{}]*\}[^{}]*)*             #   Optionally one level of nested braces
+    )
+    \}                                     # Closing brace of function body
+)
+''', regex.MULTILINE | regex.VERBOSE | regex.DOTALL)
+
+def legacy_extract(source, timeout):
+    """Names found by LEGACY_FUNC_REGEX, or None if it timed out on this source."""
+    try:
+        return {m.group('name') for m in LEGACY_FUNC_REGEX.finditer(source, timeout=timeout)}
+    except TimeoutError:
+        return None
+
+def read_sources(path):
+    if os.path.isfile(path):
+        files = [path]
+    else:
+        files = find_c_files(path)
+    sources = []
+    for filepath in files:
+        with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
+            sources.append((filepath, f.read()))
+    return sources
+
+def bench_scanner(path, timeout=1.0):
+    sources = read_sources(path)
+    if not sources:
+        print(f"No .c/.h files found in {path}")
+        sys.exit(1)
+    total_mb = sum(len(src.encode('utf-8')) for _, src in sources) / 1e6
+
+    start = time.perf_counter()
+    scanned = {filepath: {name for name, _, _ in scan_functions(src)} for filepath, src in sources}
+    scan_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    legacy = {filepath: legacy_extract(src, timeout) for filepath, src in sources}
+    legacy_time = time.perf_counter() - start
+
+    timeouts = sum(1 for names in legacy.values() if names is None)
+    scan_found = sum(len(names) for names in scanned.values())
+    legacy_found = sum(len(names) for names in legacy.values() if names)
+    # Per file, how many functions only one side found.
+    shared = sum(len(scanned[f] & (legacy[f] or set())) for f in scanned)
+    union = sum(len(scanned[f] | (legacy[f] or set())) for f in scanned)
+
+    print(f"Corpus: {len(sources)} file(s), {total_mb:.2f} MB\n")
+    print(f"{'':10} {'seconds':>10} {'MB/s':>10} {'functions':>10} {'recall':>8} {'timeouts':>9}")
+    for label, elapsed, found, skipped in (
+        ("scanner", scan_time, scan_found, 0),
+        ("regex", legacy_time, legacy_found, timeouts),
+    ):
+        recall = found / union if union else 0.0
+        print(f"{label:10} {elapsed:10.2f} {total_mb / max(elapsed, 1e-9):10.2f} {found:10} {recall:8.1%} {skipped:9}")
+    print(f"\nFound by both: {shared}, scanner only: {scan_found - shared}, regex only: {legacy_found - shared}")
+    print("(recall is measured against the union of both extractors)")
+
+C_TYPES = ("int", "size_t", "bool", "char *", "void *", "uint32", "Datum", "double")
+C_NAME_PARTS = ("buffer", "tuple", "page", "index", "scan", "hash", "lock", "node", "list", "heap",
+                "slot", "range", "state", "plan", "expr", "cache", "entry", "key", "value", "xlog")
+C_VERBS = ("get", "set", "init", "free", "build", "find", "update", "check", "read", "write", "copy", "merge")
+
+def synthetic_function(rng, name, callees):
+    """Source of one C function with a leading comment, some control flow, and calls to callees."""
+    ret = rng.choice(C_TYPES)
+    params = ", ".join(f"{rng.choice(C_TYPES)} {part}{i}" for i, part in enumerate(rng.sample(C_NAME_PARTS, rng.randint(0, 4))))
+    lines = [f"/*\n * {name}\n *\t\t{rng.choice(C_VERBS).capitalize()} the {rng.choice(C_NAME_PARTS)} "
+             f"for the given {rng.choice(C_NAME_PARTS)}.\n */",
+             f"{'static ' if rng.random() < 0.3 else ''}{ret}\n{name}({params or 'void'})\n{{",
+             "\tint\t\t\tresult = 0;", ""]
+    for _ in range(rng.randint(2, 12)):
+        kind = rng.random()
+        if kind < 0.4 and callees:
+            lines.append(f"\tresult += (int) {rng.choice(callees)}();")
+        elif kind < 0.6:
+            lines.append(f"\tfor (int i = 0; i < {rng.randint(2, 64)}; i++)\n\t{{\n\t\tif (result > i)\n\t\t\tresult -= i;\n\t}}")
+        elif kind < 0.8:
+            lines.append(f"\tif (result == {rng.randint(0, 9)})\n\t\telog(ERROR, \"unexpected {rng.choice(C_NAME_PARTS)} state\");")
+        else:
+            lines.append(f"\t/* {rng.choice(C_VERBS)} the {rng.choice(C_NAME_PARTS)} first */\n\tresult *= {rng.randint(2, 9)};")
+    lines.append(f"\n\treturn ({ret}) result;\n}}")
+    return "\n".join(lines) + "\n"
+
+def generate_corpus(out_dir, files=50, functions=40, commits=20, seed=0):
+    """
+    Write `files` C files of `functions` functions each under out_dir, calling
+    each other mostly within a file, as a git repository with an initial commit
+    followed by `commits` commits that each change one function. Returns the
+    number of bytes of C written.
+    """
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    names = [[f"{rng.choice(C_VERBS)}_{rng.choice(C_NAME_PARTS)}_{f}_{n}" for n in range(functions)]
+             for f in range(files)]
+    all_names = [name for file_names in names for name in file_names]
+    sources = []
+    for f, file_names in enumerate(names):
+        functions_source = []
+        for n, name in enumerate(file_names):
+            local = file_names[n + 1:n + 6]
+            callees = local + [rng.choice(all_names) for _ in range(2)]
+            functions_source.append(synthetic_function(rng, name, callees))
+        sources.append(functions_source)
+
+    def write(f):
+        path = os.path.join(out_dir, f"module{f:04d}.c")
+        with open(path, "w") as out:
+            out.write(f"/* module{f:04d}.c: synthetic benchmark code */\n#include \"postgres.h\"\n\n")
+            out.write("\n".join(sources[f]))
+        return path
+
+    def git(*args):
+        subprocess.run(["git", "-C", out_dir, *args], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    for f in range(files):
+        write(f)
+    git("init", "-q")
+    git("add", ".")
+    git("-c", "user.name=bench", "-c", "user.email=bench@example.com", "commit", "-q", "-m", "Synthetic corpus")
+    for number in range(commits):
+        f = rng.randrange(files)
+        n = rng.randrange(functions)
+        sources[f][n] = synthetic_function(rng, names[f][n], rng.sample(all_names, 3))
+        path = write(f)
+        git("add", os.path.relpath(path, out_dir))
+        git("-c", "user.name=bench", "-c", "user.email=bench@example.com", "commit", "-q",
+            "-m", f"Rework {names[f][n]} ({number + 1})")
+    return sum(os.path.getsize(path) for path in find_c_files(out_dir))
+
+def read_call_latencies(call_log):
+    """Per-template lists of call seconds from an llm.call_log_path file."""
+    latencies = {}
+    if not os.path.exists(call_log):
+        return latencies
+    with open(call_log) as f:
+        for line in f:
+            record = json.loads(line)
+            latencies.setdefault(record["template"], []).append(record["seconds"])
+    return latencies
+
+def bench_pipeline(path, trees, commits, use_async, mock_options, jobs=None, batch_tokens=None):
+    """Index, sample, tree and review a corpus against a local mock API, and report throughput."""
+    import llm
+    import mockserver
+    import review
+
+    work_dir = tempfile.mkdtemp(prefix="fuzzer-bench-")
+    if path is None:
+        path = os.path.join(work_dir, "corpus")
+        generate_corpus(path, commits=max(commits, 1))
+    # A private cache directory, so indexing starts cold.
+    pair.CACHE_DIR = os.path.join(work_dir, "cache")
+    total_mb = sum(os.path.getsize(filepath) for filepath in find_c_files(path)) / 1e6
+
+    start = time.perf_counter()
+    index = pair.build_index(path, jobs)
+    index_time = time.perf_counter() - start
+    functions = len(index)
+    index.close()
+
+    start = time.perf_counter()
+    specimens = pair.select_code_trees(trees, path, jobs)
+    specimen_time = time.perf_counter() - start
+
+    server = mockserver.start(**mock_options)
+    llm.base_url = server.url
+    llm.use_cache = False
+    llm.call_log_path = os.path.join(work_dir, "calls.jsonl")
+    review.open_results(os.path.join(work_dir, "results.sqlite3"), "bench")
+
+    runs = []
+    for label, template, run in (
+        ("tree", "code_tree", lambda: review.analyze_tree(trees, path, jobs, use_async=use_async, batch_tokens=batch_tokens)),
+        ("review", "review", lambda: review.review_commits(commits, path, use_async)),
+    ):
+        calls_before = sum(stats["calls"] for stats in llm.usage_stats.values())
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        calls = sum(stats["calls"] for stats in llm.usage_stats.values()) - calls_before
+        runs.append((label, template, elapsed, calls))
+    review.result_store.close()
+    server.shutdown()
+    latencies = read_call_latencies(llm.call_log_path)
+    if batch_tokens:
+        latencies.setdefault("code_tree", []).extend(latencies.get("code_tree_batch", []))
+
+    print(f"\nCorpus: {path}, {total_mb:.2f} MB, {functions} function(s)")
+    print(f"Indexing: {index_time:.2f}s, {total_mb / max(index_time, 1e-9):.2f} MB/s, "
+          f"{functions / max(index_time, 1e-9):.0f} functions/s")
+    print(f"Specimens: {len(specimens)} in {specimen_time:.2f}s, {len(specimens) / max(specimen_time, 1e-9):.0f} specimens/s")
+    print(f"Mock API: {server.stats}\n")
+    print(f"{'run':10} {'seconds':>9} {'calls':>7} {'calls/s':>9} {'p50 s':>8} {'p99 s':>8}")
+    for label, template, elapsed, calls in runs:
+        seconds = latencies.get(template, [])
+        print(f"{label:10} {elapsed:9.2f} {calls:7} {calls / max(elapsed, 1e-9):9.1f} "
+              f"{percentile(seconds, 50):8.3f} {percentile(seconds, 99):8.3f}")
+
+# Offline review.py commands, and how quickly they should get to work.
+STARTUP_COMMANDS = ("index", "sample")
+STARTUP_TARGET_MS = 100
+# Modules the offline commands must not import.
+LLM_MODULES = ("llm", "openai", "dotenv")
+
+def imported_modules(importtime_output):
+    """Top-level names of the modules listed in python -X importtime output."""
+    names = set()
+    for line in importtime_output.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            names.add(line.rsplit("|", 1)[1].strip().split(".")[0])
+    return names
+
+def bench_startup(path=None, runs=20):
+    """Time review.py's offline commands up to the start of work, and check what they import."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "review.py")
+    work_dir = tempfile.mkdtemp(prefix="fuzzer-bench-")
+    if path is None:
+        path = os.path.join(work_dir, "corpus")
+        generate_corpus(path, files=10, functions=20, commits=1)
+    env = dict(os.environ, FUZZER_CACHE_DIR=os.path.join(work_dir, "cache"))
+    runs_on_corpus = {
+        "index": ["index", "--repo", path],
+        "sample": ["sample", "10", "--repo", path, "--results", os.path.join(work_dir, "results.sqlite3")],
+    }
+
+    # --help exits right after the imports and argument parsing a command does before any work.
+    print(f"{'command':10} {'min ms':>8} {'p50 ms':>8} {'max ms':>8}")
+    for command in STARTUP_COMMANDS:
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, script, command, "--help"], stdout=subprocess.DEVNULL, check=True, env=env)
+            times.append((time.perf_counter() - start) * 1000)
+        p50 = percentile(times, 50)
+        verdict = "ok" if p50 <= STARTUP_TARGET_MS else f"over the {STARTUP_TARGET_MS} ms target"
+        print(f"{command:10} {min(times):8.1f} {p50:8.1f} {max(times):8.1f}  {verdict}")
+
+    print()
+    for command in STARTUP_COMMANDS:
+        argv = runs_on_corpus[command]
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-X", "importtime", script, *argv], stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, text=True, check=True, env=env)
+        elapsed = time.perf_counter() - start
+        unwanted = sorted(imported_modules(result.stderr) & set(LLM_MODULES))
+        print(f"{command:10} ran in {elapsed * 1000:.0f} ms (with import timing), "
+              f"{'imported ' + ', '.join(unwanted) if unwanted else 'no LLM modules imported'}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the fuzzer")
+    sub = parser.add_subparsers(dest="command", required=True)
+    scanner = sub.add_parser("scanner", help="Function scanner vs. the legacy FUNC_REGEX")
+    scanner.add_argument("path", help="C source file or directory")
+    scanner.add_argument("--timeout", type=float, default=1.0, help="Per-file regex timeout in seconds (default: 1.0)")
+    corpus = sub.add_parser("corpus", help="Generate a synthetic C corpus as a git repository")
+    corpus.add_argument("path", help="Directory to create")
+    corpus.add_argument("--files", type=int, default=50, help="Number of .c files (default: 50)")
+    corpus.add_argument("--functions", type=int, default=40, help="Functions per file (default: 40)")
+    corpus.add_argument("--commits", type=int, default=20, help="Commits after the initial one, each changing a function (default: 20)")
+    corpus.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    pipeline = sub.add_parser("pipeline", help="Index, sample, tree and review against a local mock API")
+    pipeline.add_argument("path", nargs="?", default=None, help="Corpus to use, a git repository (default: generate one)")
+    pipeline.add_argument("--trees", type=int, default=200, help="Code trees to analyze (default: 200)")
+    pipeline.add_argument("--commits", type=int, default=50, help="Commits to review (default: 50)")
+    pipeline.add_argument("--jobs", type=int, default=None, help="Indexing processes (default: one per CPU)")
+    pipeline.add_argument("--batch-tokens", type=int, default=None, help="Batch small code trees, as review.py tree --batch-tokens")
+    pipeline.add_argument("--async", dest="use_async", action="store_true", help="Use the async LLM client")
+    pipeline.add_argument("--latency", type=str, default="lognormal:0.3:0.5", help="Mock reply latency, as mockserver.py --latency (default: lognormal:0.3:0.5)")
+    pipeline.add_argument("--rate-limit", type=float, default=0.0, help="Fraction of mock requests answered with 429")
+    pipeline.add_argument("--error-rate", type=float, default=0.0, help="Fraction of mock requests answered with 500")
+    pipeline.add_argument("--garbage-rate", type=float, default=0.0, help="Fraction of mock replies garbled")
+    pipeline.add_argument("--seed", type=int, default=0, help="Mock server random seed (default: 0)")
+    startup = sub.add_parser("startup", help="Start-up time of review.py's offline commands")
+    startup.add_argument("path", nargs="?", default=None, help="Corpus to run them on, a git repository (default: generate a small one)")
+    startup.add_argument("--runs", type=int, default=20, help="Times to start each command (default: 20)")
+    args = parser.parse_args()
+
+    if args.command == "scanner":
+        bench_scanner(args.path, args.timeout)
+    elif args.command == "corpus":
+        written = generate_corpus(args.path, args.files, args.functions, args.commits, args.seed)
+        print(f"Wrote {written / 1e6:.2f} MB of C and {args.commits + 1} commit(s) to {args.path}")
+    elif args.command == "pipeline":
+        mock_options = {"latency": args.latency, "rate_limit": args.rate_limit, "error_rate": args.error_rate,
+                        "garbage_rate": args.garbage_rate, "retry_after": 0.5, "seed": args.seed}
+        bench_pipeline(args.path, args.trees, args.commits, args.use_async, mock_options, args.jobs, args.batch_tokens)
+    elif args.command == "startup":
+        bench_startup(args.path, args.runs)
+
+if __name__ == "__main__":
+    main()
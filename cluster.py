@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Grouping of near-duplicate findings.
+
+The same issue tends to be reported many times in different words: a bug in a
+callee shows up in the code tree of each of its callers, and a rerun finds it
+again. Each issue description is turned into a set of shingles (runs of three
+words, plus the function names it mentions) and summarized by a MinHash
+signature, whose positions agree between two issues about as often as their
+shingle sets overlap (Jaccard similarity). Locality-sensitive hashing on bands
+of the signature finds candidate pairs without comparing every pair, so
+clustering takes roughly linear time; candidates that really are similar
+enough are joined into one cluster. Each cluster is identified by its
+canonical issue, the most confident and severe one.
+
+    python cluster.py                      # cluster every stored issue
+    python cluster.py --show 20            # and print the 20 largest clusters
+
+Clusters are stored next to the results (see results.py) and exported to the
+tree browser, which can collapse duplicates. KnownClusters matches new issues
+against the stored clusters, so `review.py review --skip-known-issues` can skip
+reproducing known ones.
+"""
+import argparse
+import hashlib
+import random
+import re
+import struct
+
+from results import ResultStore, DEFAULT_PATH as DEFAULT_RESULTS_PATH
+
+NUM_PERM = 64
+# 16 bands of 4 rows: pairs with similarity 0.5 become candidates about 64% of
+# the time, pairs at 0.8 over 99% of the time, pairs at 0.2 under 3%.
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE_WORDS = 3
+DEFAULT_THRESHOLD = 0.5
+
+_MERSENNE = (1 << 61) - 1
+_rng = random.Random(0x5eed)
+_PERMUTATIONS = [(_rng.randrange(1, _MERSENNE), _rng.randrange(_MERSENNE)) for _ in range(NUM_PERM)]
+_SIGNATURE = struct.Struct(f"<{NUM_PERM}Q")
+
+WORD_REGEX = re.compile(r'[A-Za-z_][A-Za-z0-9_]*|[0-9]+')
+# Identifiers that look like function names: called, `quoted`, or snake_case/CamelCase.
+FUNCTION_NAME_REGEX = re.compile(r'`([A-Za-z_][A-Za-z0-9_]*)(?:\(\))?`|\b([A-Za-z_][A-Za-z0-9_]*)\s*\('
+                                 r'|\b([a-z0-9]+_[A-Za-z0-9_]+|[A-Z][a-z0-9]+[A-Z][A-Za-z0-9]*)\b')
+
+def shingles(description):
+    """The shingle set of an issue description: its word 3-grams and the function names it mentions."""
+    words = [word.lower() for word in WORD_REGEX.findall(description or "")]
+    result = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(max(1, len(words) - SHINGLE_WORDS + 1))}
+    for match in FUNCTION_NAME_REGEX.finditer(description or ""):
+        name = next(group for group in match.groups() if group)
+        result.add("fn:" + name)
+    result.discard("")
+    return result
+
+def minhash(shingle_set):
+    """The MinHash signature of a set of strings, a tuple of NUM_PERM integers."""
+    hashes = [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little")
+              for shingle in shingle_set] or [0]
+    return tuple(min((a * value + b) % _MERSENNE for value in hashes) for a, b in _PERMUTATIONS)
+
+def similarity(first, second):
+    """Estimated Jaccard similarity of the sets behind two signatures."""
+    return sum(1 for x, y in zip(first, second) if x == y) / NUM_PERM
+
+def pack_signature(signature):
+    return _SIGNATURE.pack(*signature)
+
+def unpack_signature(data):
+    return _SIGNATURE.unpack(data)
+
+class LSHIndex:
+    """Signatures bucketed by band, to look up candidates for near-duplicates."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.signatures = {}
+
+    def add(self, key, signature):
+        self.signatures[key] = signature
+        for band in range(BANDS):
+            self.buckets.setdefault((band, signature[band * ROWS:(band + 1) * ROWS]), []).append(key)
+
+    def candidates(self, signature):
+        """Keys sharing at least one band with signature."""
+        found = set()
+        for band in range(BANDS):
+            found.update(self.buckets.get((band, signature[band * ROWS:(band + 1) * ROWS]), ()))
+        return found
+
+    def query(self, signature, threshold=DEFAULT_THRESHOLD):
+        """(similarity, key) of the most similar signature at or above threshold, or None."""
+        best = None
+        for key in self.candidates(signature):
+            score = similarity(signature, self.signatures[key])
+            if score >= threshold and (best is None or score > best[0]):
+                best = (score, key)
+        return best
+
+def _rank(issue):
+    """Sort key choosing a cluster's canonical issue: most confident, then most severe, then oldest."""
+    return (-(issue["confidence"] or 0), -(issue["severity"] or 0), issue["id"])
+
+def cluster_issues(issues, threshold=DEFAULT_THRESHOLD):
+    """
+    Cluster issue dicts (id, description, confidence, severity). Returns
+    ({issue id: cluster id}, {issue id: signature}); a cluster's id is the id
+    of its canonical issue, and unique issues are clusters of one.
+    """
+    parent = {issue["id"]: issue["id"] for issue in issues}
+
+    def find(key):
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    index = LSHIndex()
+    signatures = {}
+    for issue in issues:
+        signature = minhash(shingles(issue["description"]))
+        signatures[issue["id"]] = signature
+        for other in index.candidates(signature):
+            if similarity(signature, index.signatures[other]) >= threshold:
+                parent[find(issue["id"])] = find(other)
+        index.add(issue["id"], signature)
+
+    members = {}
+    for issue in issues:
+        members.setdefault(find(issue["id"]), []).append(issue)
+    clusters = {}
+    for group in members.values():
+        canonical = min(group, key=_rank)["id"]
+        for issue in group:
+            clusters[issue["id"]] = canonical
+    return clusters, signatures
+
+def cluster_store(store, threshold=DEFAULT_THRESHOLD):
+    """Cluster every issue in the results database and store the clusters. Returns {issue id: cluster id}."""
+    issues = list(store.issues())
+    clusters, signatures = cluster_issues(issues, threshold)
+    store.save_clusters((issue_id, cluster_id, pack_signature(signatures[issue_id]))
+                        for issue_id, cluster_id in clusters.items())
+    return clusters
+
+class KnownClusters:
+    """
+    The stored clusters, for matching new issues against: match() returns the
+    cluster an issue would join, or None for an issue not seen before.
+    """
+
+    def __init__(self, store, threshold=DEFAULT_THRESHOLD):
+        self.threshold = threshold
+        self.index = LSHIndex()
+        self.cluster_of = {}
+        for issue_id, cluster_id, signature in store.cluster_signatures():
+            self.index.add(issue_id, unpack_signature(signature))
+            self.cluster_of[issue_id] = cluster_id
+
+    def __len__(self):
+        return len(set(self.cluster_of.values()))
+
+    def match(self, issue):
+        best = self.index.query(minhash(shingles(issue.get("description"))), self.threshold)
+        return self.cluster_of[best[1]] if best is not None else None
+
+def main():
+    parser = argparse.ArgumentParser(description="Cluster near-duplicate issues in the results database")
+    parser.add_argument("--results", type=str, default=DEFAULT_RESULTS_PATH, help=f"Results database (default: {DEFAULT_RESULTS_PATH})")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help=f"Minimum estimated similarity of two issues in a cluster (default: {DEFAULT_THRESHOLD})")
+    parser.add_argument("--show", type=int, default=0, help="Print the N largest clusters")
+    args = parser.parse_args()
+
+    store = ResultStore(args.results)
+    clusters = cluster_store(store, args.threshold)
+    sizes = {}
+    for cluster_id in clusters.values():
+        sizes[cluster_id] = sizes.get(cluster_id, 0) + 1
+    duplicated = sum(size for size in sizes.values() if size > 1)
+    print(f"{len(clusters)} issue(s) in {len(sizes)} cluster(s); {duplicated} issue(s) have near-duplicates")
+    if args.show:
+        descriptions = {issue["id"]: issue for issue in store.issues()}
+        for cluster_id, size in sorted(sizes.items(), key=lambda item: -item[1])[:args.show]:
+            issue = descriptions[cluster_id]
+            print(f"\n[{cluster_id}] {size} issue(s), {issue['type']} confidence {issue['confidence'] or 0:g} "
+                  f"severity {issue['severity'] or 0:g} ({issue['kind']} {issue['key']})")
+            print(f"    {issue['description']}")
+    store.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+On-disk function index, opened with mmap.
+
+The index holds one fixed-size record per function, sorted by name:
+(name, file, byte offset, length, content hash). Nothing but the header is read
+when the index is opened; records are decoded on demand and function bodies are
+read from the source files only when they are asked for, so opening the index
+costs the same for ten functions as for a million.
+
+The call graph is stored next to the records in CSR form: for function id i,
+its callees are targets[offsets[i]:offsets[i + 1]], and likewise for callers in
+the reverse arrays. Both directions are a slice away, so walking a neighbourhood
+costs O(degree) per function.
+
+Layout (little endian):
+
+    header          HEADER
+    strings         utf-8 names and file paths, back to back
+    files           n_files x FILE_RECORD   (string offset, length)
+    records         n_funcs x RECORD        (sorted by name bytes)
+    callee offsets  (n_funcs + 1) x uint32
+    callee targets  n_edges x uint32
+    caller offsets  (n_funcs + 1) x uint32
+    caller targets  n_edges x uint32
+"""
+import hashlib
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+MAGIC = b"FIDX"
+VERSION = 2
+
+# magic, version, manifest digest, n_files, n_funcs, n_edges, files offset, records offset
+HEADER = struct.Struct("<4sI20sIIIQQ")
+# path offset, path length
+FILE_RECORD = struct.Struct("<QI")
+# name offset, name length, file id, byte offset, byte length, content hash
+RECORD = struct.Struct("<QIIQI8s")
+
+def content_hash(data):
+    """Short hash of a function body's bytes, used to detect stale records."""
+    return hashlib.blake2b(data, digest_size=8).digest()
+
+def build_csr(n, edges):
+    """
+    Turn a list of (source id, target id) pairs into CSR (offsets, targets)
+    arrays. Targets of each source are sorted.
+    """
+    counts = [0] * (n + 1)
+    for src, _ in edges:
+        counts[src + 1] += 1
+    offsets = array('I', counts)
+    for i in range(n):
+        offsets[i + 1] += offsets[i]
+    targets = array('I', bytes(4 * len(edges)))
+    cursor = list(offsets[:n])
+    for src, dst in sorted(edges):
+        targets[cursor[src]] = dst
+        cursor[src] += 1
+    return offsets, targets
+
+def _write_array(f, values):
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    values.tofile(f)
+
+def write_index(index_path, digest, files, entries):
+    """
+    Write an index to index_path. `files` is a list of file paths and `entries` a
+    list of (name, file id, offset, length, hash, called names) with unique names.
+    Called names that are not in `entries` are dropped from the call graph. The
+    file is written under a temporary name and renamed into place.
+    """
+    entries = sorted(entries, key=lambda entry: entry[0].encode('utf-8'))
+    ids = {entry[0]: func_id for func_id, entry in enumerate(entries)}
+    edges = set()
+    for func_id, entry in enumerate(entries):
+        for call in entry[5]:
+            call_id = ids.get(call)
+            if call_id is not None and call_id != func_id:
+                edges.add((func_id, call_id))
+    callee_offsets, callee_targets = build_csr(len(entries), edges)
+    caller_offsets, caller_targets = build_csr(len(entries), [(dst, src) for src, dst in edges])
+
+    strings = bytearray()
+    file_refs = []
+    for filepath in files:
+        encoded = filepath.encode('utf-8', errors='surrogateescape')
+        file_refs.append((len(strings), len(encoded)))
+        strings += encoded
+    name_refs = []
+    for name, *_ in entries:
+        encoded = name.encode('utf-8')
+        name_refs.append((len(strings), len(encoded)))
+        strings += encoded
+
+    strings_off = HEADER.size
+    files_off = strings_off + len(strings)
+    records_off = files_off + FILE_RECORD.size * len(files)
+
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, digest, len(files), len(entries), len(edges), files_off, records_off))
+        f.write(strings)
+        for off, length in file_refs:
+            f.write(FILE_RECORD.pack(strings_off + off, length))
+        for (name_off, name_len), (_, file_id, offset, length, hashed, _) in zip(name_refs, entries):
+            f.write(RECORD.pack(strings_off + name_off, name_len, file_id, offset, length, hashed))
+        for values in (callee_offsets, callee_targets, caller_offsets, caller_targets):
+            _write_array(f, values)
+    os.replace(tmp_path, index_path)
+
+class FunctionIndex:
+    """Read-only view of an index file written by write_index()."""
+
+    def __init__(self, mm):
+        self._mm = mm
+        magic, version, self.digest, self._n_files, self._n_funcs, n_edges, self._files_off, self._records_off = \
+            HEADER.unpack_from(mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("not a function index, or an index from another version")
+        self._paths = {}
+        # Zero-copy uint32 views of the CSR arrays.
+        self._view = view = memoryview(mm)
+        pos = self._records_off + RECORD.size * self._n_funcs
+        arrays = []
+        for length in (self._n_funcs + 1, n_edges, self._n_funcs + 1, n_edges):
+            arrays.append(view[pos:pos + 4 * length].cast('I'))
+            pos += 4 * length
+        self._callee_offsets, self._callee_targets, self._caller_offsets, self._caller_targets = arrays
+
+    @classmethod
+    def open(cls, index_path):
+        """Map the index at index_path, or return None if it is missing or unreadable."""
+        try:
+            with open(index_path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return cls(mm)
+        except (OSError, ValueError, struct.error):
+            return None
+
+    def close(self):
+        for values in (self._callee_offsets, self._callee_targets, self._caller_offsets, self._caller_targets):
+            values.release()
+        self._view.release()
+        self._mm.close()
+
+    def __len__(self):
+        return self._n_funcs
+
+    def _record(self, func_id):
+        if not 0 <= func_id < self._n_funcs:
+            raise IndexError(func_id)
+        return RECORD.unpack_from(self._mm, self._records_off + func_id * RECORD.size)
+
+    def _name_bytes(self, func_id):
+        name_off, name_len = RECORD.unpack_from(self._mm, self._records_off + func_id * RECORD.size)[:2]
+        return self._mm[name_off:name_off + name_len]
+
+    def _path(self, file_id):
+        if file_id not in self._paths:
+            off, length = FILE_RECORD.unpack_from(self._mm, self._files_off + file_id * FILE_RECORD.size)
+            self._paths[file_id] = self._mm[off:off + length].decode('utf-8', errors='surrogateescape')
+        return self._paths[file_id]
+
+    def name(self, func_id):
+        return self._name_bytes(func_id).decode('utf-8')
+
+    def file(self, func_id):
+        return self._path(self._record(func_id)[2])
+
+    def entry(self, func_id):
+        """Return (name, file, offset, length, hash) for a function id."""
+        name_off, name_len, file_id, offset, length, hashed = self._record(func_id)
+        name = self._mm[name_off:name_off + name_len].decode('utf-8')
+        return name, self._path(file_id), offset, length, hashed
+
+    def lookup(self, name):
+        """Return the id of the function called `name`, or None. Binary search over the records."""
+        target = name.encode('utf-8')
+        lo, hi = 0, self._n_funcs
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name_bytes(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._n_funcs and self._name_bytes(lo) == target:
+            return lo
+        return None
+
+    def __contains__(self, name):
+        return self.lookup(name) is not None
+
+    def callees(self, func_id):
+        """Ids of the indexed functions that func_id calls."""
+        return self._callee_targets[self._callee_offsets[func_id]:self._callee_offsets[func_id + 1]].tolist()
+
+    def callers(self, func_id):
+        """Ids of the indexed functions that call func_id."""
+        return self._caller_targets[self._caller_offsets[func_id]:self._caller_offsets[func_id + 1]].tolist()
+
+    def length(self, func_id):
+        """Size of a function's source in bytes, without reading it."""
+        return self._record(func_id)[4]
+
+    def source(self, func_id):
+        """
+        Read a function's source from its file. Returns None if the file no longer
+        holds the indexed content, so a stale body is never returned.
+        """
+        _, filepath, offset, length, hashed = self.entry(func_id)
+        try:
+            with open(filepath, "rb") as f:
+                f.seek(offset)
+                data = f.read(length)
+        except OSError:
+            return None
+        if content_hash(data) != hashed:
+            return None
+        return data.decode('utf-8', errors='ignore')
@@ -1,212 +1,453 @@
-import openai
+import asyncio
 import os
+import threading
+import time
 from dotenv import load_dotenv
 import json
 
+from llmcache import ResponseCache, make_key
+import prompts
+import telemetry
+from replies import normalize_batch, normalize_issues, parse_reply
+from prompts import DEFAULT_TREE_TOKENS, estimate_tokens as estimate_text_tokens
+from ratelimit import AdaptiveLimiter, TokenBucket, backoff_delay, parse_retry_after
+
 load_dotenv()  # take environment variables from .env.
 
-client = openai.OpenAI(
-    api_key=os.environ.get("OPENAI_API_KEY"),  # This is the default and can be omitted
-)
+MODEL = "o3-mini-2025-01-31"
+REASONING_EFFORT = "high"
+
+# Effort for repairing a reply that could not be parsed; the answer is already there.
+REPAIR_REASONING_EFFORT = "low"
+
+# Ask for JSON-schema constrained replies where a template has a schema. Turned
+# off by itself if the endpoint rejects response_format.
+structured_output = os.environ.get("LLM_STRUCTURED_OUTPUT", "1") != "0"
+
+# Template versions are part of the response cache key; see prompts.TEMPLATES.
+PROMPT_VERSIONS = {name: template["version"] for name, template in prompts.TEMPLATES.items()}
+
+# Token budget for the code tree part of a code_tree prompt (see prompts.render_tree).
+tree_token_budget = int(os.environ.get("LLM_TREE_TOKENS", DEFAULT_TREE_TOKENS))
+
+# Appends one JSON line per API call (template, estimated and reported tokens) when set.
+call_log_path = os.environ.get("LLM_CALL_LOG")
+
+# OpenAI-compatible endpoint to call, e.g. http://127.0.0.1:8000/v1 for mockserver.py.
+# None uses OPENAI_BASE_URL or the OpenAI API.
+base_url = os.environ.get("LLM_BASE_URL") or None
+
+_client = None
+_client_lock = threading.Lock()
+
+def client_options():
+    """Keyword arguments for openai.OpenAI/AsyncOpenAI."""
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if api_key is None and base_url is not None:
+        api_key = "unused"  # local servers don't check it, but the client insists on one
+    return {"api_key": api_key, "base_url": base_url}
+
+def endpoint():
+    """The base URL calls go to, as used in response cache keys."""
+    return base_url or os.environ.get("OPENAI_BASE_URL") or "https://api.openai.com/v1"
+
+def get_client():
+    """
+    The shared synchronous client, created on first use so base_url can still
+    be changed, and so that commands which make no calls never import openai.
+    """
+    import openai
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = openai.OpenAI(**client_options(), max_retries=0)  # complete() retries itself
+        return _client
+
+def retryable_errors():
+    """
+    Errors worth retrying: throttling, server trouble and network hiccups. Calls
+    are retried with backoff, honouring Retry-After, up to max_retries times.
+    """
+    import openai
+    return (
+        openai.RateLimitError,
+        openai.InternalServerError,
+        openai.APIConnectionError,
+    )
+
+max_retries = 6
+
+use_cache = os.environ.get("LLM_CACHE", "1") != "0"
+_response_cache = None
+_response_cache_lock = threading.Lock()
+
+def get_response_cache():
+    """The shared ResponseCache, opened on first use; None when caching is off."""
+    global _response_cache
+    if not use_cache:
+        return None
+    with _response_cache_lock:
+        if _response_cache is None:
+            _response_cache = ResponseCache()
+        return _response_cache
+
+usage_stats = {}
+_usage_lock = threading.Lock()
+
+# USD per million tokens for MODEL, for the cost estimate in the run summary.
+# Reasoning tokens are billed, and reported, as completion tokens.
+PRICE_PER_MILLION = {"prompt": 1.10, "cached": 0.55, "completion": 4.40}
+
+def record_usage(template, messages, usage, seconds, retries=0):
+    """
+    Count one API call in usage_stats[template]: calls, seconds, retries,
+    our prompt token estimate, and the prompt, cached prompt, completion and
+    reasoning tokens the API reported. Cached tokens are the part of the
+    prompt served from the provider's prefix cache. Also recorded as an
+    llm.<template> telemetry span, and appended to call_log_path when set.
+    """
+    estimated = estimate_tokens(messages)
+    prompt_tokens = getattr(usage, "prompt_tokens", None) or 0
+    completion_tokens = getattr(usage, "completion_tokens", None) or 0
+    cached_tokens = getattr(getattr(usage, "prompt_tokens_details", None), "cached_tokens", None) or 0
+    reasoning_tokens = getattr(getattr(usage, "completion_tokens_details", None), "reasoning_tokens", None) or 0
+    with _usage_lock:
+        stats = usage_stats.setdefault(template, {"calls": 0, "seconds": 0.0, "retries": 0, "estimated_tokens": 0,
+                                                  "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0,
+                                                  "reasoning_tokens": 0})
+        stats["calls"] += 1
+        stats["seconds"] += seconds
+        stats["retries"] += retries
+        stats["estimated_tokens"] += estimated
+        stats["prompt_tokens"] += prompt_tokens
+        stats["cached_tokens"] += cached_tokens
+        stats["completion_tokens"] += completion_tokens
+        stats["reasoning_tokens"] += reasoning_tokens
+        if call_log_path:
+            with open(call_log_path, 'a') as f:
+                f.write(json.dumps({"time": time.time(), "template": template, "version": PROMPT_VERSIONS[template],
+                                    "seconds": round(seconds, 3), "retries": retries, "estimated_tokens": estimated,
+                                    "prompt_tokens": prompt_tokens, "cached_tokens": cached_tokens,
+                                    "completion_tokens": completion_tokens,
+                                    "reasoning_tokens": reasoning_tokens}) + "\n")
+    telemetry.record(f"llm.{template}", seconds, retries=retries, prompt_tokens=prompt_tokens,
+                     cached_tokens=cached_tokens, completion_tokens=completion_tokens,
+                     reasoning_tokens=reasoning_tokens)
+
+def estimated_cost(stats):
+    """Estimated USD cost of the calls counted in one usage_stats entry."""
+    uncached = stats["prompt_tokens"] - stats["cached_tokens"]
+    return (uncached * PRICE_PER_MILLION["prompt"] + stats["cached_tokens"] * PRICE_PER_MILLION["cached"]
+            + stats["completion_tokens"] * PRICE_PER_MILLION["completion"]) / 1e6
+
+def request_options(response_format, reasoning_effort):
+    options = {"model": MODEL, "reasoning_effort": reasoning_effort}
+    if response_format is not None and structured_output:
+        options["response_format"] = response_format
+    return options
+
+def response_format_rejected(error, options):
+    """
+    True if a BadRequestError says the endpoint does not support the
+    response_format we sent; structured output is then switched off.
+    """
+    global structured_output
+    if "response_format" not in options or "response_format" not in str(error):
+        return False
+    if structured_output:
+        print("The API rejected structured output; falling back to plain JSON replies")
+    structured_output = False
+    return True
+
+def cacheable(text, normalize=None):
+    """
+    Whether a reply should go into the response cache: with normalize, only if
+    parse_reply can make something of it, so an unparseable reply is asked
+    for again rather than replayed by every retry and rerun.
+    """
+    return text is not None and (normalize is None or parse_reply(text, normalize)[1] != "failed")
+
+def complete(template, messages, response_format=None, reasoning_effort=REASONING_EFFORT, normalize=None):
+    """
+    Run one chat completion and return the response text, answering from the
+    response cache when the same request has been made before. Replies are
+    constrained to response_format (a JSON schema) when structured output is on,
+    and cached only if they are cacheable() with normalize.
+    """
+    cache = get_response_cache()
+    if cache is not None:
+        key = make_key(endpoint(), MODEL, reasoning_effort, template, PROMPT_VERSIONS[template], messages)
+        text = cache.get(key)
+        if text is not None:
+            return text
+    import openai
+    attempt = 0
+    while True:
+        attempt += 1
+        start = time.monotonic()
+        options = request_options(response_format, reasoning_effort)
+        try:
+            response = get_client().chat.completions.create(messages=messages, **options)
+            break
+        except openai.BadRequestError as e:
+            if not response_format_rejected(e, options):
+                raise
+        except retryable_errors() as e:
+            if attempt > max_retries:
+                raise
+            retry_after = parse_retry_after(getattr(getattr(e, "response", None), "headers", None))
+            time.sleep(backoff_delay(attempt, retry_after))
+    record_usage(template, messages, getattr(response, "usage", None), time.monotonic() - start, attempt - 1)
+    text = response.choices[0].message.content
+    if cache is not None and cacheable(text, normalize):
+        cache.put(key, MODEL, template, text)
+    return text
+
+parse_stats = {}
+
+def record_parse(template, outcome):
+    """Count a reply as "parsed", "salvaged", "repaired" or "failed" in parse_stats[template]."""
+    with _usage_lock:
+        stats = parse_stats.setdefault(template, {"parsed": 0, "salvaged": 0, "repaired": 0, "failed": 0})
+        stats[outcome] += 1
+
+def repair_messages(text):
+    return prompts.build_messages("repair", text)
+
+def decode_reply(template, text, normalize, response_format=None):
+    """
+    Parse a reply with replies.parse_reply. If nothing can be recovered, ask
+    once, at low reasoning effort, for the reply to be rewritten as valid JSON.
+    Returns the parsed value or None, and counts the outcome in parse_stats.
+    """
+    with telemetry.span(f"parse.{template}"):
+        value, outcome = parse_reply(text, normalize)
+    if outcome == "failed" and text:
+        try:
+            repaired = complete("repair", repair_messages(text), response_format, REPAIR_REASONING_EFFORT, normalize)
+        except Exception as e:
+            print(f"Repairing a {template} reply failed: {e}")
+            repaired = None
+        value, repaired_outcome = parse_reply(repaired, normalize)
+        if repaired_outcome != "failed":
+            outcome = "repaired"
+    record_parse(template, outcome)
+    return value
+
+def review_messages(diff):
+    return prompts.build_messages("review", prompts.review_payload(diff))
+
+def code_tree_messages(tree):
+    return prompts.build_messages("code_tree", prompts.code_tree_payload(tree, tree_token_budget))
+
+def reproduce_messages(diff, issues):
+    return prompts.build_messages("reproduce", prompts.reproduce_payload(diff, issues))
+
+def code_tree_batch_messages(trees):
+    return prompts.build_messages("code_tree_batch", prompts.code_tree_batch_payload(trees, tree_token_budget))
 
 def review(diff):
+    response_format = prompts.response_format("review")
     try:
-        response = client.chat.completions.create(
-            messages=[
-                # {"role": "system", "content": "You are a grammar-checking assistant.  "},
-                {"role": "user", "content": f'''
-        You are an experienced PostgreSQL developer and security expert. Please review the
-                 following diff for issues. Return a JSON array describing the issues.
-                 For each issue, you will provide the following:
-                 * description: a short to medium length paragraph explaining the issue.
-                 * type: a string set to one of the following values:
-                    * BUG: a functional error in the code that needs to be fixed
-                    * TYPO: an error in a comment, etc
-                    * OTHER: something else.
-                 * confidence: on a scale of 0 to 10, how confident are you that this
-                 is a real issue that the postgresql team would accept as worth fixing?
-                 obviously it's not worth flagging a bunch of issues with low confidence.
-                 * severity: on a scale of 0 to 10, how important is this issue? Many
-                 typos will be a 0, but still worth calling out, and like a zero-day vulnerability
-                 would be a 10. An example of something that usually isn't a bug is an apparent undefined 
-                 variable - usually it'll just be defined somewhere that's not part of the 
-                 patch itself, and this would be caught by the compiler. In general,
-                 you don't need to flag anything that the compiler would catch.
-
-                 Your response should have the following format:
-
-                 [
-                    {{
-                        "description": <text>,
-                        "type": <one of BUG|TYPO|OTHER>,
-                        "confidence": <0 to 10>,
-                        "severity": <0 to 10>
-                    }}, ...
-                 ]
-
-                 Please output only JSON, with no other characters, so we can
-                 parse your output; the first character should be a [. and the last one should
-                 be a ].
-
-                 Without further ado, here is the Git patch:
-
-                 {
-                     diff
-                 }
-
-                ===
-                As discussed above, please output a JSON array with 0 or more issues, in
-                the following format:
-
-                [
-                    {{
-                        "description": <text>,
-                        "type": <one of BUG|TYPO|OTHER>,
-                        "confidence": <0 to 10>,
-                        "severity": <0 to 10>
-                    }}, ...
-                 ]
-
-                 If there are no issues, don't try to manufacture one - just return
-                 an empty array. Remember, you're describing unintended problems you
-                 find in the code, NOT the overall purpose of the patch.
-        '''}
-            
-            ],
-            reasoning_effort="high",
-            model="o3-mini-2025-01-31",
-        )
-
-        text = response.choices[0].message.content
-
-        return json.loads(text)
-    except:
-        return None 
+        text = complete("review", review_messages(diff), response_format, normalize=normalize_issues)
+    except Exception as e:
+        print(f"Review: {e}")
+        return None
+    return decode_reply("review", text, normalize_issues, response_format)
 
 def code_tree(tree):
+    response_format = prompts.response_format("code_tree")
     try:
-        response = client.chat.completions.create(
-            messages=[
-                # {"role": "system", "content": "You are a grammar-checking assistant.  "},
-                {"role": "user", "content": f'''
-        You are an experienced PostgreSQL developer. You to be given the source code of a postgres function,
-                 together with the source code (if available) for the functions it calls. 
-                 Please review the code for issues. Return a JSON array describing the issues.
-                 For each issue, you will provide the following:
-                 * description: a short to medium length paragraph explaining the issue.
-                 * type: a string set to one of the following values:
-                    * BUG: a functional error in the code that needs to be fixed
-                    * TYPO: an error in a comment, etc
-                    * PERFORMANCE: a performance.
-                 * confidence: on a scale of 0 to 10, how confident are you that this
-                 is a real issue that the postgresql team would accept as worth fixing?
-                 obviously it's not worth flagging a bunch of issues with low confidence.
-                 * severity: on a scale of 0 to 10, how important is this issue? Many
-                 typos will be a 0, but still worth calling out, and like a zero-day vulnerability
-                 would be a 10. An example of something that usually isn't a bug is an apparent undefined 
-                 variable - usually it'll just be defined somewhere that's not part of the 
-                 patch itself, and this would be caught by the compiler. In general,
-                 you don't need to flag anything that the compiler would catch.
-                 A hypothetical coding flaw, like needing to check for a null pointer,
-                 etc, usually is not a big deal in practice, since we can assume
-                 that such an issue would probably have manifested by now. I don't really
-                 care about most code quality issues. Don't worry about apparent naming inconsistencies.
-
-                 ONLY REPORT ISSUES THAT YOU ARE *VERY* CONFIDENT ABOUT.
-                 THE VAST MAJORITY OF THE TIME, THERE WILL BE NO ISSUES.
-
-                 DO NOT REPORT ANY APPARENT COMPILE ERRORS - ASSUME 
-                 POSTGRES HAS SOME PARTICULAR DEFINITIONS ETC OR OTHER,
-                 NON-INCLUDED CODE THAT WOULD FIX IT. THERE ARE DEFINITELY NO COMPILE ERRORS.
-
-                 Your response should have the following format:
-
-                 [
-                    {{
-                        "description": <text>,
-                        "type": <one of BUG|TYPO|PERFORMANCE>,
-                        "confidence": <0 to 10>,
-                        "severity": <0 to 10>
-                    }}, ...
-                 ]
-
-                 Please output only JSON, with no other characters, so we can
-                 parse your output; the first character should be a [. and the last one should
-                 be a ].
-
-                 Without further ado, here is the Git patch:
-
-                 {
-                     tree
-                 }
-
-                ===
-                As discussed above, please output a JSON array with 0 or more issues, in
-                the following format:
-
-                [
-                    {{
-                        "description": <text>,
-                        "type": <one of BUG|TYPO|PERFORMANCE>,
-                        "confidence": <0 to 10>,
-                        "severity": <0 to 10>
-                    }}, ...
-                 ]
-
-                 If there are no issues, don't try to manufacture one - just return
-                 an empty array. 
-
-        '''}
-            
-            ],
-            reasoning_effort="high",
-            model="o3-mini-2025-01-31",
-        )
-
-        text = response.choices[0].message.content
-
-        return json.loads(text)
-    except:
-        return None 
-
+        text = complete("code_tree", code_tree_messages(tree), response_format, normalize=normalize_issues)
+    except Exception as e:
+        print(f"Code tree {tree['functionName']}: {e}")
+        return None
+    return decode_reply("code_tree", text, normalize_issues, response_format)
+
+def batch_analyses(reply, count):
+    """One analysis per tree from a normalized batch reply, None where missing."""
+    if reply is None:
+        return [None] * count
+    return [reply[prompts.batch_id(position)] for position in range(count)]
+
+def code_tree_batch(trees):
+    """
+    Review several code trees in one request. Returns one analysis per tree, in
+    order; trees missing from the reply are reviewed on their own instead.
+    """
+    ids = [prompts.batch_id(position) for position in range(len(trees))]
+    response_format = prompts.response_format("code_tree_batch", len(trees))
+    try:
+        normalize = lambda value: normalize_batch(value, ids)
+        text = complete("code_tree_batch", code_tree_batch_messages(trees), response_format, normalize=normalize)
+        reply = decode_reply("code_tree_batch", text, normalize, response_format)
+    except Exception as e:
+        print(f"Batch of {len(trees)} code trees: {e}")
+        reply = None
+    analyses = batch_analyses(reply, len(trees))
+    missing = [position for position, analysis in enumerate(analyses) if analysis is None]
+    if missing:
+        print(f"Batch reply is missing {len(missing)} of {len(trees)} code trees; reviewing them separately")
+    for position in missing:
+        analyses[position] = code_tree(trees[position])
+    return analyses
 
 def reproduce(diff, issues):
     try:
-        response = client.chat.completions.create(
-            messages=[
-                {"role": "user", "content": f'''
-        You are an experienced PostgreSQL developer and security expert. Another expert reviewed
-                 the following patch:
-                 {
-                     diff
-                 }
-
-                ===
-
-                Based on that patch, the other developer proposed the following issues:
-
-                {
-                    issues
-                }
-
-            Please carefully evaluate if those issues seem correct. Also, if there is an issue,
-            please provide a clear reproduction case if possible, for example a SQL script
-            that demonstrates the problem, explaining the result you think the script
-            would have and the result it should actually have.
-
-            If possible, also propose a code change that would fix the issue, although it doesn't
-            need to be completely rigorous. 
-
-    {diff}'''}
-            
-            ],
-            reasoning_effort="high",
-            model="o3-mini-2025-01-31",
-        )
-
-        text = response.choices[0].message.content
+        text = complete("reproduce", reproduce_messages(diff, issues))
 
         return text # no need for json here
     except Exception as e:
         print(e)
         return None 
+
+
+# -----------------------
+# Async client
+# -----------------------
+
+# Account limits for the async path; None means unlimited. Set from the CLI or
+# the LLM_RPM / LLM_TPM environment variables.
+requests_per_minute = int(os.environ["LLM_RPM"]) if os.environ.get("LLM_RPM") else None
+tokens_per_minute = int(os.environ["LLM_TPM"]) if os.environ.get("LLM_TPM") else None
+initial_concurrency = 8
+max_concurrency = 64
+
+# Tokens reserved for the response before we know its real size (reasoning included).
+COMPLETION_TOKEN_ESTIMATE = 4000
+
+class AsyncState:
+    """Client and limiters for one event loop; asyncio objects cannot be shared across loops."""
+
+    def __init__(self):
+        import openai
+        self.client = openai.AsyncOpenAI(
+            **client_options(),
+            max_retries=0,  # acomplete does its own, rate-limit aware, retrying
+        )
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.concurrency = AdaptiveLimiter(initial=min(initial_concurrency, max_concurrency), maximum=max_concurrency)
+        self.retries = 0
+        self.throttled = 0
+
+_async_states = {}
+
+def get_async_state():
+    loop = asyncio.get_running_loop()
+    state = _async_states.get(loop)
+    if state is None:
+        _async_states.clear()
+        state = _async_states[loop] = AsyncState()
+    return state
+
+def estimate_tokens(messages):
+    """Prompt size in tokens, estimated locally (see prompts.estimate_tokens)."""
+    return sum(estimate_text_tokens(message["content"]) + 4 for message in messages)
+
+async def acomplete(template, messages, response_format=None, reasoning_effort=REASONING_EFFORT, normalize=None):
+    """
+    Async version of complete(). Waits for room under the requests/minute and
+    tokens/minute budgets and for a concurrency slot, then calls the API. 429s,
+    5xx and connection errors are retried with backoff, honouring Retry-After,
+    up to max_retries times; after that the error is raised rather than hidden.
+    """
+    cache = get_response_cache()
+    if cache is not None:
+        key = make_key(endpoint(), MODEL, reasoning_effort, template, PROMPT_VERSIONS[template], messages)
+        text = cache.get(key)
+        if text is not None:
+            return text
+
+    import openai
+    state = get_async_state()
+    reserved = estimate_tokens(messages) + COMPLETION_TOKEN_ESTIMATE
+    attempt = 0
+    while True:
+        attempt += 1
+        await state.requests.acquire(1)
+        await state.tokens.acquire(reserved)
+        async with state.concurrency:
+            start = time.monotonic()
+            options = request_options(response_format, reasoning_effort)
+            try:
+                response = await state.client.chat.completions.create(messages=messages, **options)
+            except openai.BadRequestError as e:
+                # Nothing was generated, whether the request is retried or not.
+                state.tokens.refund(reserved)
+                if not response_format_rejected(e, options):
+                    raise
+                continue
+            except retryable_errors() as e:
+                state.concurrency.on_throttle()
+                state.tokens.refund(reserved)
+                if attempt > max_retries:
+                    raise
+                response_headers = getattr(getattr(e, "response", None), "headers", None)
+                retry_after = parse_retry_after(response_headers)
+                if isinstance(e, openai.RateLimitError):
+                    state.throttled += 1
+                    if retry_after is not None:
+                        state.requests.drain(retry_after)
+                state.retries += 1
+                delay = backoff_delay(attempt, retry_after)
+            except Exception:
+                state.tokens.refund(reserved)
+                raise
+            else:
+                latency = time.monotonic() - start
+                state.concurrency.on_success(latency)
+                usage = getattr(response, "usage", None)
+                record_usage(template, messages, usage, latency, attempt - 1)
+                if usage is not None and usage.total_tokens is not None:
+                    state.tokens.refund(reserved - usage.total_tokens)
+                text = response.choices[0].message.content
+                if cache is not None and cacheable(text, normalize):
+                    cache.put(key, MODEL, template, text)
+                return text
+        await asyncio.sleep(delay)
+
+async def adecode_reply(template, text, normalize, response_format=None):
+    """Async version of decode_reply()."""
+    with telemetry.span(f"parse.{template}"):
+        value, outcome = parse_reply(text, normalize)
+    if outcome == "failed" and text:
+        try:
+            repaired = await acomplete("repair", repair_messages(text), response_format, REPAIR_REASONING_EFFORT, normalize)
+        except Exception as e:
+            print(f"Repairing a {template} reply failed: {e}")
+            repaired = None
+        value, repaired_outcome = parse_reply(repaired, normalize)
+        if repaired_outcome != "failed":
+            outcome = "repaired"
+    record_parse(template, outcome)
+    return value
+
+async def areview(diff):
+    response_format = prompts.response_format("review")
+    text = await acomplete("review", review_messages(diff), response_format, normalize=normalize_issues)
+    return await adecode_reply("review", text, normalize_issues, response_format)
+
+async def acode_tree(tree):
+    response_format = prompts.response_format("code_tree")
+    text = await acomplete("code_tree", code_tree_messages(tree), response_format, normalize=normalize_issues)
+    return await adecode_reply("code_tree", text, normalize_issues, response_format)
+
+async def acode_tree_batch(trees):
+    """Async version of code_tree_batch(); the fallback calls run concurrently."""
+    ids = [prompts.batch_id(position) for position in range(len(trees))]
+    response_format = prompts.response_format("code_tree_batch", len(trees))
+    normalize = lambda value: normalize_batch(value, ids)
+    text = await acomplete("code_tree_batch", code_tree_batch_messages(trees), response_format, normalize=normalize)
+    reply = await adecode_reply("code_tree_batch", text, normalize, response_format)
+    analyses = batch_analyses(reply, len(trees))
+    missing = [position for position, analysis in enumerate(analyses) if analysis is None]
+    if missing:
+        print(f"Batch reply is missing {len(missing)} of {len(trees)} code trees; reviewing them separately")
+        retried = await asyncio.gather(*(acode_tree(trees[position]) for position in missing))
+        for position, analysis in zip(missing, retried):
+            analyses[position] = analysis
+    return analyses
+
+async def areproduce(diff, issues):
+    return await acomplete("reproduce", reproduce_messages(diff, issues))
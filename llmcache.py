@@ -0,0 +1,104 @@
+"""
+Persistent cache of LLM responses, stored in SQLite.
+
+Responses are keyed by (endpoint, model, reasoning effort, prompt template,
+template version, hash of the rendered messages), so a prompt we have already
+paid for is answered locally, and replies from a mock or local server never
+stand in for the real API's. The cache is shared by all threads of a run and by
+concurrent runs (WAL mode), and is trimmed by age and total size when it is
+opened.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_PATH = os.path.join(os.environ.get("FUZZER_CACHE_DIR", ".cache"), "llm_responses.sqlite3")
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_MAX_AGE_DAYS = 90
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    template TEXT NOT NULL,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+"""
+
+def make_key(endpoint, model, reasoning_effort, template, version, messages):
+    """Cache key for one chat completion request sent to endpoint (a base URL)."""
+    payload = json.dumps(messages, sort_keys=True, ensure_ascii=False).encode('utf-8')
+    input_hash = hashlib.sha256(payload).hexdigest()
+    return f"{endpoint}|{model}|{reasoning_effort}|{template}|v{version}|{input_hash}"
+
+class ResponseCache:
+    def __init__(self, path=DEFAULT_PATH, max_bytes=DEFAULT_MAX_BYTES, max_age_days=DEFAULT_MAX_AGE_DAYS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self.evict()
+
+    def get(self, key):
+        """Return the cached response text for key, or None."""
+        with self._lock:
+            row = self._conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            with self._conn:
+                self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, model, template, response):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, template, response, size, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, model, template, response, len(response.encode('utf-8')), now, now)
+            )
+
+    def evict(self):
+        """
+        Drop entries older than max_age_days, then the least recently used ones
+        until the cache holds at most max_bytes of responses.
+        """
+        with self._lock, self._conn:
+            if self.max_age_days is not None:
+                cutoff = time.time() - self.max_age_days * 86400
+                self._conn.execute("DELETE FROM responses WHERE created_at < ?", (cutoff,))
+            if self.max_bytes is not None:
+                total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                if total > self.max_bytes:
+                    excess = total - self.max_bytes
+                    doomed = []
+                    for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_used"):
+                        if excess <= 0:
+                            break
+                        doomed.append((key,))
+                        excess -= size
+                    self._conn.executemany("DELETE FROM responses WHERE key = ?", doomed)
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM responses")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
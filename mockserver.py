@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+A local OpenAI-compatible chat completions server, for exercising and
+benchmarking the fuzzer without an API key.
+
+  python mockserver.py --port 8000 --latency lognormal:0.8:0.5 --rate-limit 0.02
+  python review.py tree 100 --base-url http://127.0.0.1:8000/v1
+
+Replies are canned but shaped like the real ones: issue arrays for review and
+code_tree prompts (wrapped in {"issues": ...} when a response_format is sent),
+{"F1": [...], ...} for batched code trees, and prose for reproductions.
+Latency is drawn from a configurable distribution, and a fraction of requests
+can be answered with a 429 (with Retry-After), a 500, or a garbled reply, to
+exercise the retry and salvage paths. Usage reports estimated prompt and
+completion tokens, with a repeated system message counted as cached.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from prompts import TEMPLATES, estimate_tokens
+
+BATCH_ID_REGEX = re.compile(r'^## Function (F\d+)', re.MULTILINE)
+
+ISSUE_TYPES = ("BUG", "TYPO", "PERFORMANCE")
+
+def parse_latency(spec):
+    """
+    A function returning one latency in seconds, from a spec: "0.2" (fixed),
+    "uniform:LOW:HIGH", "normal:MEAN:SD", "lognormal:MEDIAN:SIGMA" or
+    "exp:MEAN". Negative draws are clamped to 0.
+    """
+    name, _, params = spec.partition(":")
+    try:
+        if not params:
+            fixed = float(name)
+            return lambda rng: fixed
+        values = [float(value) for value in params.split(":")]
+    except ValueError:
+        raise ValueError(f"Invalid latency {spec!r}")
+    distributions = {
+        "uniform": (2, lambda rng, low, high: rng.uniform(low, high)),
+        "normal": (2, lambda rng, mean, sd: rng.gauss(mean, sd)),
+        "lognormal": (2, lambda rng, median, sigma: median * rng.lognormvariate(0.0, sigma)),
+        "exp": (1, lambda rng, mean: rng.expovariate(1.0 / mean) if mean > 0 else 0.0),
+    }
+    if name not in distributions or len(values) != distributions[name][0]:
+        raise ValueError(f"Invalid latency {spec!r}; expected a number, uniform:LOW:HIGH, "
+                         "normal:MEAN:SD, lognormal:MEDIAN:SIGMA or exp:MEAN")
+    draw = distributions[name][1]
+    return lambda rng: max(0.0, draw(rng, *values))
+
+def template_of(messages):
+    """The prompts.TEMPLATES name whose system message this request uses, or None."""
+    system = next((message["content"] for message in messages if message.get("role") == "system"), None)
+    for name, template in TEMPLATES.items():
+        if template["system"] == system:
+            return name
+    return None
+
+def garble(text, rng):
+    """Damage a JSON reply the ways models do: prose and fences around it, a trailing comma, or a cut."""
+    damage = rng.randrange(4)
+    if damage == 0:
+        return "Here is my review:\n\n```json\n" + text + "\n```"
+    if damage == 1:
+        return re.sub(r'(\]|\})$', r',\1', text) if len(text) > 2 else text + ","
+    if damage == 2:
+        return text[:max(1, len(text) // 2)]
+    return "I could not find any issues worth reporting in this code."
+
+class MockServer(ThreadingHTTPServer):
+    """The HTTP server, holding the reply settings and request counters."""
+
+    daemon_threads = True
+
+    def __init__(self, address, latency="0", rate_limit=0.0, error_rate=0.0, garbage_rate=0.0,
+                 issue_rate=0.2, retry_after=1.0, seed=None):
+        super().__init__(address, MockHandler)
+        self.latency = parse_latency(latency)
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.garbage_rate = garbage_rate
+        self.issue_rate = issue_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.seen_systems = set()
+        self.stats = {"requests": 0, "ok": 0, "rate_limited": 0, "errors": 0, "garbled": 0}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def draw(self):
+        """(latency, outcome) for one request; outcome is "rate_limited", "errors", "garbled" or "ok"."""
+        with self.lock:
+            latency = self.latency(self.rng)
+            roll = self.rng.random()
+            self.stats["requests"] += 1
+            if roll < self.rate_limit:
+                outcome = "rate_limited"
+            elif roll < self.rate_limit + self.error_rate:
+                outcome = "errors"
+            elif roll < self.rate_limit + self.error_rate + self.garbage_rate:
+                outcome = "garbled"
+            else:
+                outcome = "ok"
+            self.stats[outcome] += 1
+            return latency, outcome
+
+    def issues(self):
+        with self.lock:
+            if self.rng.random() >= self.issue_rate:
+                return []
+            return [{
+                "description": "Mock issue: the result of this call is used without checking it.",
+                "type": self.rng.choice(ISSUE_TYPES),
+                "confidence": self.rng.randint(0, 10),
+                "severity": self.rng.randint(0, 10),
+            }]
+
+    def reply(self, request):
+        """The reply text for a chat completions request."""
+        messages = request.get("messages") or []
+        payload = messages[-1]["content"] if messages else ""
+        template = template_of(messages)
+        if template == "reproduce":
+            return "The issue looks real. Running the following script should show it:\n\nSELECT 1;\n"
+        if template == "repair":
+            return json.dumps(self.issues())
+        ids = BATCH_ID_REGEX.findall(payload)
+        if template == "code_tree_batch" or ids:
+            return json.dumps({batch_id: self.issues() for batch_id in ids})
+        if request.get("response_format"):
+            return json.dumps({"issues": self.issues()})
+        return json.dumps(self.issues())
+
+    def usage(self, messages, text):
+        prompt_tokens = sum(estimate_tokens(message.get("content") or "") + 4 for message in messages)
+        cached_tokens = 0
+        system = next((message["content"] for message in messages if message.get("role") == "system"), None)
+        if system is not None:
+            with self.lock:
+                if system in self.seen_systems:
+                    cached_tokens = estimate_tokens(system)
+                self.seen_systems.add(system)
+        completion_tokens = estimate_tokens(text)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        }
+
+class MockHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            with self.server.lock:
+                self.send_json(200, dict(self.server.stats))
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+        except ValueError:
+            self.send_json(400, {"error": {"message": "Request body is not JSON", "type": "invalid_request_error"}})
+            return
+        server = self.server
+        latency, outcome = server.draw()
+        time.sleep(latency)
+        if outcome == "rate_limited":
+            self.send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_exceeded"}},
+                           {"Retry-After": f"{server.retry_after:g}"})
+            return
+        if outcome == "errors":
+            self.send_json(500, {"error": {"message": "Internal error (mock)", "type": "server_error"}})
+            return
+        text = server.reply(request)
+        if outcome == "garbled":
+            with server.lock:
+                text = garble(text, server.rng)
+        messages = request.get("messages") or []
+        self.send_json(200, {
+            "id": f"chatcmpl-mock{server.stats['requests']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": text}}],
+            "usage": server.usage(messages, text),
+        })
+
+def start(host="127.0.0.1", port=0, **options):
+    """Start a MockServer on a background thread (port 0 picks a free one) and return it."""
+    server = MockServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible chat completions server")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on (default: 8000)")
+    parser.add_argument("--latency", type=str, default="0", help="Reply latency in seconds: a number, uniform:LOW:HIGH, normal:MEAN:SD, lognormal:MEDIAN:SIGMA or exp:MEAN (default: 0)")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="Fraction of requests answered with 429 (default: 0)")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with a 429 (default: 1)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 500 (default: 0)")
+    parser.add_argument("--garbage-rate", type=float, default=0.0, help="Fraction of replies garbled: fenced, truncated, or prose (default: 0)")
+    parser.add_argument("--issue-rate", type=float, default=0.2, help="Probability of reporting an issue per reviewed function or patch (default: 0.2)")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed, for repeatable runs")
+    args = parser.parse_args()
+
+    server = MockServer((args.host, args.port), args.latency, args.rate_limit, args.error_rate,
+                        args.garbage_rate, args.issue_rate, args.retry_after, args.seed)
+    print(f"Mock API listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"Requests: {server.stats}")
+
+if __name__ == "__main__":
+    main()
@@ -1,87 +1,265 @@
 #!/usr/bin/env python3
+import argparse
 import os
 import sys
-import regex
+import re
 import random
 import pickle
 import hashlib
+import subprocess
 import time
 
+import telemetry
+from funcindex import FunctionIndex, content_hash, write_index
+
 # -----------------------
 # Regex Definitions
 # -----------------------
 
-# Revised regex that extracts a function definition including an optional preceding comment.
-# It matches an optional comment block (or line comments) immediately preceding the function signature.
-FUNC_REGEX = regex.compile(r'''
-(?P<full>
-    ^\s*                                   # Start-of-line optional whitespace
-    (?P<comment>(?:/\*.*?\*/\s*|//.*?\n\s*)*)  # Optional preceding comments (block or line)
-    (?:static\s+)?                         # Optional "static" keyword
-    (?:inline\s+)?                         # Optional "inline" keyword
-    (?P<ret>[a-zA-Z_][a-zA-Z0-9_\*\s]+?)\s+  # Return type (non-greedy)
-    (?P<name>[a-zA-Z_][a-zA-Z0-9_]*)\s*      # Function name
-    \([^)]*\)\s*                           # Parameter list (anything until the first ')')
-    \{                                     # Opening brace of function body
-    (?:                                    # Non-capturing group for body content:
-         [^{}]*                           #   Any characters except braces
-         (?:\{[^{}]*\}[^{}]*)*             #   Optionally one level of nested braces
-    )
-    \}                                     # Closing brace of function body
-)
-''', regex.MULTILINE | regex.VERBOSE | regex.DOTALL)
+# Tokens the function scanner cares about. Everything else (identifiers, numbers,
+# operators, whitespace) is skipped inside the regex engine. Each alternative is
+# free of nested quantifiers, and unterminated comments/strings run to the end of
+# the input (or line), so a scan is a single linear pass with no backtracking.
+SCAN_REGEX = re.compile(r'''
+    (?P<comment>/\*(?:[^*]|\*(?!/))*(?:\*/|\Z)|//[^\n]*)   # Block or line comment
+  | (?P<pp>^[ \t]*\#(?:[^\n\\]|\\.|\\\n)*)                # Preprocessor line (with continuations)
+  | (?P<string>"(?:[^"\\\n]|\\.)*"?)                       # String literal
+  | (?P<char>'(?:[^'\\\n]|\\.)*'?)                         # Character literal
+  | (?P<punct>[{}();=])                                     # Structure-relevant punctuation
+''', re.MULTILINE | re.VERBOSE)
+
+PP_DIRECTIVE_REGEX = re.compile(r'[ \t]*#[ \t]*(\w+)')
+TRAILING_IDENT_REGEX = re.compile(r'([A-Za-z_][A-Za-z0-9_]*)[ \t\r\n]*\Z')
+EXTERN_BLOCK_REGEX = re.compile(r'extern\s*"[^"]*"\s*\Z')
 
-# Simple regex to capture potential function calls (naïve approach)
-CALL_REGEX = regex.compile(r'\b([a-zA-Z_][a-zA-Z0-9_]*)\s*\(')
+# Simple regex to capture potential function calls (naïve approach). Compiled
+# on first use, so commands that only read a cached index don't import regex.
+CALL_PATTERN = r'\b([a-zA-Z_][a-zA-Z0-9_]*)\s*\('
+_call_regex = None
 EXCLUDE_KEYWORDS = {"if", "for", "while", "switch", "return", "sizeof"}
 
+# Words that can precede a top-level "(...) {" without it being a function definition.
+NON_FUNCTION_NAMES = EXCLUDE_KEYWORDS | {"do", "else", "case", "goto", "defined", "_Alignof", "alignof"}
+# Parenthesised decorations that can follow a parameter list; never function names.
+ATTRIBUTE_NAMES = {"__attribute__", "__declspec", "__asm__", "asm", "_Pragma"}
+
 # -----------------------
 # Extraction Functions
 # -----------------------
 
+def scan_functions(source):
+    """
+    Scan complete C source code and yield (name, start, end) for every function
+    definition, where source[start:end] is the definition including any comments
+    immediately preceding it.
+
+    This is a single pass over the tokens matched by SCAN_REGEX: comments, string
+    and character literals are skipped, and braces are matched at any depth. A
+    top-level "{" opens a function body when the declaration in front of it has a
+    parameter list and no initializer. The name is the identifier in front of the
+    last parameter list, so unterminated macro invocations before it are ignored.
+    When an #else/#elif branch starts at a different brace depth than its #if (the
+    usual "if (a) {" / "if (b) {" trick), the rest of the conditional is skipped
+    so the braces stay balanced.
+    """
+    depth = 0
+    paren_depth = 0
+    boundary = 0           # end of the last top-level statement, directive or comment
+    decl_start = None      # first code character of the current top-level declaration
+    comment_start = None   # start of the comment block just before decl_start
+    paren_end = 0          # end of the last top-level "(...)" group in the declaration
+    name = None            # identifier before the last top-level "(" of the declaration
+    is_initializer = False
+    func_start = None
+    func_name = None
+    cond_stack = []        # brace depth at each open #if
+    skip_to = None         # len(cond_stack) we are waiting to return to, when skipping
+
+    for match in SCAN_REGEX.finditer(source):
+        kind = match.lastgroup
+
+        if kind == 'pp':
+            directive = PP_DIRECTIVE_REGEX.match(match.group())
+            directive = directive.group(1) if directive else ''
+            if directive.startswith('if'):
+                cond_stack.append(depth)
+            elif directive in ('else', 'elif', 'elifdef', 'elifndef'):
+                if skip_to is None and cond_stack and cond_stack[-1] != depth:
+                    skip_to = len(cond_stack)
+            elif directive == 'endif':
+                if cond_stack:
+                    cond_stack.pop()
+                if skip_to is not None and len(cond_stack) < skip_to:
+                    skip_to = None
+            if depth == 0 and skip_to is None:
+                boundary = match.end()
+                decl_start = comment_start = name = None
+                paren_depth = 0
+                is_initializer = False
+            continue
+
+        if skip_to is not None:
+            continue
+
+        if depth > 0:
+            if kind == 'punct':
+                ch = match.group()
+                if ch == '{':
+                    depth += 1
+                elif ch == '}':
+                    depth -= 1
+                    if depth == 0:
+                        if func_name is not None:
+                            yield func_name, func_start, match.end()
+                        func_name = None
+                        boundary = match.end()
+                        decl_start = comment_start = name = None
+                        paren_depth = 0
+                        is_initializer = False
+            continue
+
+        # Top level: work out where the current declaration (and its comment) starts.
+        if decl_start is None:
+            gap = source[boundary:match.start()]
+            stripped = gap.lstrip()
+            if stripped:
+                decl_start = paren_end = match.start() - len(stripped)
+            elif kind == 'comment':
+                if comment_start is None:
+                    comment_start = match.start()
+                boundary = match.end()
+                continue
+            else:
+                decl_start = paren_end = match.start()
+
+        if kind != 'punct':
+            continue
+        ch = match.group()
+        if ch == '(':
+            if paren_depth == 0 and not is_initializer:
+                ident = TRAILING_IDENT_REGEX.search(source, paren_end, match.start())
+                if ident and ident.group(1) not in ATTRIBUTE_NAMES:
+                    name = ident.group(1)
+            paren_depth += 1
+        elif ch == ')':
+            if paren_depth > 0:
+                paren_depth -= 1
+                if paren_depth == 0:
+                    paren_end = match.end()
+        elif ch == '=':
+            if paren_depth == 0:
+                is_initializer = True
+        elif ch == ';':
+            if paren_depth == 0:
+                boundary = match.end()
+                decl_start = comment_start = name = None
+                is_initializer = False
+        elif ch == '{':
+            if name is None and EXTERN_BLOCK_REGEX.match(source, decl_start, match.start()):
+                # extern "C" { ... } only wraps declarations; stay at the top level.
+                boundary = match.end()
+                decl_start = comment_start = None
+                is_initializer = False
+                continue
+            depth = 1
+            paren_depth = 0
+            if name and not is_initializer and name not in NON_FUNCTION_NAMES:
+                func_name = name
+                func_start = comment_start if comment_start is not None else decl_start
+            else:
+                func_name = None
+        elif ch == '}':
+            # Stray closing brace at top level; resynchronise.
+            boundary = match.end()
+            decl_start = comment_start = name = None
+            paren_depth = 0
+            is_initializer = False
+
 def extract_functions_from_source(source):
     """
     Given complete C source code as a string, return a dictionary mapping
     function names to their full source code (including any immediately preceding comments).
-    If regex matching times out (after 1 second), skip this file.
     """
     functions = {}
-    try:
-        for match in FUNC_REGEX.finditer(source, timeout=1.0):
-            func_name = match.group('name')
-            func_source = match.group('full')
-            functions[func_name] = func_source
-    except TimeoutError:
-        print("  Regex matching timed out on this file. Skipping function extraction.")
-        return {}
+    for func_name, start, end in scan_functions(source):
+        functions[func_name] = source[start:end]
     return functions
 
 def find_called_functions(func_source):
     """
     Given a function's source code, return a set of names that appear to be called.
     """
-    calls = CALL_REGEX.findall(func_source)
+    global _call_regex
+    if _call_regex is None:
+        import regex
+        _call_regex = regex.compile(CALL_PATTERN)
+    calls = _call_regex.findall(func_source)
     return {name for name in calls if name not in EXCLUDE_KEYWORDS}
 
 def find_c_files(path):
     """
     Given a directory, recursively find all files with .c or .h extension.
+    Directories and files are visited in sorted order so the result is stable.
     """
     c_files = []
     for root, dirs, files in os.walk(path):
-        for file in files:
+        dirs.sort()
+        for file in sorted(files):
             if file.lower().endswith(('.c', '.h')):
                 c_files.append(os.path.join(root, file))
     return c_files
 
-def build_functions_dict(path):
+def index_file(filepath):
+    """
+    Extract the functions of one file. Returns (filepath, table, error), where
+    table is a list of (name, byte offset, byte length, content hash, called
+    names) in file order. Runs in worker processes, so it only returns plain
+    picklable data.
+    """
+    try:
+        with open(filepath, 'rb') as f:
+            data = f.read()
+    except Exception as e:
+        return filepath, [], str(e)
+    # latin-1 maps every byte to one character, so string offsets are byte offsets.
+    source = data.decode('latin-1')
+    spans = {}
+    for name, start, end in scan_functions(source):
+        calls = tuple(sorted(find_called_functions(source[start:end])))
+        spans[name] = (start, end - start, content_hash(data[start:end]), calls)
+    return filepath, [(name, *span) for name, span in spans.items()], None
+
+def default_jobs():
+    """Number of indexing processes to use when none is given."""
+    return os.cpu_count() or 1
+
+def iter_indexed_files(files, jobs):
+    """
+    Yield index_file() results for each file, in the order of `files`.
+    With jobs > 1 the files are spread over a process pool.
+    """
+    if jobs <= 1 or len(files) <= 1:
+        for filepath in files:
+            yield index_file(filepath)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    # Enough chunks per worker to keep them all busy, few enough to keep IPC cheap.
+    chunksize = max(1, min(64, len(files) // (jobs * 8)))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(index_file, files, chunksize=chunksize)
+
+def build_index(path, jobs=None):
     """
-    Process a single file or all .c/.h files in a directory, and return a dictionary
-    mapping function names to a tuple: (function source, filepath).
-    Prints a START message when beginning and a FINISHED message (with elapsed time)
-    when done processing each file.
+    Process a single file or all .c/.h files in a directory, and return a
+    FunctionIndex of the functions they define and the calls between them.
+
+    Each file's functions are cached under its content key (see get_file_keys), so
+    only files that are new or changed since the last run are scanned. Those are
+    scanned by `jobs` processes (default: one per CPU). Results are merged in file
+    order, so when a function name appears more than once the first one wins.
+    If no file changed since the index was last written, it is opened as is.
+    Progress is printed about once a second.
     """
-    all_functions = {}
     if os.path.isfile(path):
         files = [path]
     elif os.path.isdir(path):
@@ -94,68 +272,309 @@ def build_functions_dict(path):
         print(f"No .c/.h files found in {path}")
         sys.exit(1)
     
-    total_files = len(files)
-    print(f"Processing {total_files} file(s)...\n")
-    for idx, filepath in enumerate(files, start=1):
-        print(f"[{idx}/{total_files}] START processing: {filepath}")
-        start_time = time.time()
-        try:
-            with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
-                source = f.read()
-        except Exception as e:
-            print(f"Error reading {filepath}: {e}")
-            continue
+    start_time = time.time()
+    with telemetry.span("index.file_keys", files=len(files)):
+        file_keys = get_file_keys(path, files)
+    index_path = get_index_path(path)
+    digest = hashlib.sha1(f"v{INDEX_VERSION}".encode('utf-8'))
+    for filepath in files:
+        digest.update(f"\0{filepath}\0{file_keys[filepath]}".encode('utf-8', errors='surrogateescape'))
+    digest = digest.digest()
+
+    index = FunctionIndex.open(index_path)
+    if index is not None:
+        if index.digest == digest:
+            print(f"Using index with {len(index)} function(s).\n")
+            return index
+        index.close()  # out of date; release the file before it is rewritten
+
+    if jobs is None:
+        jobs = default_jobs()
+    if telemetry.profile_path:
+        jobs = 1  # scan in this process, so the profile sees the scanner
+    tables = {}
+    with telemetry.span("index.load_cache"):
+        for filepath in files:
+            table = load_cache(get_cache_path(file_keys[filepath]))
+            if table is not None:
+                tables[filepath] = table
+    misses = [filepath for filepath in files if filepath not in tables]
+    telemetry.count("index.cached_files", len(tables))
+    telemetry.count("index.scanned_files", len(misses))
 
-        funcs = extract_functions_from_source(source)
-        if funcs:
-            print(f"  Found {len(funcs)} function(s) in this file.")
-        for name, code in funcs.items():
+    total_files = len(misses)
+    print(f"{len(tables)} of {len(files)} file(s) unchanged; processing {total_files} file(s) with {jobs} job(s)...")
+    last_report = start_time
+    errors = 0
+    with telemetry.span("index.scan", files=total_files, jobs=jobs), telemetry.profile():
+        for idx, (filepath, funcs, error) in enumerate(iter_indexed_files(misses, jobs), start=1):
+            if error is not None:
+                print(f"Error reading {filepath}: {error}")
+                errors += 1
+            else:
+                save_cache(get_cache_path(file_keys[filepath]), funcs)
+            tables[filepath] = funcs
+            now = time.time()
+            if now - last_report >= 1.0 or idx == total_files:
+                last_report = now
+                print(f"[{idx}/{total_files}] Errors: {errors} | {now - start_time:.2f} seconds")
+
+    entries = {}
+    for file_id, filepath in enumerate(files):
+        for name, offset, length, hashed, calls in tables[filepath]:
             # For simplicity, if a function name appears more than once, keep the first occurrence.
-            if name not in all_functions:
-                all_functions[name] = (code, filepath)
-        elapsed = time.time() - start_time
-        print(f"[{idx}/{total_files}] FINISHED processing: {filepath} in {elapsed:.2f} seconds.\n")
-    return all_functions
+            if name not in entries:
+                entries[name] = (name, file_id, offset, length, hashed, calls)
+    with telemetry.span("index.write", functions=len(entries)):
+        write_index(index_path, digest, files, list(entries.values()))
+    print(f"Indexed {len(entries)} function(s) in {time.time() - start_time:.2f} seconds.\n")
+    return FunctionIndex.open(index_path)
+
+def build_functions_dict(path, jobs=None):
+    """
+    Return a dictionary mapping every function name in `path` to a tuple:
+    (function source, filepath). This reads every function body; prefer
+    build_index() when only some of them are needed.
+    """
+    index = build_index(path, jobs)
+    functions = {}
+    for func_id in range(len(index)):
+        code = index.source(func_id)
+        if code is not None:
+            functions[index.name(func_id)] = (code, index.file(func_id))
+    return functions
 
 # -----------------------
 # Caching Helpers
 # -----------------------
 
-def get_cache_path(repo_path):
+# Per-file function tables live under CACHE_DIR, keyed by file content. Point
+# several checkouts at the same directory to share results between them.
+CACHE_DIR = os.environ.get("FUZZER_CACHE_DIR", ".cache")
+
+# Bump whenever extraction output changes, so older tables are never served.
+INDEX_VERSION = 3
+
+def git_file_blobs(path):
+    """
+    Return {normalized file path: git blob hash} for the files under `path` whose
+    working-tree content matches the git index. Files that are untracked, modified
+    or conflicted are left out, as is everything when `path` is not in a git repo.
+    """
+    blobs = {}
+    try:
+        output = subprocess.check_output(
+            ["git", "-C", path, "ls-files", "--stage", "-z"],
+            stderr=subprocess.DEVNULL
+        )
+        for entry in output.split(b"\0"):
+            if not entry:
+                continue
+            meta, rel = entry.split(b"\t", 1)
+            _mode, blob, stage = meta.split()
+            if stage == b"0":
+                blobs[os.path.normpath(os.path.join(path, os.fsdecode(rel)))] = blob.decode()
+        output = subprocess.check_output(
+            ["git", "-C", path, "ls-files", "--modified", "-z"],
+            stderr=subprocess.DEVNULL
+        )
+        for rel in output.split(b"\0"):
+            if rel:
+                blobs.pop(os.path.normpath(os.path.join(path, os.fsdecode(rel))), None)
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+    return blobs
+
+def get_file_keys(path, files):
+    """
+    Return {filepath: cache key} for the given files. Files that git knows to be
+    unchanged are keyed by their blob hash, which is shared by every worktree and
+    branch that has the same content. Everything else is keyed by its absolute
+    path, mtime and size, so any edit produces a new key.
+    """
+    base = path if os.path.isdir(path) else (os.path.dirname(path) or ".")
+    blobs = git_file_blobs(base)
+    keys = {}
+    for filepath in files:
+        blob = blobs.get(os.path.normpath(filepath))
+        if blob is not None:
+            keys[filepath] = f"blob-{blob}"
+            continue
+        try:
+            st = os.stat(filepath)
+            stamp = f"{os.path.abspath(filepath)}:{st.st_mtime_ns}:{st.st_size}"
+        except OSError:
+            stamp = f"{os.path.abspath(filepath)}:missing:{time.time()}"
+        keys[filepath] = "stat-" + hashlib.sha1(stamp.encode('utf-8')).hexdigest()
+    return keys
+
+def get_cache_path(file_key):
+    """
+    Compute the cache filename for one file's function table.
+    Cache files are stored in CACHE_DIR, fanned out by the first characters of the key.
+    """
+    digest = file_key.split("-", 1)[-1]
+    return os.path.join(CACHE_DIR, f"functions-v{INDEX_VERSION}", digest[:2], f"{file_key}.pkl")
+
+def get_index_path(repo_path):
     """
-    Compute a cache filename based on the repository path.
-    Cache file is stored in a .cache folder relative to the current directory.
+    Compute the filename of the function index for a repository path.
     """
-    cache_dir = ".cache"
-    if not os.path.exists(cache_dir):
-        os.makedirs(cache_dir)
+    os.makedirs(CACHE_DIR, exist_ok=True)
     repo_abs = os.path.abspath(repo_path)
     repo_hash = hashlib.md5(repo_abs.encode('utf-8')).hexdigest()
-    cache_filename = f"funcs_cache_{repo_hash}.pkl"
-    return os.path.join(cache_dir, cache_filename)
+    return os.path.join(CACHE_DIR, f"index_{repo_hash}.bin")
 
 def load_cache(cache_path):
-    """Load the cached function dictionary from the given path, if it exists."""
+    """Load cached data from the given path, or None if it is missing or unreadable."""
     if os.path.exists(cache_path):
         try:
             with open(cache_path, "rb") as f:
-                data = pickle.load(f)
-            print(f"Loaded cache from {cache_path}")
-            return data
+                return pickle.load(f)
         except Exception as e:
-            print(f"Failed to load cache: {e}")
+            print(f"Failed to load cache {cache_path}: {e}")
     return None
 
 def save_cache(cache_path, data):
-    """Save the function dictionary to the given cache path."""
+    """
+    Save data to the given cache path. The file is written under a temporary name
+    and renamed into place, so concurrent readers never see a partial file.
+    """
     try:
-        with open(cache_path, "wb") as f:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
             pickle.dump(data, f)
-        print(f"Saved cache to {cache_path}")
+        os.replace(tmp_path, cache_path)
     except Exception as e:
-        print(f"Failed to save cache: {e}")
+        print(f"Failed to save cache {cache_path}: {e}")
+
+def collect_neighbours(index, func_id, depth, direction, budget):
+    """
+    Breadth-first walk of the call graph from func_id, `depth` levels out along
+    `direction` (index.callees or index.callers). Returns a list of
+    (function id, level). Within a level smaller functions come first, and a
+    function is skipped once its size would exceed the remaining budget (bytes
+    of source, None for no limit). Each visited function costs O(degree).
+    """
+    seen = {func_id}
+    found = []
+    frontier = [func_id]
+    for level in range(1, depth + 1):
+        candidates = []
+        for current in frontier:
+            for neighbour in direction(current):
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    candidates.append((index.length(neighbour), neighbour))
+        frontier = []
+        for length, neighbour in sorted(candidates):
+            if budget is not None:
+                if length > budget:
+                    continue
+                budget -= length
+            found.append((neighbour, level))
+            frontier.append(neighbour)
+        if not frontier:
+            break
+    return found
+
+def tree_members(index, func_id, depth=1, caller_depth=0, budget=None):
+    """
+    The functions included with func_id in its code tree: (called, calling),
+    each a list of (function id, level) as returned by collect_neighbours.
+    """
+    called = collect_neighbours(index, func_id, depth, index.callees, budget)
+    remaining = None
+    if budget is not None:
+        remaining = budget - sum(index.length(called_id) for called_id, _ in called)
+    calling = collect_neighbours(index, func_id, caller_depth, index.callers, remaining)
+    return called, calling
+
+def tree_hash(index, func_id, called, calling):
+    """
+    Hash of a code tree: the function's content hash combined with the name,
+    content hash and level of every called and calling function included with
+    it. It changes exactly when the text sent for review would change.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for group in ([(func_id, 0)], called, calling):
+        for member_id, level in group:
+            name, _, _, _, hashed = index.entry(member_id)
+            h.update(name.encode('utf-8') + b"\0" + hashed + level.to_bytes(2, 'little'))
+        h.update(b"\1")
+    return h.hexdigest()
+
+def iter_tree_hashes(index, depth=1, caller_depth=0, budget=None):
+    """Yield (function id, tree hash) for every function in the index."""
+    for func_id in range(len(index)):
+        called, calling = tree_members(index, func_id, depth, caller_depth, budget)
+        yield func_id, tree_hash(index, func_id, called, calling)
+
+def build_specimen(index, func_id, depth=1, caller_depth=0, budget=None):
+    """
+    The code tree of one function as (tree hash, specimen dict), or None if its
+    file changed since it was indexed. See select_code_trees.
+    """
+    def describe(neighbours):
+        described = []
+        for member_id, level in neighbours:
+            code = index.source(member_id)
+            if code is None:
+                continue
+            described.append({
+                "functionName": index.name(member_id),
+                "source": code,
+                "file": index.file(member_id),
+                "depth": level
+            })
+        return described
+
+    code = index.source(func_id)
+    if code is None:
+        return None
+    called, calling = tree_members(index, func_id, depth, caller_depth, budget)
+    return tree_hash(index, func_id, called, calling), {
+        "functionName": index.name(func_id),
+        "source": code,
+        "file": index.file(func_id),
+        "calledFunctions": describe(called),
+        "callingFunctions": describe(calling)
+    }
+
+def select_code_trees(cnt, repo_path, jobs=None, depth=1, caller_depth=0, budget=None, skip_hashes=None,
+                      choose=None):
+    """
+    Like get_code_tree, but returns (tree hash, specimen) pairs. With
+    `skip_hashes` (a set of tree hashes, e.g. those already analyzed), only
+    functions whose current tree hash is not in it are candidates. cnt <= 0
+    takes all candidates. `choose(index, candidates, cnt)` returns the ids to
+    use (see scheduler.make_chooser); by default they are sampled uniformly.
+    """
+    index = build_index(repo_path, jobs)
+    if not len(index):
+        print("No functions with bodies were found.")
+        return []
+
+    if skip_hashes is not None:
+        candidates = [func_id for func_id, hashed in iter_tree_hashes(index, depth, caller_depth, budget)
+                      if hashed not in skip_hashes]
+        print(f"{len(candidates)} of {len(index)} code trees are new or changed since they were last analyzed")
+    else:
+        candidates = range(len(index))
+    if cnt <= 0:
+        cnt = len(candidates)
+    if choose is not None:
+        selected_ids = choose(index, candidates, min(cnt, len(candidates)))
+    elif cnt >= len(candidates):
+        selected_ids = candidates
+    else:
+        selected_ids = random.sample(candidates, cnt)
+    with telemetry.span("index.specimens", count=len(selected_ids)):
+        specimens = [build_specimen(index, func_id, depth, caller_depth, budget) for func_id in selected_ids]
+    return [specimen for specimen in specimens if specimen is not None]
 
-def get_code_tree(cnt, repo_path):
+def get_code_tree(cnt, repo_path, jobs=None, depth=1, caller_depth=0, budget=None):
     """
     Returns a list of 'cnt' specimens from the repository.
     
@@ -163,89 +582,58 @@ def get_code_tree(cnt, repo_path):
       - "functionName": the name of the function
       - "source": the full source code (including any immediately preceding comments)
       - "file": the file path where the function was found
-      - "calledFunctions": a list of dictionaries for each function that is called
-         within the function body (one level deep). Each sub-dictionary contains:
-             "functionName", "source", "file"
+      - "calledFunctions": a list of dictionaries for the functions it calls, up to
+         `depth` calls away. Each sub-dictionary contains:
+             "functionName", "source", "file", "depth"
+      - "callingFunctions": the same for the functions that call it, up to
+         `caller_depth` calls away (empty by default).
     
-    If repo_path is not provided, DEFAULT_REPO_PATH is used.
-    """
-    cache_path = get_cache_path(repo_path)
-    functions = load_cache(cache_path)
-    if functions is None:
-        print("Cache not found or failed to load; scanning repository...")
-        functions = build_functions_dict(repo_path)
-        save_cache(cache_path, functions)
-    else:
-        print(f"Using cached data with {len(functions)} functions.\n")
-    
-    if not functions:
-        print("No functions with bodies were found.")
-        return []
-    
-    # Helper to build a specimen dictionary from a function name.
-    def get_specimen(name):
-        code, filepath = functions[name]
-        calls = find_called_functions(code)
-        called_specimens = []
-        for call in calls:
-            if call in functions:
-                call_code, call_filepath = functions[call]
-                called_specimens.append({
-                    "functionName": call,
-                    "source": call_code,
-                    "file": call_filepath
-                })
-        return {
-            "functionName": name,
-            "source": code,
-            "file": filepath,
-            "calledFunctions": called_specimens
-        }
-    
-    keys = list(functions.keys())
-    if cnt >= len(keys):
-        selected_keys = keys
-    else:
-        selected_keys = random.sample(keys, cnt)
-    specimens = [get_specimen(name) for name in selected_keys]
-    return specimens
+    Neighbours come from the call graph stored in the index, nearest first. When
+    `budget` is set, the called and calling functions together are limited to
+    that many bytes of source, callees taking precedence.
+    `repo_path` is the directory (or single file) to index and sample from.
+    `jobs` is the number of processes used to index new or changed files.
+    """
+    return [specimen for _, specimen in select_code_trees(cnt, repo_path, jobs, depth, caller_depth, budget)]
 
 # -----------------------
 # Command-line Execution
 # -----------------------
 
-def main(path):
-    cache_path = get_cache_path(path)
-    functions = load_cache(cache_path)
-    if functions is None:
-        print("Cache not found or failed to load; scanning repository...")
-        functions = build_functions_dict(path)
-        save_cache(cache_path, functions)
-    else:
-        print(f"Using cached data with {len(functions)} functions.\n")
-        
-    if not functions:
+def main(path, jobs=None):
+    index = build_index(path, jobs)
+    if not len(index):
         print("No functions with bodies were found.")
         sys.exit(0)
 
-    print(f"\nTotal functions found: {len(functions)}\n")
-    parent_func = random.choice(list(functions.keys()))
-    parent_source, parent_file = functions[parent_func]
+    print(f"\nTotal functions found: {len(index)}\n")
+    parent_id = random.randrange(len(index))
+    parent_func, parent_file = index.name(parent_id), index.file(parent_id)
+    parent_source = index.source(parent_id)
+    if parent_source is None:
+        print(f"{parent_file} changed while reading it; please re-run.")
+        sys.exit(1)
     print(f"Selected function: {parent_func} (from {parent_file})\n")
     print("== Function Source ==")
     print(parent_source)
     print("\n== Invoked Functions (with extracted source, if available) ==")
     called = find_called_functions(parent_source)
     for cf in called:
-        if cf in functions:
-            src, fname = functions[cf]
-            print(f"\n--- {cf} (from {fname}) ---")
+        cf_id = index.lookup(cf)
+        src = index.source(cf_id) if cf_id is not None else None
+        if src is not None:
+            print(f"\n--- {cf} (from {index.file(cf_id)}) ---")
             print(src)
         else:
             print(f"\n--- {cf} (source not found) ---")
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print(f"Usage: {sys.argv[0]} <path_to_c_source_or_directory>")
-        sys.exit(1)
-    main(sys.argv[1])
+    parser = argparse.ArgumentParser(
+        description="Print a random function and the functions it calls"
+    )
+    parser.add_argument("path", help="Path to a C source file or directory")
+    parser.add_argument("--jobs", type=int, default=None, help="Number of indexing processes (default: one per CPU)")
+    parser.add_argument("--profile", type=str, default=None, help="Write cProfile data for indexing to this file (indexes in one process)")
+    args = parser.parse_args()
+    telemetry.profile_path = args.profile
+    main(args.path, args.jobs)
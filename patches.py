@@ -0,0 +1,241 @@
+"""
+Streaming access to a repository's commit patches.
+
+iter_commit_patches() runs a single `git log -p` for the whole selection and
+splits its output into per-commit patches while it is still being produced, so
+the first patch is available right away and only one patch is held at a time.
+"""
+import subprocess
+import time
+
+import telemetry
+
+# Each commit starts with NUL, its hash, NUL. Git never emits NUL in commit
+# messages or text diffs (files containing NUL are shown as binary), so the
+# split is unambiguous. The rest mimics `git format-patch --stdout`.
+PATCH_FORMAT = (
+    "%x00%H%x00"
+    "From %H Mon Sep 17 00:00:00 2001%n"
+    "From: %an <%ae>%n"
+    "Date: %aD%n"
+    "Subject: [PATCH] %s%n"
+    "%n"
+    "%b"
+)
+
+def log_command(repo_path, options, revisions=None, max_count=None, paths=None,
+                author=None, since=None, until=None):
+    """The `git log` command line selecting commits as iter_commit_patches() describes."""
+    cmd = ["git", "-C", repo_path, "log", "--no-color", "--no-merges", *options]
+    if max_count:
+        cmd.append(f"--max-count={max_count}")
+    if author:
+        cmd.append(f"--author={author}")
+    if since:
+        cmd.append(f"--since={since}")
+    if until:
+        cmd.append(f"--until={until}")
+    if isinstance(revisions, str):
+        revisions = [revisions]
+    cmd.extend(revisions or ["HEAD"])
+    cmd.append("--")
+    cmd.extend(paths or [])
+    return cmd
+
+def list_commits(repo_path=".", revisions=None, max_count=None, paths=None,
+                 author=None, since=None, until=None):
+    """Hashes of the commits iter_commit_patches() would yield, without reading their patches."""
+    cmd = log_command(repo_path, ["--format=%H"], revisions, max_count, paths, author, since, until)
+    try:
+        output = subprocess.check_output(cmd, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        print("Error listing commits:", e.stderr.decode("utf-8", errors="replace").strip())
+        return []
+    return output.decode("ascii").split()
+
+def iter_commit_patches(repo_path=".", revisions=None, max_count=None, paths=None,
+                        author=None, since=None, until=None, chunk_size=1 << 16):
+    """
+    Yield (commit hash, patch text) for commits in `revisions` (default HEAD),
+    newest first, like `git rev-list`. max_count limits the number of commits;
+    paths, author, since and until are passed to git log as filters. A commit
+    selected by `paths` still comes with its whole patch. Merge commits are
+    skipped since they have no patch of their own.
+    """
+    cmd = log_command(repo_path, ["-p", "--stat", "--full-diff", f"--format={PATCH_FORMAT}"],
+                      revisions, max_count, paths, author, since, until)
+
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        partial = []   # pieces of the field currently being read
+        fields = []    # complete fields: hash, text, hash, text, ...
+        leading = True
+        waited = time.perf_counter()  # git time between patches, not our consumer's
+        while True:
+            chunk = process.stdout.read1(chunk_size)
+            if not chunk:
+                break
+            pieces = chunk.split(b"\0")
+            partial.append(pieces[0])
+            for piece in pieces[1:]:
+                fields.append(b"".join(partial))
+                partial = [piece]
+            if leading and fields:
+                fields.pop(0)  # the empty field before the first commit
+                leading = False
+            while len(fields) >= 2:
+                telemetry.record("git.read_patch", time.perf_counter() - waited)
+                telemetry.count("git.patch_bytes", len(fields[1]))
+                yield decode_patch(fields[0], fields[1])
+                waited = time.perf_counter()
+                del fields[:2]
+        if len(fields) == 1:
+            telemetry.record("git.read_patch", time.perf_counter() - waited)
+            yield decode_patch(fields[0], b"".join(partial))
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.stderr.close()
+        if process.wait() not in (0, -9) and stderr:
+            print("Error reading commits:", stderr.decode("utf-8", errors="replace").strip())
+
+def get_commit_patch(repo_path, commit_hash):
+    """
+    Return (commit hash, patch text) for exactly the commit commit_hash, in the
+    same form iter_commit_patches() yields it. Raises ValueError if the commit
+    doesn't exist or is a merge, which has no patch of its own.
+    """
+    result = subprocess.run(["git", "-C", repo_path, "rev-list", "--no-walk", "--parents", commit_hash, "--"],
+                            capture_output=True, text=True)
+    if result.returncode != 0 or not result.stdout.strip():
+        raise ValueError(f"Commit {commit_hash} is not in {repo_path}")
+    commit, *parents = result.stdout.split()
+    if len(parents) > 1:
+        raise ValueError(f"Commit {commit_hash} is a merge and has no patch of its own")
+    cmd = ["git", "-C", repo_path, "log", "--no-color", "--no-walk", "-p", "--stat", "--full-diff",
+           f"--format={PATCH_FORMAT}", commit, "--"]
+    result = subprocess.run(cmd, capture_output=True, check=True)
+    _, hashed, text = result.stdout.split(b"\0", 2)
+    return decode_patch(hashed, text)
+
+def decode_patch(commit, text):
+    return commit.decode("ascii"), text.decode("utf-8", errors="replace").lstrip("\n")
+
+def split_patch(patch):
+    """
+    Split patch text into (header, files), where header is everything before
+    the first "diff --git" line and each file is (file header, [hunks]): the
+    diff/index/---/+++ lines, then the text of each "@@" hunk.
+    """
+    lines = patch.splitlines(keepends=True)
+    header = []
+    files = []
+    for line in lines:
+        if line.startswith("diff --git "):
+            files.append([[line], []])
+        elif not files:
+            header.append(line)
+        elif line.startswith("@@"):
+            files[-1][1].append([line])
+        elif files[-1][1]:
+            files[-1][1][-1].append(line)
+        else:
+            files[-1][0].append(line)
+    return "".join(header), [("".join(file_header), ["".join(hunk) for hunk in hunks])
+                             for file_header, hunks in files]
+
+def shard_patch(patch, max_chars=25000):
+    """
+    Split a patch that is longer than max_chars into shards of at most about
+    max_chars each, along file and then hunk boundaries. Every shard starts with
+    the commit header (message and diffstat, trimmed to a fifth of the budget),
+    and every piece of a file repeats that file's diff header, so each shard can
+    be reviewed on its own. A single hunk too large for a shard is cut at line
+    boundaries. Patches that already fit are returned as the only shard.
+    """
+    if len(patch) <= max_chars:
+        return [patch]
+    header, files = split_patch(patch)
+    header_budget = max_chars // 5
+    if len(header) > header_budget:
+        header = header[:header_budget].rsplit("\n", 1)[0] + "\n[... commit header truncated ...]\n"
+    budget = max(1, max_chars - len(header))
+
+    pieces = []
+    for file_header, hunks in files:
+        if len(file_header) + sum(len(hunk) for hunk in hunks) <= budget:
+            pieces.append(file_header + "".join(hunks))
+            continue
+        current = file_header
+        for hunk in hunks:
+            for part in _split_long(hunk, budget - len(file_header)):
+                if len(current) + len(part) > budget and current != file_header:
+                    pieces.append(current)
+                    current = file_header
+                current += part
+        if current != file_header or not hunks:
+            pieces.append(current)
+
+    shards = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + len(piece) > budget:
+            shards.append(header + current)
+            current = ""
+        current += piece
+    if current or not shards:
+        shards.append(header + current)
+    return shards
+
+def _split_long(text, limit):
+    """Cut text into parts of at most limit characters, at line boundaries where possible."""
+    limit = max(1, limit)
+    if len(text) <= limit:
+        return [text]
+    parts = []
+    current = ""
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        if len(current) + len(line) > limit:
+            parts.append(current)
+            current = ""
+        current += line
+    if current:
+        parts.append(current)
+    return parts
+
+def merge_issues(analyses):
+    """
+    Merge the issue arrays of several shard reviews into one, dropping repeats
+    (same type and description, ignoring case and whitespace) and keeping the
+    highest confidence and severity among them. Returns None if no shard
+    produced a parseable review.
+    """
+    if all(analysis is None for analysis in analyses):
+        return None
+    merged = {}
+    for analysis in analyses:
+        if not isinstance(analysis, list):
+            continue
+        for issue in analysis:
+            if not isinstance(issue, dict):
+                continue
+            key = (str(issue.get("type", "")).upper(),
+                   " ".join(str(issue.get("description", "")).lower().split()))
+            if key not in merged:
+                merged[key] = dict(issue)
+                continue
+            kept = merged[key]
+            for field in ("confidence", "severity"):
+                try:
+                    kept[field] = max(kept.get(field, 0), issue.get(field, 0))
+                except TypeError:
+                    pass
+    return list(merged.values())
@@ -0,0 +1,324 @@
+"""
+Prompt templates and prompt assembly.
+
+Each template is a fixed system message holding all of the instructions, plus a
+user message holding only the variable payload (a patch, a code tree...). The
+system message is byte-for-byte the same on every call, so it forms a shared
+prefix the API can cache, and the payload appears exactly once. Bump a
+template's version whenever its text changes meaning, so cached responses to
+the old prompt are not reused.
+
+render_tree() turns a specimen from pair.get_code_tree into compact plain text
+that fits a token budget: the function under review in full, then its called
+and calling functions, most relevant first. Neighbours that do not fit in full
+are cut down to their leading comment and signature, and if even that does not
+fit they are only listed by name. Token counts are estimated locally.
+"""
+import json
+import math
+import re
+
+# Token estimate: words cost about one token per five letters, digits come in
+# groups of up to three, every other symbol and each run of whitespace is one.
+TOKEN_REGEX = re.compile(r'[A-Za-z_]+|[0-9]{1,3}|\s+|[^\sA-Za-z0-9_]')
+
+# Default size of a rendered tree, leaving room for instructions and the answer.
+DEFAULT_TREE_TOKENS = 12000
+
+def estimate_tokens(text):
+    """Approximate number of tokens in text, without a tokenizer."""
+    count = 0
+    for match in TOKEN_REGEX.finditer(text):
+        token = match.group()
+        if token[0].isalpha() or token[0] == "_":
+            count += math.ceil(len(token) / 5)
+        else:
+            count += 1
+    return count
+
+def summarize_function(source):
+    """The leading comment and signature of a function: everything before its body."""
+    brace = source.find("{")
+    if brace == -1:
+        return source
+    return source[:brace].rstrip() + " { ... }"
+
+def truncate_to_tokens(text, budget):
+    """Cut text at a line boundary so it fits in about `budget` tokens."""
+    if estimate_tokens(text) <= budget:
+        return text
+    kept = []
+    used = 0
+    for line in text.splitlines(keepends=True):
+        cost = estimate_tokens(line)
+        if used + cost > budget:
+            break
+        kept.append(line)
+        used += cost
+    return "".join(kept) + "\n/* ... truncated ... */\n"
+
+def rank_neighbours(tree):
+    """
+    Called and calling functions of a tree, most relevant first: nearer ones,
+    then those the function under review mentions more often, then smaller
+    ones. Returns a list of (role, neighbour dict).
+    """
+    root = tree.get("source") or ""
+    ranked = []
+    for role, key in (("Calls", "calledFunctions"), ("Called by", "callingFunctions")):
+        for neighbour in tree.get(key) or []:
+            mentions = len(re.findall(r'\b' + re.escape(neighbour["functionName"]) + r'\s*\(', root))
+            ranked.append(((neighbour.get("depth", 1), role != "Calls", -mentions, len(neighbour.get("source") or "")),
+                           role, neighbour))
+    ranked.sort(key=lambda item: item[0])
+    return [(role, neighbour) for _, role, neighbour in ranked]
+
+def render_tree(tree, budget=DEFAULT_TREE_TOKENS):
+    """
+    Render a code tree as plain text of at most about `budget` tokens. Returns
+    (text, estimated tokens).
+    """
+    root_header = f"### Function under review: {tree['functionName']} ({tree['file']})\n"
+    root_source = tree.get("source") or ""
+    remaining = budget - estimate_tokens(root_header)
+    root_source = truncate_to_tokens(root_source, max(0, remaining))
+    parts = [root_header, root_source.rstrip("\n") + "\n"]
+    remaining -= estimate_tokens(root_source)
+
+    omitted = []
+    for role, neighbour in rank_neighbours(tree):
+        header = f"\n### {role}: {neighbour['functionName']} ({neighbour.get('file')}, depth {neighbour.get('depth', 1)})\n"
+        source = neighbour.get("source") or ""
+        for body in (source, summarize_function(source)):
+            cost = estimate_tokens(header) + estimate_tokens(body)
+            if cost <= remaining:
+                parts.append(header)
+                parts.append(body.rstrip("\n") + "\n")
+                remaining -= cost
+                break
+        else:
+            omitted.append(neighbour["functionName"])
+    if omitted:
+        # Name as many of the omitted functions as still fit, and count the rest.
+        line = "\n### Omitted for space:"
+        remaining -= estimate_tokens(line) + 8
+        for number, name in enumerate(omitted):
+            cost = estimate_tokens(name) + 1
+            if cost > remaining:
+                line += f" and {len(omitted) - number} more"
+                break
+            line += (", " if number else " ") + name
+            remaining -= cost
+        parts.append(line + "\n")
+    text = "".join(parts)
+    return text, estimate_tokens(text)
+
+
+ISSUE_FIELDS = """For each issue, provide the following:
+* description: a short to medium length paragraph explaining the issue.
+* type: a string set to one of the following values:
+{types}
+* confidence: on a scale of 0 to 10, how confident are you that this is a real
+  issue that the postgresql team would accept as worth fixing? Obviously it's
+  not worth flagging a bunch of issues with low confidence.
+* severity: on a scale of 0 to 10, how important is this issue? Many typos will
+  be a 0, but still worth calling out, and a zero-day vulnerability would be a
+  10. An example of something that usually isn't a bug is an apparent undefined
+  variable - usually it'll just be defined somewhere that's not part of the
+  code shown, and this would be caught by the compiler. In general, you don't
+  need to flag anything that the compiler would catch."""
+
+ISSUE_FORMAT = """Your response should have the following format:
+
+[
+    {{
+        "description": <text>,
+        "type": <one of {type_names}>,
+        "confidence": <0 to 10>,
+        "severity": <0 to 10>
+    }}, ...
+]
+
+Please output only JSON, with no other characters, so we can parse your
+output; the first character should be a [ and the last one should be a ].
+If there are no issues, don't try to manufacture one - just return an empty
+array."""
+
+def issue_type_lines(types):
+    """A bullet list of {name: meaning} issue types."""
+    return "\n".join(f"  * {name}: {meaning}" for name, meaning in types.items())
+
+def issue_instructions(types):
+    """The issue fields and response format, for {name: meaning} issue types."""
+    return (ISSUE_FIELDS.format(types=issue_type_lines(types)) + "\n\n"
+            + ISSUE_FORMAT.format(type_names="|".join(types)))
+
+REVIEW_TYPES = {
+    "BUG": "a functional error in the code that needs to be fixed",
+    "TYPO": "an error in a comment, etc",
+    "OTHER": "something else.",
+}
+
+REVIEW_SYSTEM = f"""You are an experienced PostgreSQL developer and security expert. The user
+will send a Git patch. Please review it for issues and return a JSON array
+describing them.
+
+{issue_instructions(REVIEW_TYPES)}
+
+Remember, you're describing unintended problems you find in the code, NOT the
+overall purpose of the patch."""
+
+CODE_TREE_TYPES = {
+    "BUG": "a functional error in the code that needs to be fixed",
+    "TYPO": "an error in a comment, etc",
+    "PERFORMANCE": "a performance problem.",
+}
+
+CODE_TREE_GUIDANCE = """A hypothetical coding flaw, like needing to check for a null pointer, etc,
+usually is not a big deal in practice, since we can assume that such an issue
+would probably have manifested by now. I don't really care about most code
+quality issues. Don't worry about apparent naming inconsistencies.
+
+ONLY REPORT ISSUES THAT YOU ARE *VERY* CONFIDENT ABOUT.
+THE VAST MAJORITY OF THE TIME, THERE WILL BE NO ISSUES.
+
+DO NOT REPORT ANY APPARENT COMPILE ERRORS - ASSUME POSTGRES HAS SOME PARTICULAR
+DEFINITIONS ETC OR OTHER, NON-INCLUDED CODE THAT WOULD FIX IT. THERE ARE
+DEFINITELY NO COMPILE ERRORS."""
+
+CODE_TREE_SYSTEM = f"""You are an experienced PostgreSQL developer. The user will send the source code
+of a postgres function, together with the source code (if available) of the
+functions it calls and of some that call it. Less relevant functions may be cut
+down to their signatures or only named. Please review the function under review
+for issues and return a JSON array describing them.
+
+{issue_instructions(CODE_TREE_TYPES)}
+
+{CODE_TREE_GUIDANCE}"""
+
+CODE_TREE_BATCH_SYSTEM = f"""You are an experienced PostgreSQL developer. The user will send several
+postgres functions, each under a "## Function <id>" heading (F1, F2, ...),
+together with the source code (if available) of the functions it calls and of
+some that call it. Less relevant functions may be cut down to their signatures
+or only named. Please review each function under review for issues, separately.
+
+Return a JSON object with one key per function id, every id included, whose
+value is the JSON array of issues for that function (empty if there are none):
+
+{{"F1": [...], "F2": [], ...}}
+
+{ISSUE_FIELDS.format(types=issue_type_lines(CODE_TREE_TYPES))}
+
+Each issue has the format:
+
+{{
+    "description": <text>,
+    "type": <one of BUG|TYPO|PERFORMANCE>,
+    "confidence": <0 to 10>,
+    "severity": <0 to 10>
+}}
+
+Please output only the JSON object, with no other characters, so we can parse
+your output; the first character should be a {{ and the last one should be a }}.
+Don't try to manufacture issues - most functions will have none.
+
+{CODE_TREE_GUIDANCE}"""
+
+REPRODUCE_SYSTEM = """You are an experienced PostgreSQL developer and security expert. The user will
+send a patch, followed by the issues another expert found when reviewing it.
+
+Please carefully evaluate if those issues seem correct. Also, if there is an
+issue, please provide a clear reproduction case if possible, for example a SQL
+script that demonstrates the problem, explaining the result you think the
+script would have and the result it should actually have.
+
+If possible, also propose a code change that would fix the issue, although it
+doesn't need to be completely rigorous."""
+
+REPAIR_SYSTEM = """The user will send a reply that was supposed to be JSON but could not be
+parsed: it is either an array of issues, each an object with "description",
+"type", "confidence" and "severity", or an object mapping function ids (F1,
+F2, ...) to such arrays. Output the same content as valid JSON of that shape,
+with no other characters. Do not add, drop or change any issue. If the reply
+holds no issues at all, output []."""
+
+# "types" are the issue types a template's replies may use; templates with
+# types get a JSON schema for structured output (see response_format).
+TEMPLATES = {
+    "review": {"version": 2, "system": REVIEW_SYSTEM, "types": REVIEW_TYPES},
+    "code_tree": {"version": 3, "system": CODE_TREE_SYSTEM, "types": CODE_TREE_TYPES},
+    "reproduce": {"version": 2, "system": REPRODUCE_SYSTEM},
+    "code_tree_batch": {"version": 1, "system": CODE_TREE_BATCH_SYSTEM, "types": CODE_TREE_TYPES},
+    "repair": {"version": 1, "system": REPAIR_SYSTEM},
+}
+
+def build_messages(template, payload):
+    """The messages for one call: the template's static system message, then the payload."""
+    return [
+        {"role": "system", "content": TEMPLATES[template]["system"]},
+        {"role": "user", "content": payload},
+    ]
+
+def review_payload(diff):
+    return "Git patch:\n\n" + diff
+
+def code_tree_payload(tree, budget=DEFAULT_TREE_TOKENS):
+    rendered, _ = render_tree(tree, budget)
+    return rendered
+
+def reproduce_payload(diff, issues):
+    return "Patch:\n\n" + diff + "\n\nProposed issues:\n\n" + json.dumps(issues, indent=2)
+
+def batch_id(position):
+    """Id of the tree at `position` in a batch: F1, F2, ..."""
+    return f"F{position + 1}"
+
+def code_tree_batch_payload(trees, budget=DEFAULT_TREE_TOKENS):
+    """Several code trees for one request, each rendered within `budget` under its batch id."""
+    return "\n\n".join(f"## Function {batch_id(position)}\n\n" + render_tree(tree, budget)[0]
+                         for position, tree in enumerate(trees))
+
+def issues_schema(types):
+    """JSON schema of an issue array whose types are the keys of `types`."""
+    return {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {
+                "description": {"type": "string"},
+                "type": {"type": "string", "enum": list(types)},
+                "confidence": {"type": "integer"},
+                "severity": {"type": "integer"},
+            },
+            "required": ["description", "type", "confidence", "severity"],
+            "additionalProperties": False,
+        },
+    }
+
+def response_format(template, count=None):
+    """
+    The structured output response_format for a template, or None if its
+    replies are free text. Schemas must have an object at the top, so a
+    single review's issues come back as {"issues": [...]}; a batch of
+    `count` trees as {"F1": [...], ...}.
+    """
+    types = TEMPLATES[template].get("types")
+    if types is None:
+        return None
+    if count is None:
+        properties = {"issues": issues_schema(types)}
+    else:
+        properties = {batch_id(position): issues_schema(types) for position in range(count)}
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": template,
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": properties,
+                "required": list(properties),
+                "additionalProperties": False,
+            },
+        },
+    }
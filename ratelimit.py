@@ -0,0 +1,119 @@
+"""
+Rate limiting for the async LLM client.
+
+TokenBucket enforces a per-minute budget (requests or tokens). AdaptiveLimiter
+caps the number of requests in flight and moves that cap with what the API
+tells us: it grows while calls succeed at a steady latency, and halves when we
+are rate limited or the server errors out (AIMD, as in TCP congestion control).
+"""
+import asyncio
+import random
+import time
+
+class TokenBucket:
+    """
+    A bucket of `per_minute` units that refills continuously. acquire(n) waits
+    until n units are available and takes them; refund(n) gives units back when
+    a reservation turned out to be too large. per_minute=None disables the limit.
+    """
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.per_minute / 60.0)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        if self.per_minute is None:
+            return
+        # A single request larger than the whole budget can still go once the bucket is full.
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.level >= amount:
+                    self.level -= amount
+                    return
+                await asyncio.sleep((amount - self.level) * 60.0 / self.per_minute)
+
+    def refund(self, amount):
+        if self.per_minute is None:
+            return
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+    def drain(self, seconds):
+        """Empty the bucket and keep it empty for `seconds`, e.g. after a Retry-After."""
+        if self.per_minute is None:
+            return
+        self.level = -seconds * self.per_minute / 60.0
+        self.updated = time.monotonic()
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit that adapts to the observed latency and errors.
+
+    Every success adds 1/limit to the limit (about +1 per round trip of the
+    whole window), unless latency has grown to more than `latency_slack` times
+    the best seen, which means requests are queueing somewhere. Every throttle
+    or server error halves it.
+    """
+
+    def __init__(self, initial=8, minimum=1, maximum=64, latency_slack=2.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_slack = latency_slack
+        self.in_flight = 0
+        self.best_latency = None
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self, latency):
+        if self.best_latency is None or latency < self.best_latency:
+            self.best_latency = latency
+        if latency <= self.best_latency * self.latency_slack:
+            self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+    def on_throttle(self):
+        self.limit = max(self.minimum, self.limit / 2)
+
+def backoff_delay(attempt, retry_after=None, base=1.0, cap=60.0):
+    """
+    Seconds to wait before retry number `attempt` (starting at 1). The server's
+    Retry-After wins when given; otherwise exponential backoff with full jitter.
+    """
+    if retry_after is not None:
+        return min(cap, retry_after)
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+def parse_retry_after(headers):
+    """Read retry-after-ms / retry-after (seconds) from response headers, or None."""
+    if headers is None:
+        return None
+    try:
+        value = headers.get("retry-after-ms")
+        if value is not None:
+            return float(value) / 1000.0
+        value = headers.get("retry-after")
+        if value is not None:
+            return float(value)
+    except (TypeError, ValueError):
+        pass
+    return None
@@ -0,0 +1,111 @@
+"""
+Turning model replies into issue lists.
+
+Replies are supposed to be bare JSON, but a paid-for answer should not be thrown
+away over a markdown fence, a sentence before the array or a trailing comma.
+salvage_json() finds the JSON value in such text; normalize_issues() and
+normalize_batch() check its shape and clean up the fields.
+"""
+import json
+import re
+
+FENCE_REGEX = re.compile(r'```(?:json|JSON)?[ \t]*\n?(.*?)```', re.DOTALL)
+TRAILING_COMMA_REGEX = re.compile(r',(\s*[\]}])')
+
+# Give up on finding a JSON value after trying this many opening brackets.
+MAX_CANDIDATES = 64
+
+def iter_json_values(text):
+    """
+    JSON arrays and objects found in text, most likely first: inside ```
+    fences, then anywhere, each starting at the earliest bracket; then the
+    same again with trailing commas removed.
+    """
+    if text is None:
+        return
+    candidates = [match.group(1) for match in FENCE_REGEX.finditer(text)] + [text]
+    decoder = json.JSONDecoder()
+    for candidate in candidates:
+        for attempt in (candidate, TRAILING_COMMA_REGEX.sub(r'\1', candidate)):
+            for tried, match in enumerate(re.finditer(r'[\[{]', attempt)):
+                if tried >= MAX_CANDIDATES:
+                    break
+                try:
+                    value, _ = decoder.raw_decode(attempt, match.start())
+                except ValueError:
+                    continue
+                yield value
+
+def salvage_json(text):
+    """
+    The first JSON array or object in text: inside a ``` fence if there is
+    one, otherwise wherever it starts. Trailing commas are tolerated. Raises
+    ValueError if there is none.
+    """
+    for value in iter_json_values(text):
+        return value
+    raise ValueError("no JSON value found in reply")
+
+def _score(value):
+    """A confidence/severity as a number from 0 to 10, or None."""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    number = min(10.0, max(0.0, number))
+    return int(number) if number.is_integer() else number
+
+def normalize_issues(value):
+    """
+    An issue array from a parsed reply (a bare array, or an object holding it
+    under "issues" as structured output returns it), keeping only issues with
+    a description. A confidence or severity that is missing or not a number
+    becomes 0. None if the value has the wrong shape.
+    """
+    if isinstance(value, dict) and isinstance(value.get("issues"), list):
+        value = value["issues"]
+    if not isinstance(value, list):
+        return None
+    issues = []
+    for issue in value:
+        if not isinstance(issue, dict) or not isinstance(issue.get("description"), str):
+            continue
+        issue = dict(issue)
+        issue["type"] = str(issue.get("type", "OTHER")).upper()
+        for field in ("confidence", "severity"):
+            issue[field] = _score(issue.get(field))
+            if issue[field] is None:
+                issue[field] = 0
+        issues.append(issue)
+    return issues
+
+def normalize_batch(value, ids):
+    """
+    {id: issue array} from a parsed batched reply, for the expected ids; ids
+    whose entry is missing or malformed map to None. None if value is not an
+    object at all.
+    """
+    if not isinstance(value, dict):
+        return None
+    return {batch_id: normalize_issues(value.get(batch_id)) if batch_id in value else None
+            for batch_id in ids}
+
+def parse_reply(text, normalize):
+    """
+    Parse a reply with `normalize`. Returns (value, outcome): outcome is
+    "parsed" if the text was clean JSON, "salvaged" if the JSON had to be dug
+    out of it, or "failed" (value None).
+    """
+    if text is None:
+        return None, "failed"
+    try:
+        value = normalize(json.loads(text))
+        if value is not None:
+            return value, "parsed"
+    except ValueError:
+        pass
+    for value in iter_json_values(text):
+        value = normalize(value)
+        if value is not None:
+            return value, "salvaged"
+    return None, "failed"
@@ -0,0 +1,465 @@
+#!/usr/bin/env python3
+"""
+Append-only store for review results, kept in one SQLite database (WAL mode,
+or the journal mode in $FUZZER_SQLITE_JOURNAL).
+
+Every reviewed commit and analyzed code tree becomes one row in `results`, tagged
+with the run that produced it, its key (commit hash or function name), a hash of
+the reviewed content and the model. Each reported issue becomes a row in
+`issues`, so results can be filtered on type/confidence/severity without parsing
+anything. The `analyzed` ledger holds the hash of every tree that was analyzed
+successfully, issues or not, so unchanged code need not be reviewed again.
+`clusters` groups near-duplicate issues (see cluster.py).
+Writes go through a background thread that commits in batches.
+
+    python results.py list --min-confidence 7 --type BUG
+    python results.py export out/        # one JSON file per item, as before
+    python results.py browser browse/    # index + shards for tree_browser.html
+"""
+import argparse
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+import telemetry
+
+DEFAULT_PATH = os.path.join("out", "results.sqlite3")
+
+# WAL relies on shared memory, so every process using a database must be on
+# one host. Databases on a network filesystem (NFS, SMB) that several machines
+# write need the rollback journal: FUZZER_SQLITE_JOURNAL=DELETE, set for every
+# process that opens them.
+JOURNAL_MODE = os.environ.get("FUZZER_SQLITE_JOURNAL", "WAL").upper()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    model TEXT,
+    args TEXT,
+    started_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    run_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    file TEXT,
+    content_hash TEXT,
+    model TEXT,
+    created_at REAL NOT NULL,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_key ON results (kind, key);
+CREATE INDEX IF NOT EXISTS results_run ON results (run_id);
+CREATE INDEX IF NOT EXISTS results_content_hash ON results (content_hash);
+CREATE TABLE IF NOT EXISTS issues (
+    id INTEGER PRIMARY KEY,
+    result_id INTEGER NOT NULL REFERENCES results (id),
+    type TEXT,
+    confidence REAL,
+    severity REAL,
+    description TEXT
+);
+CREATE INDEX IF NOT EXISTS issues_result ON issues (result_id);
+CREATE INDEX IF NOT EXISTS issues_confidence ON issues (confidence);
+CREATE INDEX IF NOT EXISTS issues_severity ON issues (severity);
+CREATE TABLE IF NOT EXISTS analyzed (
+    kind TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    key TEXT NOT NULL,
+    run_id TEXT,
+    model TEXT,
+    analyzed_at REAL NOT NULL,
+    PRIMARY KEY (kind, content_hash)
+);
+CREATE INDEX IF NOT EXISTS analyzed_key ON analyzed (kind, key);
+CREATE TABLE IF NOT EXISTS clusters (
+    issue_id INTEGER PRIMARY KEY REFERENCES issues (id),
+    cluster_id INTEGER NOT NULL,
+    signature BLOB
+);
+CREATE INDEX IF NOT EXISTS clusters_cluster ON clusters (cluster_id);
+"""
+
+def connect(path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+    conn.execute(f"PRAGMA journal_mode={JOURNAL_MODE}")
+    conn.execute("PRAGMA synchronous=NORMAL" if JOURNAL_MODE == "WAL" else "PRAGMA synchronous=FULL")
+    conn.executescript(SCHEMA)
+    return conn
+
+def new_run_id():
+    return time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:6]
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+class ResultStore:
+    """
+    Results database. add() may be called from any thread; rows are queued and
+    written by one background thread in batches of up to `batch_size`, or every
+    `flush_interval` seconds. Several processes can write to the same file.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, batch_size=100, flush_interval=0.5):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._conn = connect(path)
+        self._queue = queue.Queue()
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def start_run(self, kind, model=None, args=None):
+        run_id = new_run_id()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO runs (run_id, kind, model, args, started_at) VALUES (?, ?, ?, ?, ?)",
+                (run_id, kind, model, json.dumps(args) if args is not None else None, time.time())
+            )
+        return run_id
+
+    def add(self, run_id, kind, key, record, analysis, file=None, content_hash=None, model=None, unique=False):
+        """
+        Queue one result. `record` is the full JSON-able result (as in the old
+        out/<key>.json files); `analysis` its issue array, or None. With
+        unique=True the result is dropped if the run already has one for this
+        kind and key, so a job that is done twice is stored once.
+        """
+        self._put(("result", run_id, kind, key, file, content_hash, model, time.time(), record, analysis, unique))
+
+    def mark_analyzed(self, run_id, kind, key, content_hash, model=None):
+        """Queue a ledger entry: the content with this hash has been analyzed."""
+        self._put(("analyzed", run_id, kind, key, content_hash, model, time.time()))
+
+    def _put(self, item):
+        # Each writer has its own queue, so a flush() racing add()s from other
+        # threads stops the writer it took, not the one those add()s start.
+        with self._lock:
+            if self._writer is None:
+                self._queue = queue.Queue()
+                self._writer = threading.Thread(target=self._write_loop, args=(self._queue,), daemon=True)
+                self._writer.start()
+            self._queue.put(item)
+
+    def _write_loop(self, items):
+        while True:
+            item = items.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    item = items.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._write_batch(batch)
+            if stop:
+                return
+
+    def _write_batch(self, batch):
+        with telemetry.span("results.write", items=len(batch)), self._lock, self._conn:
+            # Take the write lock up front, so checks for existing results
+            # can't race another process writing the same ones.
+            self._conn.execute("BEGIN IMMEDIATE")
+            for item in batch:
+                if item[0] == "analyzed":
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO analyzed (run_id, kind, key, content_hash, model, analyzed_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?)", item[1:]
+                    )
+                    continue
+                _, run_id, kind, key, file, content_hash, model, created_at, record, analysis, unique = item
+                if unique and self._conn.execute("SELECT 1 FROM results WHERE run_id = ? AND kind = ? AND key = ?",
+                                                 (run_id, kind, key)).fetchone():
+                    continue
+                cursor = self._conn.execute(
+                    "INSERT INTO results (run_id, kind, key, file, content_hash, model, created_at, record) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (run_id, kind, key, file, content_hash, model, created_at, json.dumps(record))
+                )
+                issues = [issue for issue in (analysis or []) if isinstance(issue, dict)]
+                self._conn.executemany(
+                    "INSERT INTO issues (result_id, type, confidence, severity, description) VALUES (?, ?, ?, ?, ?)",
+                    [(cursor.lastrowid, issue.get("type"), _number(issue.get("confidence")),
+                      _number(issue.get("severity")), issue.get("description")) for issue in issues]
+                )
+
+    def flush(self):
+        """Write everything queued so far and stop the writer (it restarts on the next add)."""
+        with self._lock:
+            writer, self._writer = self._writer, None
+            if writer is not None:
+                self._queue.put(None)
+        if writer is not None:
+            writer.join()
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+    def analyzed_hashes(self, kind):
+        """Hashes of everything of this kind that has been analyzed, as a set."""
+        with self._lock:
+            return {row[0] for row in self._conn.execute("SELECT content_hash FROM analyzed WHERE kind = ?", (kind,))}
+
+    def analyzed_keys(self, kind):
+        """Keys (function names, commits) that have been analyzed at some version, as a set."""
+        with self._lock:
+            return {row[0] for row in self._conn.execute("SELECT DISTINCT key FROM analyzed WHERE kind = ?", (kind,))}
+
+    def issues(self):
+        """Yield every stored issue as a dict (id, result_id, kind, key, type, confidence, severity, description)."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT i.id, i.result_id, r.kind, r.key, i.type, i.confidence, i.severity, i.description "
+                "FROM issues i JOIN results r ON r.id = i.result_id ORDER BY i.id"
+            ).fetchall()
+        for row in rows:
+            yield {"id": row[0], "result_id": row[1], "kind": row[2], "key": row[3], "type": row[4],
+                   "confidence": row[5], "severity": row[6], "description": row[7]}
+
+    def confidence_by_file(self, kind):
+        """Sum of issue confidences per file over every stored result of kind, as {file: total}."""
+        with self._lock:
+            return dict(self._conn.execute(
+                "SELECT r.file, SUM(i.confidence) FROM issues i JOIN results r ON r.id = i.result_id "
+                "WHERE r.kind = ? AND r.file IS NOT NULL AND r.file != '' GROUP BY r.file", (kind,)
+            ).fetchall())
+
+    def save_clusters(self, rows):
+        """Replace the stored clusters with (issue id, cluster id, signature) rows."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM clusters")
+            self._conn.executemany("INSERT INTO clusters (issue_id, cluster_id, signature) VALUES (?, ?, ?)", rows)
+
+    def cluster_signatures(self):
+        """(issue id, cluster id, signature) for every clustered issue."""
+        with self._lock:
+            return self._conn.execute("SELECT issue_id, cluster_id, signature FROM clusters").fetchall()
+
+    def result_clusters(self):
+        """{result id: [cluster id or None per issue, in issue order]}."""
+        clusters = {}
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT i.result_id, c.cluster_id FROM issues i LEFT JOIN clusters c ON c.issue_id = i.id ORDER BY i.id"
+            ).fetchall()
+        for result_id, cluster_id in rows:
+            clusters.setdefault(result_id, []).append(cluster_id)
+        return clusters
+
+    def canonical_results(self):
+        """{cluster id: id of the result holding the cluster's canonical issue}."""
+        with self._lock:
+            return dict(self._conn.execute(
+                "SELECT id, result_id FROM issues WHERE id IN (SELECT DISTINCT cluster_id FROM clusters)"
+            ).fetchall())
+
+    def query(self, kind=None, key=None, run_id=None, min_confidence=None, min_severity=None,
+              issue_type=None, with_issues=True, latest=False):
+        """
+        Yield stored results as dicts (id, run_id, kind, key, file, content_hash,
+        model, created_at, record). Issue filters keep results with at least one
+        issue matching all of them, as the tree browser does; with_issues=False
+        also returns results without any issue. latest=True keeps only the most
+        recent result per (kind, key), of run_id's results if it is given.
+        """
+        where = []
+        params = []
+        for column, value in (("r.kind", kind), ("r.key", key), ("r.run_id", run_id)):
+            if value is not None:
+                where.append(f"{column} = ?")
+                params.append(value)
+        issue_where = []
+        if min_confidence is not None:
+            issue_where.append("i.confidence >= ?")
+            params.append(min_confidence)
+        if min_severity is not None:
+            issue_where.append("i.severity >= ?")
+            params.append(min_severity)
+        if issue_type is not None:
+            issue_where.append("UPPER(i.type) LIKE ?")
+            params.append(f"%{issue_type.upper()}%")
+        if issue_where or with_issues:
+            where.append("EXISTS (SELECT 1 FROM issues i WHERE i.result_id = r.id"
+                         + "".join(f" AND {clause}" for clause in issue_where) + ")")
+        if latest:
+            # Latest within the selected run, when there is one.
+            same_run = " AND run_id = r.run_id" if run_id is not None else ""
+            where.append(f"r.id = (SELECT MAX(id) FROM results WHERE kind = r.kind AND key = r.key{same_run})")
+        sql = "SELECT r.id, r.run_id, r.kind, r.key, r.file, r.content_hash, r.model, r.created_at, r.record FROM results r"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY r.id"
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        for row in rows:
+            yield {
+                "id": row[0], "run_id": row[1], "kind": row[2], "key": row[3], "file": row[4],
+                "content_hash": row[5], "model": row[6], "created_at": row[7], "record": json.loads(row[8]),
+            }
+
+def export_json(store, out_dir, **filters):
+    """
+    Write the latest result per item as out_dir/<key>.json, in the layout
+    review.py used to write directly. Returns the number of files written.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    written = 0
+    for result in store.query(latest=True, **filters):
+        with open(os.path.join(out_dir, f"{result['key']}.json"), 'w') as f:
+            json.dump(result["record"], f, indent=4)
+        written += 1
+    return written
+
+class _ShardWriter:
+    """Collects JSON objects into dir/<prefix>-NNNNN.json files of about max_bytes each."""
+
+    def __init__(self, directory, prefix, max_bytes):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.number = 0
+        self.size = 0
+        self.entries = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def add(self, key, value):
+        """Add one entry and return the number of the shard it went into."""
+        encoded = json.dumps(value, separators=(",", ":"))
+        if self.entries and self.size + len(encoded) > self.max_bytes:
+            self.close()
+        self.entries[key] = encoded
+        self.size += len(encoded) + len(key) + 4
+        return self.number
+
+    def close(self):
+        if not self.entries:
+            return
+        path = os.path.join(self.directory, f"{self.prefix}-{self.number:05d}.json")
+        with open(path, 'w') as f:
+            f.write("{" + ",".join(f"{json.dumps(key)}:{value}" for key, value in self.entries.items()) + "}")
+        self.number += 1
+        self.size = 0
+        self.entries = {}
+
+def export_browser(store, out_dir, shard_bytes=1 << 19, **filters):
+    """
+    Write the latest code tree results in the layout tree_browser.html loads
+    lazily: out_dir/index.json holds one small record per item (function, file,
+    and each issue's type/confidence/severity), items/ holds the analyses and
+    root sources, and sources/ the called/calling functions' sources, each
+    stored once however many trees include it. If the issues have been
+    clustered (cluster.py), each issue also carries its cluster id, and
+    "clusters" maps each cluster to its size and the item holding its
+    canonical issue (or its first item), so the browser can collapse
+    duplicates. Returns the number of items.
+    """
+    items = _ShardWriter(os.path.join(out_dir, "items"), "items", shard_bytes)
+    sources = _ShardWriter(os.path.join(out_dir, "sources"), "sources", shard_bytes * 2)
+    source_shards = {}
+    index = []
+    result_clusters = store.result_clusters()
+    canonical_results = store.canonical_results()
+    clusters = {}
+    for result in store.query(kind="tree", latest=True, **filters):
+        record = result["record"]
+        tree = record["tree"]
+        analysis = record.get("analysis") or []
+        neighbours = {}
+        for group in ("calledFunctions", "callingFunctions"):
+            neighbours[group] = []
+            for fn in tree.get(group) or []:
+                source = fn.get("source") or ""
+                source_key = hashlib.sha1(source.encode("utf-8", errors="replace")).hexdigest()[:16]
+                if source_key not in source_shards:
+                    source_shards[source_key] = sources.add(source_key, source)
+                neighbours[group].append({"functionName": fn["functionName"], "file": fn.get("file"),
+                                          "depth": fn.get("depth"), "source": [source_shards[source_key], source_key]})
+        item_id = str(len(index))
+        shard = items.add(item_id, {
+            "analysis": analysis,
+            "tree": {"functionName": tree["functionName"], "file": tree["file"], "source": tree["source"], **neighbours},
+        })
+        issue_clusters = result_clusters.get(result["id"], [])
+        issues = [[issue.get("type"), issue.get("confidence"), issue.get("severity")]
+                  for issue in analysis if isinstance(issue, dict)]
+        for position, cluster_id in enumerate(issue_clusters[:len(issues)]):
+            if cluster_id is None:
+                continue
+            issues[position].append(cluster_id)
+            cluster = clusters.setdefault(cluster_id, {"size": 0, "item": len(index)})
+            cluster["size"] += 1
+            if canonical_results.get(cluster_id) == result["id"]:
+                cluster["item"] = len(index)
+        index.append({
+            "function": tree["functionName"],
+            "file": tree["file"],
+            "shard": shard,
+            "issues": issues,
+        })
+    items.close()
+    sources.close()
+    exported = {"version": 1, "items": index}
+    if clusters:
+        exported["clusters"] = {str(cluster_id): cluster for cluster_id, cluster in clusters.items()}
+    with open(os.path.join(out_dir, "index.json"), 'w') as f:
+        json.dump(exported, f, separators=(",", ":"))
+    return len(index)
+
+def main():
+    parser = argparse.ArgumentParser(description="Query and export stored review results")
+    parser.add_argument("--results", type=str, default=DEFAULT_PATH, help=f"Results database (default: {DEFAULT_PATH})")
+    sub = parser.add_subparsers(dest="command", required=True)
+    list_cmd = sub.add_parser("list", help="List results with matching issues")
+    export_cmd = sub.add_parser("export", help="Write the latest result per item as <dir>/<key>.json")
+    export_cmd.add_argument("out_dir", help="Directory to write into")
+    browser_cmd = sub.add_parser("browser", help="Write code tree results for tree_browser.html (index.json plus shards)")
+    browser_cmd.add_argument("out_dir", help="Directory to write into")
+    for cmd in (list_cmd, export_cmd):
+        cmd.add_argument("--kind", choices=["commit", "tree"], default=None, help="Only commit reviews or code trees")
+    for cmd in (list_cmd, export_cmd, browser_cmd):
+        cmd.add_argument("--run", type=str, default=None, help="Only results from this run id")
+        cmd.add_argument("--min-confidence", type=float, default=None, help="Minimum issue confidence")
+        cmd.add_argument("--min-severity", type=float, default=None, help="Minimum issue severity")
+        cmd.add_argument("--type", type=str, default=None, help="Issue type, e.g. BUG")
+        cmd.add_argument("--all", action="store_true", help="Include results without issues")
+    args = parser.parse_args()
+
+    store = ResultStore(args.results)
+    filters = {"run_id": args.run, "min_confidence": args.min_confidence,
+               "min_severity": args.min_severity, "issue_type": args.type, "with_issues": not args.all}
+    if args.command == "list":
+        for result in store.query(kind=args.kind, **filters):
+            analysis = result["record"].get("analysis") or []
+            print(f"{result['run_id']}  {result['kind']:6}  {result['key']}  ({len(analysis)} issue(s))")
+            for issue in analysis:
+                print(f"    [{issue.get('type')} c={issue.get('confidence')} s={issue.get('severity')}] "
+                      f"{issue.get('description')}")
+    elif args.command == "export":
+        written = export_json(store, args.out_dir, kind=args.kind, **filters)
+        print(f"Wrote {written} file(s) to {args.out_dir}")
+    elif args.command == "browser":
+        written = export_browser(store, args.out_dir, **filters)
+        print(f"Wrote {written} item(s) to {args.out_dir}; open tree_browser.html and select that folder")
+    store.close()
+
+if __name__ == "__main__":
+    main()
@@ -1,43 +1,62 @@
 #!/usr/bin/env python3
+"""
+Looking for issues in a codebase, one subcommand per job:
+
+    python review.py index                    # build or refresh the function index
+    python review.py sample 20                # show the code trees `tree 20` would analyze
+    python review.py tree 100                 # analyze 100 code trees
+    python review.py review 50                # review (and reproduce) the last 50 commits
+    python review.py reproduce <commit>
+    python review.py worker campaign.sqlite3  # work on a queue seeded by tree/review --queue
+    python review.py coverage
+    python review.py export out/              # write stored results as <key>.json files
+
+llm, and through it openai, is only imported by the commands that call the
+API, and the client is only created for the first call, so index, sample,
+coverage and export start quickly and work offline, without an API key.
+`python bench.py startup` measures how long they take to start.
+"""
 import argparse
-import subprocess
+import hashlib
+import time
 import json
 import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-from worker import run_jobs
-from llm import review, reproduce, code_tree
-from pair import get_code_tree
+import telemetry
+from pair import build_index, build_specimen, get_index_path, iter_tree_hashes, select_code_trees
+from prompts import DEFAULT_TREE_TOKENS, render_tree
+from patches import get_commit_patch, iter_commit_patches, list_commits, merge_issues, shard_patch
+from scheduler import STRATEGIES, make_chooser, parse_weights
+from results import ResultStore, export_browser, export_json, DEFAULT_PATH as DEFAULT_RESULTS_PATH
+from workqueue import DEFAULT_LEASE, WorkQueue, worker_name
 
-def get_last_commit_hashes(n, repo_path):
-    """
-    Get the last n commit hashes from the specified repository.
-    """
-    try:
-        output = subprocess.check_output(
-            ["git", "-C", repo_path, "rev-list", f"-n{n}", "HEAD"],
-            stderr=subprocess.STDOUT
-        )
-        commit_hashes = output.decode("utf-8").strip().splitlines()
-        return commit_hashes
-    except subprocess.CalledProcessError as e:
-        print("Error retrieving commit hashes:", e.output.decode("utf-8"))
-        return []
+# Patches longer than this are split into shards that are reviewed separately.
+MAX_PATCH_CHARS = 25000
 
-def get_commit_patch(commit_hash, repo_path):
+# Shards of one patch reviewed (or reproduced) at once. Every commit job runs
+# its own shards, so this multiplies with the number of review workers.
+SHARD_WORKERS = 4
 
-    """
-    Get the patch text for a commit using git format-patch.
-    """
-    try:
-        output = subprocess.check_output(
-            ["git", "-C", repo_path, "format-patch", "-1", commit_hash, "--stdout"],
-            stderr=subprocess.STDOUT
-        )
-        patch_text = output.decode("utf-8")
-        return patch_text
-    except subprocess.CalledProcessError as e:
-        print(f"Error retrieving patch for commit {commit_hash}:", e.output.decode("utf-8"))
-        return ""
+# Set by open_results(); every review/tree result of this run is added to it.
+result_store = None
+run_id = None
+
+# Set by --skip-known-issues: issues matching one of these stored clusters are not reproduced.
+known_clusters = None
+
+def open_results(path, kind, options=None, existing_run=None):
+    """Open the results database and start a new run in it, or continue existing_run."""
+    import llm
+    global result_store, run_id
+    result_store = ResultStore(path)
+    run_id = existing_run or result_store.start_run(kind, llm.MODEL, options)
+    print(f"Recording results of run {run_id} in {path}")
+    return result_store
+
+def content_hash(text):
+    return hashlib.sha1(text.encode("utf-8", errors="replace")).hexdigest()
 
 def build_prompt(patch_texts):
     """
@@ -52,84 +71,769 @@ def build_prompt(patch_texts):
         prompt += "```\n" + patch + "\n```\n\n"
     return prompt
 
+def write_commit_review(commit, patch, analysis, repro, unique=False):
+    import llm
+    print("Writing analysis for ", commit)
+    record = {
+        "commit": commit,
+        "analysis": analysis,
+        "repro": repro
+    }
+    result_store.add(run_id, "commit", commit, record, analysis,
+                     content_hash=content_hash(patch), model=llm.MODEL, unique=unique)
+
+def review_shards(commit, patch):
+    """
+    Review a patch, split into shards of at most MAX_PATCH_CHARS that are
+    reviewed in parallel. Returns (shards, per-shard analyses, merged analysis).
+    """
+    import llm
+    shards = shard_patch(patch, MAX_PATCH_CHARS)
+    if len(shards) == 1:
+        analyses = [llm.review(patch)]
+    else:
+        print(f"Reviewing patch {commit} in {len(shards)} shards")
+        with ThreadPoolExecutor(max_workers=min(len(shards), SHARD_WORKERS)) as executor:
+            analyses = list(executor.map(llm.review, shards))
+    return shards, analyses, merge_issues(analyses)
+
+def reproduce_shards(shards, analyses):
+    """Reproduce each shard's issues against that shard, in parallel, and join the answers."""
+    import llm
+    jobs = [(shard, analysis) for shard, analysis in zip(shards, analyses) if analysis]
+    if not jobs:
+        return None
+    if len(jobs) == 1:
+        return llm.reproduce(*jobs[0])
+    with ThreadPoolExecutor(max_workers=min(len(jobs), SHARD_WORKERS)) as executor:
+        repros = list(executor.map(lambda job: llm.reproduce(*job), jobs))
+    return "\n\n".join(repro for repro in repros if repro) or None
+
+def qualifying_issues(analysis, min_confidence=0, min_severity=0):
+    """The issues of an analysis whose confidence and severity reach both thresholds."""
+    selected = []
+    for issue in analysis or []:
+        if not isinstance(issue, dict):
+            continue
+        try:
+            if float(issue.get("confidence", 0)) >= min_confidence and float(issue.get("severity", 0)) >= min_severity:
+                selected.append(issue)
+        except (TypeError, ValueError):
+            continue
+    return selected
+
+def reproduction_jobs(shards, analyses, min_confidence=0, min_severity=0):
+    """
+    (shard, issues) for every shard with issues worth reproducing. All of a
+    shard's qualifying issues go into one call, so an unsharded commit needs a
+    single reproduce call however many issues it has. Issues that match a
+    known cluster (see cluster.py) are left out when known_clusters is set.
+    """
+    jobs = []
+    for shard, analysis in zip(shards, analyses):
+        issues = qualifying_issues(merge_issues([analysis]), min_confidence, min_severity)
+        if known_clusters is not None and issues:
+            unseen = [issue for issue in issues if known_clusters.match(issue) is None]
+            telemetry.count("reproduce.known_issues", len(issues) - len(unseen))
+            issues = unseen
+        if issues:
+            jobs.append((shard, issues))
+    return jobs
+
+def require_analysis(analysis, key):
+    """
+    Return analysis, or raise if it is None: llm.review/code_tree return None
+    for failed calls and unparseable replies, and a job that got one must be
+    reported as failed (and retried) rather than written and checkpointed.
+    """
+    if analysis is None:
+        raise ValueError(f"No usable analysis of {key}")
+    return analysis
+
 def review_commit(args):
+    """Pipeline stage one: review a commit. Returns (patch, shards, per-shard analyses, merged analysis)."""
     commit, patch = args
-    if len(patch) > 25000:
-        print(f"Skipping analysis for patch {commit} because it's too large")
-        return
-    analysis = review(patch)
+    shards, analyses, analysis = review_shards(commit, patch)
+    print(commit, analysis)
+    return patch, shards, analyses, analysis
+
+def reproduce_issues(commit, jobs):
+    """Pipeline stage two: reproduce the jobs from reproduction_jobs() one after another."""
+    import llm
+    repros = [llm.reproduce(shard, issues) for shard, issues in jobs]
+    repro = "\n\n".join(repro for repro in repros if repro) or None
+    print("<repro>", commit, repro)
+    return repro
+
+# Async reproduce concurrency, one semaphore per event loop.
+_reproduce_slots = {}
+
+def reproduce_slots(limit):
+    import asyncio
+    loop = asyncio.get_running_loop()
+    if loop not in _reproduce_slots:
+        _reproduce_slots.clear()
+        _reproduce_slots[loop] = asyncio.Semaphore(limit)
+    return _reproduce_slots[loop]
+
+async def review_commit_async(args, min_confidence=0, min_severity=0, reproduce_workers=5):
+    import asyncio
+    import llm
+    commit, patch = args
+    shards = shard_patch(patch, MAX_PATCH_CHARS)
+    if len(shards) > 1:
+        print(f"Reviewing patch {commit} in {len(shards)} shards")
+    analyses = await asyncio.gather(*(llm.areview(shard) for shard in shards))
+    for shard_analysis in analyses:
+        require_analysis(shard_analysis, commit)
+    analysis = merge_issues(analyses)
     print(commit, analysis)
 
-    if len(analysis):
-        repro = reproduce(patch, analysis)
+    repro = None
+    jobs = reproduction_jobs(shards, analyses, min_confidence, min_severity)
+    if jobs:
+        # At most reproduce_workers commits are reproduced at once, leaving
+        # the rest of the rate budget to reviews.
+        async with reproduce_slots(reproduce_workers):
+            repros = [await llm.areproduce(shard, issues) for shard, issues in jobs]
+        repro = "\n\n".join(repro for repro in repros if repro) or None
         print("<repro>", commit, repro)
-    else:
-        repro = None
 
-    print("Writing analysis for ", commit)
-    with open(f'out/{commit}.json', 'w') as f:
-        json.dump({
-            "commit": commit,
-            "analysis": analysis,
-            "repro": repro
-        }, f, indent=4)
-
-def review_commits(n, repo_path="."):
-    commit_hashes = get_last_commit_hashes(n, repo_path)
-    if not commit_hashes:
-        print("No commits found or error accessing repository.")
-        return
-    
-    patches = [(commit, get_commit_patch(commit, repo_path)) for commit in commit_hashes]
+    write_commit_review(commit, patch, analysis, repro)
 
-    run_jobs(review_commit, patches, max_workers=25, payload_arg_key_fn=lambda x: x[0])
+def review_commits(n, repo_path=".", use_async=False, revisions=None, paths=None,
+                   author=None, since=None, until=None, review_workers=25, reproduce_workers=5,
+                   min_confidence=5, min_severity=0, checkpoint=None, **job_options):
+    """
+    Review the last n commits of `revisions` (all of them if n <= 0), optionally
+    limited to commits touching `paths` or by author/date. Patches are read from
+    a single git process and fed to the workers as they arrive.
 
-def reproduce_commit(commit_hash, repo_path="."):
-    patch = get_commit_patch(commit_hash, repo_path)
+    Reviewing and reproducing are two pipeline stages with their own worker
+    pools: reviews stream into a queue of reproductions, which only run for
+    commits with issues of at least min_confidence and min_severity (all of a
+    commit's qualifying issues in one call). A commit is written, and recorded
+    in the checkpoint, once both stages are done with it.
+    """
+    from worker import Checkpoint, iter_jobs, iter_jobs_async
+    patches = iter_commit_patches(repo_path, revisions, max_count=n if n > 0 else None,
+                                  paths=paths, author=author, since=since, until=until)
+    done_keys = Checkpoint(checkpoint, result_store.flush) if checkpoint else None
+    if done_keys is not None:
+        patches = (patch for patch in patches if patch[0] not in done_keys)
 
-    if not patch:
-        print(f"Failed to fetch patch for commit {commit_hash}")
+    def finish(commit, patch, analysis, repro):
+        write_commit_review(commit, patch, analysis, repro)
+        if done_keys is not None and analysis is not None:
+            done_keys.add(commit)
+
+    def review_job(args):
+        result = review_commit(args)
+        for shard_analysis in result[2]:
+            require_analysis(shard_analysis, args[0])
+        return result
+
+    reviewed = 0
+    reproduced = 0
+    try:
+        if use_async:
+            review_fn = lambda args: review_commit_async(args, min_confidence, min_severity, reproduce_workers)
+            for commit, result in iter_jobs_async(review_fn, patches, payload_arg_key_fn=lambda x: x[0],
+                                                  **async_options(job_options)):
+                if not isinstance(result, dict):
+                    reviewed += 1  # review_commit_async wrote its own output
+                    if done_keys is not None:
+                        done_keys.add(commit)
+        else:
+            pending = {}
+            with ThreadPoolExecutor(max_workers=reproduce_workers) as reproducer:
+                def collect(block):
+                    nonlocal reproduced
+                    if block:
+                        finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    else:
+                        finished = [future for future in pending if future.done()]
+                    for future in finished:
+                        commit, patch, analysis = pending.pop(future)
+                        try:
+                            repro = future.result()
+                        except Exception as e:
+                            print(f"Reproducing {commit} failed: {e}")
+                            repro = None
+                        reproduced += 1
+                        finish(commit, patch, analysis, repro)
+
+                for commit, result in iter_jobs(review_job, patches, max_workers=review_workers,
+                                                payload_arg_key_fn=lambda x: x[0], **job_options):
+                    if isinstance(result, dict):
+                        continue  # the review failed; iter_jobs reported it
+                    reviewed += 1
+                    patch, shards, analyses, analysis = result
+                    jobs = reproduction_jobs(shards, analyses, min_confidence, min_severity)
+                    if jobs:
+                        pending[reproducer.submit(reproduce_issues, commit, jobs)] = (commit, patch, analysis)
+                    else:
+                        finish(commit, patch, analysis, None)
+                    collect(block=False)
+                    # Backpressure: don't let reviews run too far ahead of reproduction.
+                    while len(pending) > reproduce_workers * 4:
+                        collect(block=True)
+                while pending:
+                    collect(block=True)
+            print(f"Reproduced {reproduced} of {reviewed} reviewed commit(s)")
+    finally:
+        if done_keys is not None:
+            done_keys.close()
+    if not reviewed:
+        print("No commits were reviewed.")
+
+def reproduce_commit(commit_hash, repo_path="."):
+    import llm
+    # Read the patch as review_commits does, so a commit that was already
+    # reviewed is answered from the response cache.
+    try:
+        _, patch = get_commit_patch(repo_path, commit_hash)
+    except ValueError as e:
+        print(f"Failed to fetch patch: {e}")
         return
-    
-    # probably fine to re-run this
-    issues = review(patch)
+
+    shards, analyses, issues = review_shards(commit_hash, patch)
 
     print(issues)
 
-    repro = reproduce(patch, issues)
+    if len(shards) == 1:
+        repro = llm.reproduce(patch, issues)
+    else:
+        repro = reproduce_shards(shards, analyses)
     print(repro)
 
-def analyze_tree(count, repo_path):
-    trees = get_code_tree(count, repo_path)
+def batch_trees(payloads, batch_tokens):
+    """
+    Pack (key, tree) payloads into batches whose rendered trees add up to at
+    most about batch_tokens. Trees over half of that are sent on their own,
+    since batching only pays off for small ones.
+    """
+    import llm
+    batches = []
+    current = []
+    used = 0
+    for key, tree in payloads:
+        _, tokens = render_tree(tree, llm.tree_token_budget)
+        if tokens > batch_tokens // 2:
+            batches.append([(key, tree)])
+            continue
+        if current and used + tokens > batch_tokens:
+            batches.append(current)
+            current = []
+            used = 0
+        current.append((key, tree))
+        used += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def choose_trees(count, repo_path, store, jobs=None, depth=1, caller_depth=0, budget=None, incremental=False,
+                 strategy="random", weights=None, token_budget=None, prompt_tokens=DEFAULT_TREE_TOKENS):
+    """The (tree hash, specimen) pairs the tree command would analyze; see analyze_tree."""
+    skip_hashes = store.analyzed_hashes("tree") if incremental else None
+    choose = None
+    if strategy != "random" or token_budget is not None:
+        choose = make_chooser(repo_path, strategy, weights, token_budget, store, depth, caller_depth, budget,
+                              prompt_tokens)
+    return select_code_trees(count, repo_path, jobs, depth, caller_depth, budget, skip_hashes, choose)
+
+def analyze_tree(count, repo_path, jobs=None, depth=1, caller_depth=0, budget=None, use_async=False,
+                 incremental=False, strategy="random", weights=None, token_budget=None, batch_tokens=None,
+                 **job_options):
+    """
+    Analyze `count` code trees (0 for all), chosen by `strategy` (see
+    scheduler.py) within token_budget. With incremental=True, only trees that
+    are new or changed since they were last analyzed are candidates; every
+    tree analyzed successfully is added to the ledger. With batch_tokens,
+    small trees are packed into shared requests of about that many tokens.
+    """
+    import llm
+    from worker import Checkpoint, iter_jobs, iter_jobs_async
+    trees = choose_trees(count, repo_path, result_store, jobs, depth, caller_depth, budget, incremental,
+                         strategy, weights, token_budget, llm.tree_token_budget)
+
+    job_options = {**job_options, "persist": result_store.flush}
+    by_key = { tree['functionName']: (hashed, tree) for hashed, tree in trees }
+    payloads = [(key, tree) for key, (_, tree) in by_key.items()]
+    done_keys = None
+    if batch_tokens:
+        # Batches are the jobs, but functions are what gets checkpointed, so
+        # a function missing from a batch reply fails without taking the
+        # others with it.
+        checkpoint = job_options.pop("checkpoint", None)
+        if checkpoint:
+            done_keys = Checkpoint(checkpoint, result_store.flush)
+            payloads = [(key, tree) for key, tree in payloads if key not in done_keys]
+        batches = batch_trees(payloads, batch_tokens)
+        print(f"Packed {len(payloads)} code tree(s) into {len(batches)} request(s)")
+        batch_key = lambda batch: tuple(key for key, _ in batch)
+
+        def check_batch(batch, analyses):
+            # Only a batch with nothing usable fails (and is retried) as a whole.
+            if all(analysis is None for analysis in analyses):
+                raise ValueError(f"No usable analysis of {', '.join(batch_key(batch))}")
+            return analyses
+
+        if use_async:
+            async def run_batch(batch):
+                if len(batch) == 1:
+                    analyses = [await llm.acode_tree(batch[0][1])]
+                else:
+                    analyses = await llm.acode_tree_batch([tree for _, tree in batch])
+                return check_batch(batch, analyses)
+            batch_results = iter_jobs_async(run_batch, batches, payload_arg_key_fn=batch_key, **async_options(job_options))
+        else:
+            def run_batch(batch):
+                if len(batch) == 1:
+                    analyses = [llm.code_tree(batch[0][1])]
+                else:
+                    analyses = llm.code_tree_batch([tree for _, tree in batch])
+                return check_batch(batch, analyses)
+            batch_results = iter_jobs(run_batch, batches, max_workers=25, payload_arg_key_fn=batch_key, **job_options)
+
+        def split_batches():
+            # One result per function; one the reply has no analysis of fails on its own.
+            for keys, analyses in batch_results:
+                if not isinstance(analyses, list):
+                    continue
+                for key, analysis in zip(keys, analyses):
+                    if analysis is None:
+                        print(f"No usable analysis of {key}")
+                        continue
+                    yield key, analysis
+        results = split_batches()
+    elif use_async:
+        async def run_tree(payload):
+            return require_analysis(await llm.acode_tree(payload[1]), payload[0])
+        results = iter_jobs_async(run_tree, payloads, payload_arg_key_fn=lambda x: x[0], **async_options(job_options))
+    else:
+        run_tree = lambda payload: require_analysis(llm.code_tree(payload[1]), payload[0])
+        results = iter_jobs(run_tree, payloads, max_workers=25, payload_arg_key_fn=lambda x: x[0], **job_options)
+
+    try:
+        for key, analysis in results:
+            # A dict is a failed job (no usable analysis); it doesn't count as analyzed.
+            if not isinstance(analysis, list):
+                continue
+            hashed, tree = by_key[key]
+            result_store.mark_analyzed(run_id, "tree", key, hashed, llm.MODEL)
+            if analysis:
+                result_store.add(run_id, "tree", key, {"tree": tree, "analysis": analysis}, analysis,
+                                 file=tree["file"], content_hash=hashed, model=llm.MODEL)
+            if done_keys is not None:
+                done_keys.add(key)
+    finally:
+        if done_keys is not None:
+            done_keys.close()
+
+def coverage_report(repo_path, store, jobs=None, depth=1, caller_depth=0, budget=None):
+    """
+    Print how much of the codebase has been analyzed at its current version:
+    functions whose current code tree hash is in the ledger, overall and per
+    directory. Tree hashes depend on depth/callers/budget, so pass the values
+    the tree runs use.
+    """
+    index = build_index(repo_path, jobs)
+    if not len(index):
+        print("No functions with bodies were found.")
+        return
+    analyzed = store.analyzed_hashes("tree")
+    analyzed_names = store.analyzed_keys("tree")
+    root = os.path.abspath(repo_path)
+    by_dir = {}
+    totals = [0, 0, 0]  # functions, current, analyzed at an older version
+    for func_id, hashed in iter_tree_hashes(index, depth, caller_depth, budget):
+        directory = os.path.dirname(os.path.relpath(index.file(func_id), root)) or "."
+        counts = by_dir.setdefault(directory, [0, 0, 0])
+        current = hashed in analyzed
+        stale = not current and index.name(func_id) in analyzed_names
+        for c in (counts, totals):
+            c[0] += 1
+            c[1] += current
+            c[2] += stale
+
+    print(f"{'directory':<50} {'functions':>9} {'current':>8} {'stale':>6} {'covered':>8}")
+    for directory, (total, current, stale) in sorted(by_dir.items()):
+        print(f"{directory:<50} {total:>9} {current:>8} {stale:>6} {current / total:>8.1%}")
+    total, current, stale = totals
+    print(f"{'total':<50} {total:>9} {current:>8} {stale:>6} {current / total:>8.1%}")
+    print(f"{total - current} function(s) need review: {stale} changed since they were analyzed, "
+          f"{total - current - stale} never analyzed")
+
+def index_repo(repo_path, jobs=None):
+    """Build the function index of repo_path, or bring it up to date, as the tree command would."""
+    index = build_index(repo_path, jobs)
+    if len(index):
+        print(f"{len(index)} function(s) in {get_index_path(repo_path)}")
+
+def sample_trees(count, repo_path, store, jobs=None, depth=1, caller_depth=0, budget=None, incremental=False,
+                 strategy="random", weights=None, token_budget=None, prompt_tokens=DEFAULT_TREE_TOKENS,
+                 json_path=None):
+    """
+    Print the code trees `tree` would analyze with the same options, without
+    calling the API: one line per tree with its function, file, size and
+    estimated prompt tokens. With json_path, the specimens are also written
+    there, one JSON object per line.
+    """
+    trees = choose_trees(count, repo_path, store, jobs, depth, caller_depth, budget, incremental,
+                         strategy, weights, token_budget, prompt_tokens)
+    total = 0
+    for hashed, tree in trees:
+        _, tokens = render_tree(tree, prompt_tokens)
+        total += tokens
+        print(f"{tree['functionName']:<40} {tree['file']}  {len(tree['calledFunctions'])} called, "
+              f"{len(tree['callingFunctions'])} calling, ~{tokens} token(s)")
+    print(f"{len(trees)} code tree(s), ~{total} prompt token(s) of code")
+    if json_path:
+        with open(json_path, 'w') as f:
+            for hashed, tree in trees:
+                f.write(json.dumps({"hash": hashed, **tree}) + "\n")
+        print(f"Wrote {len(trees)} specimen(s) to {json_path}")
+
+def load_known_clusters(results_path):
+    """Set known_clusters to the clusters cluster.py stored in results_path."""
+    global known_clusters
+    from cluster import KnownClusters
+    store = ResultStore(results_path)
+    known_clusters = KnownClusters(store)
+    store.close()
+    print(f"Skipping reproduction of issues in {len(known_clusters)} known cluster(s)")
+
+def seed_queue(queue_path, kind, items, results_path, options):
+    """
+    Add (key, payload) jobs to the work queue at queue_path for worker
+    processes, which use `options` for jobs of this kind. The first seeding
+    starts the campaign's run in the results database; later ones add to it.
+    """
+    import llm
+    work_queue = WorkQueue(queue_path)
+    info = work_queue.info()
+    if "run_id" not in info:
+        store = ResultStore(results_path)
+        info = {"results": results_path, "run_id": store.start_run(kind, llm.MODEL, options)}
+        store.close()
+    work_queue.set_info(**{**info, **options})
+    added = work_queue.seed(kind, items)
+    counts = work_queue.counts()
+    print(f"Added {added} {kind} job(s) to {queue_path} for run {info['run_id']} "
+          f"({counts['queued']} queued, {counts['done']} done)")
+    work_queue.close()
+
+def seed_campaign(args):
+    """Seed args.queue with the commits (review) or code trees (tree) the other options select."""
+    if args.command == "review":
+        commits = list_commits(args.repo, args.range, args.count if args.count > 0 else None,
+                               args.path, args.author, args.since, args.until)
+        settings = {"repro_min_confidence": args.repro_min_confidence, "repro_min_severity": args.repro_min_severity}
+        seed_queue(args.queue, "commit", [(commit, None) for commit in commits], args.results, settings)
+        return
+    store = ResultStore(args.results)
+    trees = choose_trees(args.count, args.repo, store, args.jobs, args.depth, args.callers, args.budget,
+                         args.incremental, args.strategy, parse_weights(args.weights), args.token_budget,
+                         args.prompt_tokens or DEFAULT_TREE_TOKENS)
+    store.close()
+    settings = {"depth": args.depth, "callers": args.callers, "budget": args.budget}
+    seed_queue(args.queue, "tree", [(tree["functionName"], {"hash": hashed}) for hashed, tree in trees],
+               args.results, settings)
+
+def run_queue_job(kind, key, payload, repo_path, settings, get_index):
+    """Do one queued job: review (and reproduce) a commit, or analyze a function's code tree."""
+    import llm
+    if kind == "commit":
+        _, patch = get_commit_patch(repo_path, key)
+        _, shards, analyses, analysis = review_commit((key, patch))
+        for shard_analysis in analyses:
+            require_analysis(shard_analysis, key)
+        jobs = reproduction_jobs(shards, analyses, settings.get("repro_min_confidence", 5),
+                                 settings.get("repro_min_severity", 0))
+        repro = reproduce_issues(key, jobs) if jobs else None
+        write_commit_review(key, patch, analysis, repro, unique=True)
+        return
+    index = get_index()
+    func_id = index.lookup(key)
+    specimen = build_specimen(index, func_id, settings.get("depth", 1), settings.get("callers", 0),
+                              settings.get("budget")) if func_id is not None else None
+    if specimen is None:
+        raise ValueError(f"Function {key} is not in {repo_path}")
+    hashed, tree = specimen
+    analysis = require_analysis(llm.code_tree(tree), key)
+    result_store.mark_analyzed(run_id, "tree", key, hashed, llm.MODEL)
+    if analysis:
+        result_store.add(run_id, "tree", key, {"tree": tree, "analysis": analysis}, analysis,
+                         file=tree["file"], content_hash=hashed, model=llm.MODEL, unique=True)
+
+def run_worker(queue_path, repo_path=".", threads=25, lease=DEFAULT_LEASE, jobs=None, poll=5.0,
+               skip_known_issues=False):
+    """
+    Work on a queue seeded with --queue until no job is left: claim up to
+    2 * threads jobs at a time, renew their leases every lease / 3 seconds
+    while they run, and mark them done once their results are written. Jobs
+    other workers hold are waited for, in case their leases expire.
+    """
+    work_queue = WorkQueue(queue_path)
+    settings = work_queue.info()
+    if "run_id" not in settings:
+        print(f"{queue_path} has not been seeded; start a campaign with `review --queue` or `tree --queue`")
+        return
+    if skip_known_issues:
+        load_known_clusters(settings["results"])
+    open_results(settings["results"], None, existing_run=settings["run_id"])
+    owner = worker_name()
+    print(f"Worker {owner} on {queue_path}")
 
-    by_key = { tree['functionName']: tree for tree in trees }
-    analysis = run_jobs(code_tree, [(key, val) for key, val in by_key.items()], max_workers=25, payload_arg_key_fn=lambda x: x[0])
+    index = None
+    index_lock = threading.Lock()
+    def get_index():
+        nonlocal index
+        with index_lock:
+            if index is None:
+                index = build_index(repo_path, jobs)
+            return index
 
-    for key, analysis in analysis.items():
-        if len(analysis):
-            with open(f'out/{key}.json', 'w') as f:
-                json.dump({
-                    "tree": by_key[key],
-                    "analysis": analysis,
-                }, f, indent=4)
+    in_flight = {}  # future -> (job id, kind, key)
+    in_flight_lock = threading.Lock()
+    stop = threading.Event()
+    def heartbeat():
+        while not stop.wait(lease / 3):
+            with in_flight_lock:
+                job_ids = [job[0] for job in in_flight.values()]
+            if job_ids:
+                lost = work_queue.heartbeat(owner, job_ids, lease)
+                if lost:
+                    print(f"Lost the lease on {len(lost)} job(s); another worker may redo them")
+    beater = threading.Thread(target=heartbeat, daemon=True)
+    beater.start()
+
+    done = failed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            while True:
+                room = threads * 2 - len(in_flight)
+                if room > 0:
+                    for job_id, kind, key, payload in work_queue.claim(owner, room, lease):
+                        future = executor.submit(run_queue_job, kind, key, payload, repo_path, settings, get_index)
+                        with in_flight_lock:
+                            in_flight[future] = (job_id, kind, key)
+                if not in_flight:
+                    if not work_queue.unfinished():
+                        break
+                    time.sleep(poll)  # the rest is leased to other workers
+                    continue
+                finished, _ = wait(list(in_flight), timeout=poll, return_when=FIRST_COMPLETED)
+                completed = []
+                for future in finished:
+                    with in_flight_lock:
+                        job_id, kind, key = in_flight.pop(future)
+                    try:
+                        future.result()
+                        completed.append(job_id)
+                    except Exception as e:
+                        print(f"{kind} {key} failed: {e}")
+                        work_queue.fail(owner, job_id, e)
+                        failed += 1
+                if completed:
+                    # Results must be on disk before their jobs are marked done.
+                    result_store.flush()
+                    lost = work_queue.complete(owner, completed)
+                    done += len(completed) - len(lost)
+                    counts = work_queue.counts()
+                    print(f"Worker {owner}: {done} done, {failed} failed | queue: {counts['queued']} queued, "
+                          f"{counts['leased']} leased, {counts['done']} done, {counts['failed']} failed")
+    finally:
+        stop.set()
+        work_queue.close()
+    print(f"Worker {owner} finished: {done} job(s) done, {failed} failed")
+
+def async_options(job_options):
+    """The iter_jobs options that apply to iter_jobs_async (the llm module retries by itself)."""
+    return {name: value for name, value in job_options.items() if name in ("checkpoint", "persist", "deadline")}
+
+
+def configure_llm(args):
+    """Apply the API options of an LLM command to the llm module, importing it."""
+    import llm
+    if args.base_url is not None:
+        llm.base_url = args.base_url
+    if args.no_cache:
+        llm.use_cache = False
+    if getattr(args, "rpm", None) is not None:
+        llm.requests_per_minute = args.rpm
+    if getattr(args, "tpm", None) is not None:
+        llm.tokens_per_minute = args.tpm
+    if getattr(args, "max_concurrency", None) is not None:
+        llm.max_concurrency = args.max_concurrency
+    if getattr(args, "prompt_tokens", None) is not None:
+        llm.tree_token_budget = args.prompt_tokens
+
+def report_llm_usage(elapsed):
+    """Print response cache hits, per-template usage and cost, and reply parsing outcomes."""
+    import llm
+    cache = llm.get_response_cache()
+    if cache is not None:
+        print(f"LLM response cache: {cache.hits} hit(s), {cache.misses} miss(es)")
+    for template, stats in sorted(llm.usage_stats.items()):
+        cached = stats['cached_tokens'] / stats['prompt_tokens'] if stats['prompt_tokens'] else 0.0
+        print(f"LLM {template}: {stats['calls']} call(s) averaging {stats['seconds'] / stats['calls']:.1f}s "
+              f"({stats['retries']} retried), "
+              f"{stats['prompt_tokens']} prompt token(s) (estimated {stats['estimated_tokens']}, {cached:.0%} cached), "
+              f"{stats['completion_tokens']} completion token(s) ({stats['reasoning_tokens']} reasoning), "
+              f"about ${llm.estimated_cost(stats):.2f}")
+    if llm.usage_stats:
+        tokens = sum(stats['prompt_tokens'] + stats['completion_tokens'] for stats in llm.usage_stats.values())
+        cost = sum(llm.estimated_cost(stats) for stats in llm.usage_stats.values())
+        print(f"LLM total: {tokens} token(s) in {elapsed:.1f}s ({tokens / max(elapsed, 1e-9):.0f} tokens/s), about ${cost:.2f}")
+    for template, stats in sorted(llm.parse_stats.items()):
+        print(f"Replies to {template}: {stats['parsed']} parsed, {stats['salvaged']} salvaged, "
+              f"{stats['repaired']} repaired, {stats['failed']} unparseable")
 
 def main():
     parser = argparse.ArgumentParser(
         description="Looking for issues in a codebase"
     )
-    group = parser.add_mutually_exclusive_group(required=True)
-    group.add_argument("--review", type=int, help="Review the last N commits")
-    group.add_argument("--reproduce", type=str, help="Reproduce (fetch diff patch) for the specified commit hash")
-    group.add_argument("--tree", type=int, help="Analyze random code trees in the repo")
-    parser.add_argument("--repo", type=str, default=".", help="Path to the git repository (default: current directory)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    index_cmd = sub.add_parser("index", help="Build or refresh the function index of the repo (offline)")
+    sample_cmd = sub.add_parser("sample", help="Print the code trees `tree` would analyze, without calling the API (offline)")
+    sample_cmd.add_argument("count", type=int, help="Number of code trees (0 for all)")
+    sample_cmd.add_argument("--json", type=str, default=None, help="Also write the specimens to this file, one JSON object per line")
+    tree_cmd = sub.add_parser("tree", help="Analyze N code trees in the repo, chosen by --strategy")
+    tree_cmd.add_argument("count", type=int, help="Number of code trees (0 for all)")
+    tree_cmd.add_argument("--batch-tokens", type=int, default=None, help="Pack small specimens into shared requests of about this many tokens of code")
+    review_cmd = sub.add_parser("review", help="Review the last N commits and reproduce their issues")
+    review_cmd.add_argument("count", type=int, help="Number of commits (0 for every commit selected by the filters below)")
+    review_cmd.add_argument("--range", type=str, action="append", default=None, help="Revision range, e.g. REL_16_0..master (repeatable; default: HEAD)")
+    review_cmd.add_argument("--path", type=str, action="append", default=None, help="Only commits touching this path (repeatable)")
+    review_cmd.add_argument("--author", type=str, default=None, help="Only commits by a matching author")
+    review_cmd.add_argument("--since", type=str, default=None, help="Only commits after this date")
+    review_cmd.add_argument("--until", type=str, default=None, help="Only commits before this date")
+    review_cmd.add_argument("--review-workers", type=int, default=25, help="Concurrent review calls (default: 25)")
+    review_cmd.add_argument("--repro-workers", type=int, default=5, help="Concurrent reproductions of reviewed commits (default: 5)")
+    review_cmd.add_argument("--repro-min-confidence", type=float, default=5, help="Only reproduce issues with at least this confidence (default: 5)")
+    review_cmd.add_argument("--repro-min-severity", type=float, default=0, help="Only reproduce issues with at least this severity (default: 0)")
+    reproduce_cmd = sub.add_parser("reproduce", help="Review one commit and reproduce its issues")
+    reproduce_cmd.add_argument("commit", help="Commit hash")
+    worker_cmd = sub.add_parser("worker", help="Work on jobs from a queue seeded with `tree --queue` or `review --queue` until none are left")
+    worker_cmd.add_argument("queue_path", metavar="queue", help="Queue database")
+    worker_cmd.add_argument("--lease", type=float, default=DEFAULT_LEASE, help=f"Seconds a job is held before another worker may take it over, renewed while it runs (default: {DEFAULT_LEASE})")
+    worker_cmd.add_argument("--threads", type=int, default=25, help="Concurrent jobs (default: 25)")
+    coverage_cmd = sub.add_parser("coverage", help="Report how much of the repo has been analyzed at its current version (offline)")
+    export_cmd = sub.add_parser("export", help="Write stored results as <dir>/<key>.json, or for tree_browser.html (offline)")
+    export_cmd.add_argument("out_dir", help="Directory to write into")
+    export_cmd.add_argument("--browser", action="store_true", help="Write code tree results for tree_browser.html (index.json plus shards)")
+    export_cmd.add_argument("--kind", choices=["commit", "tree"], default=None, help="Only commit reviews or code trees")
+    export_cmd.add_argument("--run", type=str, default=None, help="Only results from this run id")
+    export_cmd.add_argument("--all", action="store_true", help="Include results without issues")
+
+    for cmd in (index_cmd, sample_cmd, tree_cmd, review_cmd, reproduce_cmd, worker_cmd, coverage_cmd):
+        cmd.add_argument("--repo", type=str, default=".", help="Path to the git repository (default: current directory)")
+        cmd.add_argument("--telemetry", type=str, default=None, help="Append per-stage timing spans to this JSONL file (default: $FUZZER_TELEMETRY)")
+    for cmd in (index_cmd, sample_cmd, tree_cmd, worker_cmd, coverage_cmd):
+        cmd.add_argument("--jobs", type=int, default=None, help="Number of processes used to index the repo (default: one per CPU)")
+        cmd.add_argument("--profile", type=str, default=None, help="Write cProfile data for indexing to this file (indexes in one process)")
+    for cmd in (sample_cmd, tree_cmd, coverage_cmd):
+        cmd.add_argument("--depth", type=int, default=1, help="Levels of called functions to include in specimens (default: 1)")
+        cmd.add_argument("--callers", type=int, default=0, help="Levels of calling functions to include in specimens (default: 0)")
+        cmd.add_argument("--budget", type=int, default=None, help="Maximum bytes of called/calling function source per specimen (default: no limit)")
+    for cmd in (sample_cmd, tree_cmd):
+        cmd.add_argument("--incremental", action="store_true", help="Only pick functions whose code tree changed since it was last analyzed (count 0: all of them)")
+        cmd.add_argument("--strategy", choices=STRATEGIES, default="random", help="How functions are picked: uniformly, sampled by priority score, or highest score first (default: random)")
+        cmd.add_argument("--weights", type=str, default=None, help="Priority signal weights, e.g. churn=2,size=1,fan_in=0.5,fan_out=0.5,findings=1")
+        cmd.add_argument("--token-budget", type=int, default=None, help="Stop adding specimens once their estimated prompt tokens reach this")
+    for cmd in (sample_cmd, tree_cmd, worker_cmd):
+        cmd.add_argument("--prompt-tokens", type=int, default=None, help=f"Token budget for the code of one code tree prompt; less relevant callees are cut to their signatures or left out (default: {DEFAULT_TREE_TOKENS})")
+    for cmd in (tree_cmd, review_cmd, reproduce_cmd, worker_cmd):
+        cmd.add_argument("--base-url", type=str, default=None, help="OpenAI-compatible API endpoint, e.g. http://127.0.0.1:8000/v1 for mockserver.py")
+        cmd.add_argument("--no-cache", action="store_true", help="Always call the API instead of reusing cached LLM responses")
+    for cmd in (tree_cmd, review_cmd):
+        cmd.add_argument("--async", dest="use_async", action="store_true", help="Use the async LLM client, paced by --rpm/--tpm instead of a fixed thread count")
+        cmd.add_argument("--rpm", type=int, default=None, help="Requests per minute allowed by the API account (async only)")
+        cmd.add_argument("--tpm", type=int, default=None, help="Tokens per minute allowed by the API account (async only)")
+        cmd.add_argument("--max-concurrency", type=int, default=None, help="Upper bound for the adaptive number of requests in flight (async only)")
+        cmd.add_argument("--checkpoint", type=str, default=None, help="File recording finished commits/functions; a rerun with the same file skips them")
+        cmd.add_argument("--retries", type=int, default=0, help="Times to retry a failed job, with exponential backoff (default: 0)")
+        cmd.add_argument("--deadline", type=float, default=None, help="Stop starting new jobs after this many seconds")
+        cmd.add_argument("--queue", type=str, default=None, help="Add the selected commits/trees to this work queue for worker processes instead of reviewing them")
+        cmd.add_argument("--json-out", type=str, default=None, help="After the run, also write its results as <dir>/<key>.json (the old out/ layout)")
+    for cmd in (review_cmd, worker_cmd):
+        cmd.add_argument("--skip-known-issues", action="store_true", help="Don't reproduce issues that match a cluster stored by cluster.py")
+    for cmd in (sample_cmd, tree_cmd, review_cmd, coverage_cmd, export_cmd):
+        cmd.add_argument("--results", type=str, default=DEFAULT_RESULTS_PATH, help=f"Results database (default: {DEFAULT_RESULTS_PATH})")
     args = parser.parse_args()
 
-    if args.review is not None:
-        review_commits(args.review, args.repo)
-    elif args.reproduce is not None:
-        reproduce_commit(args.reproduce, args.repo)
-    elif args.tree is not None:
-        analyze_tree(args.tree, args.repo)
+    started = time.monotonic()
+    if getattr(args, "telemetry", None) is not None:
+        telemetry.log_path = args.telemetry
+    if getattr(args, "profile", None) is not None:
+        telemetry.profile_path = args.profile
+
+    seeding = getattr(args, "queue", None) is not None
+    uses_llm = args.command in ("tree", "review", "reproduce", "worker") and not seeding
+    if uses_llm:
+        configure_llm(args)
+    if args.command in ("tree", "review"):
+        job_options = {"checkpoint": args.checkpoint, "retries": args.retries, "deadline": args.deadline}
+        if not seeding:
+            open_results(args.results, "commit" if args.command == "review" else "tree", vars(args))
+    if args.command == "review" and args.skip_known_issues:
+        load_known_clusters(args.results)
+
+    if seeding:
+        seed_campaign(args)
+    elif args.command == "index":
+        index_repo(args.repo, args.jobs)
+    elif args.command == "sample":
+        store = ResultStore(args.results)
+        sample_trees(args.count, args.repo, store, args.jobs, args.depth, args.callers, args.budget, args.incremental,
+                     args.strategy, parse_weights(args.weights), args.token_budget,
+                     args.prompt_tokens or DEFAULT_TREE_TOKENS, args.json)
+        store.close()
+    elif args.command == "worker":
+        run_worker(args.queue_path, args.repo, args.threads, args.lease, args.jobs,
+                   skip_known_issues=args.skip_known_issues)
+    elif args.command == "review":
+        review_commits(args.count, args.repo, args.use_async, args.range, args.path,
+                       args.author, args.since, args.until, args.review_workers, args.repro_workers,
+                       args.repro_min_confidence, args.repro_min_severity, **job_options)
+    elif args.command == "reproduce":
+        reproduce_commit(args.commit, args.repo)
+    elif args.command == "tree":
+        analyze_tree(args.count, args.repo, args.jobs, args.depth, args.callers, args.budget, args.use_async,
+                     args.incremental, args.strategy, parse_weights(args.weights), args.token_budget,
+                     args.batch_tokens, **job_options)
+    elif args.command == "coverage":
+        store = ResultStore(args.results)
+        coverage_report(args.repo, store, args.jobs, args.depth, args.callers, args.budget)
+        store.close()
+    elif args.command == "export":
+        store = ResultStore(args.results)
+        filters = {"run_id": args.run, "with_issues": not args.all}
+        if args.browser:
+            written = export_browser(store, args.out_dir, **filters)
+            print(f"Wrote {written} item(s) to {args.out_dir}; open tree_browser.html and select that folder")
+        else:
+            written = export_json(store, args.out_dir, kind=args.kind, **filters)
+            print(f"Wrote {written} file(s) to {args.out_dir}")
+        store.close()
+
+    if result_store is not None:
+        result_store.flush()
+        if getattr(args, "json_out", None):
+            with telemetry.span("results.export"):
+                written = export_json(result_store, args.json_out, run_id=run_id, with_issues=False)
+            print(f"Wrote {written} result file(s) to {args.json_out}")
+        result_store.close()
+
+    elapsed = time.monotonic() - started
+    if uses_llm:
+        report_llm_usage(elapsed)
+    summary = telemetry.summary()
+    if summary:
+        print(f"\nStages ({elapsed:.1f}s in total):\n{summary}")
+    telemetry.close()
 
 if __name__ == "__main__":
     main()
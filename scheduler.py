@@ -0,0 +1,200 @@
+"""
+Prioritized selection of code trees for review.
+
+Instead of sampling functions uniformly, functions are scored from signals that
+are cheap to compute up front: how much (and how recently) their file changed,
+from one `git log --numstat` pass; their size; how many functions call them and
+how many they call, from the index's call graph; and how many issues earlier
+runs found in their file. Trees are then taken highest score first ("top") or
+sampled with probability proportional to the score ("weighted"), until the
+requested count or the token budget is reached.
+"""
+import math
+import os
+import random
+import subprocess
+import time
+
+import telemetry
+from pair import build_specimen
+from prompts import DEFAULT_TREE_TOKENS, TEMPLATES, estimate_tokens, render_tree
+
+STRATEGIES = ("random", "weighted", "top")
+
+DEFAULT_WEIGHTS = {
+    "churn": 1.0,
+    "size": 1.0,
+    "fan_in": 0.5,
+    "fan_out": 0.5,
+    "findings": 1.0,
+}
+
+# A file's churn counts changes from a day ago fully, from CHURN_HALF_LIFE_DAYS ago half.
+CHURN_HALF_LIFE_DAYS = 90
+
+# Tokens of a code tree request besides the rendered tree: the system message
+# and the framing of the two messages (as counted by llm.estimate_tokens).
+PROMPT_OVERHEAD_TOKENS = estimate_tokens(TEMPLATES["code_tree"]["system"]) + 2 * 4
+
+def parse_weights(text):
+    """Parse "churn=2,size=0.5" into a weights dict, starting from DEFAULT_WEIGHTS."""
+    weights = dict(DEFAULT_WEIGHTS)
+    for part in (text or "").split(","):
+        if not part.strip():
+            continue
+        name, _, value = part.partition("=")
+        name = name.strip()
+        if name not in weights:
+            raise ValueError(f"Unknown signal {name!r}; expected one of {', '.join(DEFAULT_WEIGHTS)}")
+        weights[name] = float(value)
+    return weights
+
+def file_churn(repo_path, since=None, half_life_days=CHURN_HALF_LIFE_DAYS):
+    """
+    Lines added plus deleted per file over the history (or since `since`), each
+    commit's changes weighted by 2 ** -(age / half life). Returns {real path:
+    churn}; empty if repo_path is not in a git repository.
+    """
+    try:
+        toplevel = subprocess.check_output(
+            ["git", "-C", repo_path, "rev-parse", "--show-toplevel"], stderr=subprocess.DEVNULL
+        ).decode("utf-8").strip()
+    except (subprocess.CalledProcessError, OSError):
+        return {}
+    cmd = ["git", "-C", toplevel, "log", "--no-merges", "--no-renames", "--numstat", "--format=%x00%ct"]
+    if since:
+        cmd.append(f"--since={since}")
+    now = time.time()
+    decay = math.log(2) / (half_life_days * 86400)
+    churn = {}
+    weight = 1.0
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    for line in process.stdout:
+        line = line.decode("utf-8", errors="surrogateescape").rstrip("\n")
+        if line.startswith("\0"):
+            weight = math.exp(-decay * max(0.0, now - int(line[1:])))
+            continue
+        parts = line.split("\t", 2)
+        if len(parts) != 3 or parts[0] == "-":
+            continue  # blank line or binary file
+        path = os.path.join(toplevel, parts[2])
+        churn[path] = churn.get(path, 0.0) + weight * (int(parts[0]) + int(parts[1]))
+    process.wait()
+    return churn
+
+def file_findings(store):
+    """Sum of issue confidences per file over every stored tree result, from the results database."""
+    findings = {}
+    for file, total in store.confidence_by_file("tree").items():
+        if total is None:
+            continue  # no issue of the file has a numeric confidence
+        path = os.path.realpath(file)
+        findings[path] = findings.get(path, 0.0) + total / 10.0
+    return findings
+
+def compute_signals(index, repo_path, store=None, since=None):
+    """
+    Raw signals per function id: {"churn", "size", "fan_in", "fan_out",
+    "findings"}, each a list indexed by function id. File-level signals
+    (churn, findings) are shared by the functions of a file; findings are
+    divided by the number of functions in the file.
+    """
+    with telemetry.span("git.churn"):
+        churn = file_churn(repo_path, since)
+    with telemetry.span("results.findings"):
+        findings = file_findings(store) if store is not None else {}
+    n = len(index)
+    paths = [os.path.realpath(index.file(func_id)) for func_id in range(n)]
+    per_file = {}
+    for path in paths:
+        per_file[path] = per_file.get(path, 0) + 1
+    return {
+        "churn": [churn.get(path, 0.0) for path in paths],
+        "size": [index.length(func_id) for func_id in range(n)],
+        "fan_in": [len(index.callers(func_id)) for func_id in range(n)],
+        "fan_out": [len(index.callees(func_id)) for func_id in range(n)],
+        "findings": [findings.get(path, 0.0) / per_file[path] for path in paths],
+    }
+
+def score_functions(signals, candidates, weights=None):
+    """
+    Score each candidate: the weighted sum of its signals, each put on a log
+    scale and divided by the largest value among the candidates, so every
+    signal contributes between 0 and its weight. Returns {function id: score}.
+    """
+    weights = weights or DEFAULT_WEIGHTS
+    scores = {func_id: 1e-3 for func_id in candidates}
+    for name, weight in weights.items():
+        if not weight:
+            continue
+        values = signals[name]
+        scaled = {func_id: math.log1p(values[func_id]) for func_id in candidates}
+        top = max(scaled.values(), default=0.0)
+        if top <= 0:
+            continue
+        for func_id, value in scaled.items():
+            scores[func_id] += weight * value / top
+    return scores
+
+def tree_tokens(index, func_id, depth=1, caller_depth=0, budget=None, prompt_tokens=DEFAULT_TREE_TOKENS):
+    """
+    Estimated prompt tokens for reviewing func_id's code tree: the tree as
+    render_tree cuts it to prompt_tokens for the request, plus the prompt
+    around it.
+    """
+    specimen = build_specimen(index, func_id, depth, caller_depth, budget)
+    if specimen is None:
+        return PROMPT_OVERHEAD_TOKENS
+    _, tokens = render_tree(specimen[1], prompt_tokens)
+    return min(tokens, prompt_tokens) + PROMPT_OVERHEAD_TOKENS
+
+def schedule(index, candidates, count, strategy="random", scores=None, token_budget=None, tree_size=None):
+    """
+    Pick up to `count` function ids from candidates. "random" samples
+    uniformly, "weighted" samples without replacement with probability
+    proportional to scores, "top" takes the highest scores. With token_budget,
+    trees are taken in that order while their estimated tokens (tree_size(func_id))
+    still fit; trees that do not fit are passed over for smaller ones.
+    """
+    candidates = list(candidates)
+    if strategy == "random":
+        order = random.sample(candidates, len(candidates))
+    elif strategy == "weighted":
+        # Efraimidis-Spirakis: sorting by u ** (1 / weight) samples proportionally to weight.
+        order = sorted(candidates, key=lambda func_id: random.random() ** (1.0 / scores[func_id]), reverse=True)
+    elif strategy == "top":
+        order = sorted(candidates, key=lambda func_id: scores[func_id], reverse=True)
+    else:
+        raise ValueError(f"Unknown strategy {strategy!r}; expected one of {', '.join(STRATEGIES)}")
+
+    if token_budget is None:
+        return order[:count]
+    selected = []
+    remaining = token_budget
+    for func_id in order:
+        if len(selected) >= count or remaining < PROMPT_OVERHEAD_TOKENS:
+            break
+        tokens = tree_size(func_id)
+        if tokens <= remaining:
+            selected.append(func_id)
+            remaining -= tokens
+    print(f"Selected {len(selected)} tree(s), about {token_budget - remaining} of {token_budget} prompt tokens")
+    return selected
+
+def make_chooser(repo_path, strategy="random", weights=None, token_budget=None, store=None,
+                 depth=1, caller_depth=0, budget=None, prompt_tokens=DEFAULT_TREE_TOKENS):
+    """
+    A `choose(index, candidates, count)` function for pair.select_code_trees
+    that picks trees with the given strategy and token budget. depth,
+    caller_depth, budget and prompt_tokens (llm.tree_token_budget) must match
+    the trees being built and sent, for the size estimate.
+    """
+    def choose(index, candidates, count):
+        scores = None
+        if strategy != "random":
+            signals = compute_signals(index, repo_path, store)
+            scores = score_functions(signals, candidates, weights)
+        def tree_size(func_id):
+            return tree_tokens(index, func_id, depth, caller_depth, budget, prompt_tokens)
+        return schedule(index, candidates, count, strategy, scores, token_budget, tree_size)
+    return choose
@@ -0,0 +1,125 @@
+"""
+Timing spans and counters for the stages of a run.
+
+Code wraps a stage in `with telemetry.span("index.scan"):` (or reports a
+duration it measured itself with record()) and bumps counters with count().
+Every span is kept in memory for the end-of-run summary, a table of count,
+total and p50/p95/p99 seconds per stage, and, when log_path is set (the
+FUZZER_TELEMETRY environment variable or --telemetry), also appended to it as
+one JSON line, together with any fields given to the span.
+
+Stage names are dotted, stage first: index.*, git.*, queue.*, job, llm.<template>,
+parse.<template>, results.*.
+"""
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Append one JSON line per span here when set.
+log_path = os.environ.get("FUZZER_TELEMETRY")
+
+# Write cProfile data for indexing here when set (see profile()).
+profile_path = None
+
+_lock = threading.Lock()
+_durations = {}
+_counters = {}
+_log_file = None
+
+def _write(entry):
+    global _log_file
+    if not log_path:
+        return
+    line = json.dumps(entry) + "\n"
+    with _lock:
+        if _log_file is None:
+            _log_file = open(log_path, "a")
+        _log_file.write(line)
+
+def record(name, seconds, **fields):
+    """Record a span of `seconds` that has already been measured."""
+    with _lock:
+        _durations.setdefault(name, []).append(seconds)
+    _write({"time": time.time(), "span": name, "seconds": round(seconds, 6), **fields})
+
+@contextmanager
+def span(name, **fields):
+    """Time the body of a with statement as a span called `name`."""
+    start = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        record(name, time.perf_counter() - start, **fields)
+
+def count(name, value=1):
+    """Add value to the counter `name`."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def counter(name):
+    with _lock:
+        return _counters.get(name, 0)
+
+def durations(name):
+    """Every recorded duration of span `name`, in seconds."""
+    with _lock:
+        return list(_durations.get(name, ()))
+
+def percentile(values, q):
+    """The q-th percentile (0 to 100) of values, by nearest rank; 0 if there are none."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q / 100.0 * len(ordered)) - 1))]
+
+def summary():
+    """The span and counter summary, as printable text."""
+    with _lock:
+        spans = {name: list(values) for name, values in _durations.items()}
+        counters = dict(_counters)
+    if not spans and not counters:
+        return ""
+    lines = [f"{'stage':28} {'count':>7} {'total s':>9} {'p50 s':>8} {'p95 s':>8} {'p99 s':>8}"]
+    for name in sorted(spans):
+        values = spans[name]
+        lines.append(f"{name:28} {len(values):7} {sum(values):9.2f} {percentile(values, 50):8.3f} "
+                     f"{percentile(values, 95):8.3f} {percentile(values, 99):8.3f}")
+    for name in sorted(counters):
+        value = counters[name]
+        lines.append(f"{name:28} {value:>7}" if isinstance(value, int) else f"{name:28} {value:7.2f}")
+    return "\n".join(lines)
+
+def close():
+    global _log_file
+    with _lock:
+        if _log_file is not None:
+            _log_file.close()
+            _log_file = None
+
+@contextmanager
+def profile():
+    """
+    Profile the body of a with statement with cProfile when profile_path is
+    set: the stats are written there (for pstats or snakeviz) and the top
+    functions by cumulative time are printed. Otherwise does nothing.
+    """
+    if not profile_path:
+        yield
+        return
+    import cProfile
+    import io
+    import pstats
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(15)
+        print(f"Wrote indexing profile to {profile_path}")
+        print(report.getvalue())
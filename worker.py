@@ -1,26 +1,274 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+import json
+import os
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
+import telemetry
 
-def run_jobs(fn, payloads, max_workers=5, payload_arg_key_fn=None):
-    results = {}
-    errors = 0
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        job_to_args = {executor.submit(fn, args): args for args in payloads}
 
-        for job in as_completed(job_to_args):
-            args = job_to_args[job]
-            if payload_arg_key_fn:
-                key = payload_arg_key_fn(args)
-            else:
-                key = args
-            try:
-                results[key] = job.result()
-            except Exception as e:
-                print(e)
-                results[key] = {"error": str(e)}
-                errors += 1
+class Checkpoint:
+    """
+    Append-only file of finished job keys (one JSON value per line), so an
+    interrupted run can be restarted without redoing finished jobs.
 
-            print(f"Progress: {len(results)}/{len(payloads)} | Errors: {errors}")
+    With `persist` (e.g. ResultStore.flush), keys are written at most every
+    `interval` seconds and persist() is called first, so a key is never on disk
+    before the results it stands for. Keys still buffered when the process dies
+    are just redone by the next run.
+    """
 
-    return results
+    def __init__(self, path, persist=None, interval=1.0):
+        self.path = path
+        self.persist = persist
+        self.interval = interval
+        self.keys = set()
+        self._pending = []
+        self._last_write = time.monotonic()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        self.keys.add(line)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, 'a')
 
+    @staticmethod
+    def _encode(key):
+        return json.dumps(key, sort_keys=True)
+
+    def __contains__(self, key):
+        return self._encode(key) in self.keys
+
+    def add(self, key):
+        encoded = self._encode(key)
+        if encoded not in self.keys:
+            self.keys.add(encoded)
+            self._pending.append(encoded)
+        if self.persist is None or time.monotonic() - self._last_write >= self.interval:
+            self.write()
+
+    def write(self):
+        """Persist the results, then append the buffered keys to the file."""
+        self._last_write = time.monotonic()
+        if not self._pending:
+            return
+        if self.persist is not None:
+            self.persist()
+        self._file.write("".join(encoded + "\n" for encoded in self._pending))
+        self._file.flush()
+        self._pending = []
+
+    def close(self):
+        try:
+            self.write()
+        finally:
+            self._file.close()
+
+
+class Progress:
+    """Prints a progress line at most once a second, and a final one from the caller."""
+
+    def __init__(self, total=None):
+        self.total = total
+        self.done = 0
+        self.errors = 0
+        self.skipped = 0
+        self._last = 0.0
+
+    def update(self, error=False):
+        self.done += 1
+        if error:
+            self.errors += 1
+        now = time.monotonic()
+        if now - self._last >= 1.0:
+            self._last = now
+            self.report()
+
+    def report(self):
+        total = f"/{self.total}" if self.total is not None else ""
+        skipped = f" | Skipped: {self.skipped}" if self.skipped else ""
+        print(f"Progress: {self.done + self.skipped}{total} | Errors: {self.errors}{skipped}")
+
+
+def _call_with_retries(fn, args, retries, backoff, stop_at, submitted=None):
+    if submitted is not None:
+        telemetry.record("queue.wait", time.monotonic() - submitted)
+    attempt = 0
+    while True:
+        try:
+            with telemetry.span("job"):
+                return fn(args)
+        except Exception as e:
+            attempt += 1
+            delay = random.uniform(0.5, 1.0) * backoff * 2 ** (attempt - 1)
+            if attempt > retries or (stop_at is not None and time.monotonic() + delay > stop_at):
+                raise
+            telemetry.count("job.retries")
+            print(f"Retrying after error ({attempt}/{retries}): {e}")
+            time.sleep(delay)
+
+
+def iter_jobs(fn, payloads, max_workers=5, payload_arg_key_fn=None, window=None,
+              checkpoint=None, persist=None, retries=0, backoff=1.0, deadline=None):
+    """
+    Run fn(args) for every args in payloads on a thread pool, yielding
+    (key, result) as jobs finish. A failed job yields {"error": message}.
+
+    payloads may be any iterable, including a generator: at most `window` jobs
+    (default: twice max_workers) are queued at a time, so memory stays constant
+    however many payloads there are. With `checkpoint` (a file path), keys of
+    jobs that succeeded are recorded, once the consumer has taken their result
+    and `persist` has saved it (see Checkpoint), and skipped by later runs. A failing job
+    is retried up to `retries` times with exponential backoff. After `deadline`
+    seconds no new jobs are started and queued ones are dropped.
+    """
+    key_fn = payload_arg_key_fn or (lambda args: args)
+    window = window or max_workers * 2
+    done_keys = Checkpoint(checkpoint, persist) if checkpoint else None
+    stop_at = time.monotonic() + deadline if deadline else None
+    progress = Progress(len(payloads) if hasattr(payloads, '__len__') else None)
+    payloads = iter(payloads)
+    exhausted = False
+    pending = {}
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        while True:
+            while not exhausted and len(pending) < window and (stop_at is None or time.monotonic() < stop_at):
+                try:
+                    args = next(payloads)
+                except StopIteration:
+                    exhausted = True
+                    break
+                key = key_fn(args)
+                if done_keys is not None and key in done_keys:
+                    progress.skipped += 1
+                    continue
+                job = executor.submit(_call_with_retries, fn, args, retries, backoff, stop_at, time.monotonic())
+                pending[job] = key
+            if not pending:
+                if not exhausted:
+                    print("Deadline reached; not starting any more jobs.")
+                break
+
+            timeout = None if stop_at is None else max(0.0, stop_at - time.monotonic())
+            finished, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not finished:
+                print(f"Deadline reached; dropping {len(pending)} unfinished job(s).")
+                break
+            for job in finished:
+                key = pending.pop(job)
+                try:
+                    result = job.result()
+                except Exception as e:
+                    print(e)
+                    progress.update(error=True)
+                    yield key, {"error": str(e)}
+                    continue
+                progress.update()
+                yield key, result
+                if done_keys is not None:
+                    done_keys.add(key)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        if done_keys is not None:
+            done_keys.close()
+    progress.report()
+
+
+def run_jobs(fn, payloads, max_workers=5, payload_arg_key_fn=None, **options):
+    """
+    Run every job and return {key: result}. See iter_jobs for the options; use
+    iter_jobs directly to handle results as they arrive instead of holding them.
+    """
+    return dict(iter_jobs(fn, payloads, max_workers, payload_arg_key_fn, **options))
+
+
+def iter_jobs_async(fn, payloads, payload_arg_key_fn=None, window=256, checkpoint=None, persist=None,
+                    deadline=None):
+    """
+    Like iter_jobs, for a coroutine function. The jobs run on an event loop in a
+    background thread, at most `window` at once; how many actually hit the
+    network together is up to the limits inside fn (for the llm module: its rate
+    and concurrency limiters, which also do the retrying).
+    """
+    key_fn = payload_arg_key_fn or (lambda args: args)
+    done_keys = Checkpoint(checkpoint, persist) if checkpoint else None
+    progress = Progress(len(payloads) if hasattr(payloads, '__len__') else None)
+    results = queue.Queue()
+    finished = object()
+    stop = threading.Event()
+
+    async def run_one(key, args):
+        try:
+            with telemetry.span("job"):
+                return key, await fn(args), None
+        except Exception as e:
+            return key, None, e
+
+    async def run_all():
+        stop_at = time.monotonic() + deadline if deadline else None
+        payload_iter = iter(payloads)
+        exhausted = False
+        pending = set()
+        try:
+            while True:
+                while not exhausted and not stop.is_set() and len(pending) < window and \
+                        (stop_at is None or time.monotonic() < stop_at):
+                    try:
+                        args = next(payload_iter)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    key = key_fn(args)
+                    if done_keys is not None and key in done_keys:
+                        progress.skipped += 1
+                        continue
+                    pending.add(asyncio.ensure_future(run_one(key, args)))
+                if not pending:
+                    if not exhausted and not stop.is_set():
+                        print("Deadline reached; not starting any more jobs.")
+                    break
+                timeout = None if stop_at is None else max(0.0, stop_at - time.monotonic())
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    print(f"Deadline reached; dropping {len(pending)} unfinished job(s).")
+                    for task in pending:
+                        task.cancel()
+                    break
+                for task in done:
+                    results.put(task.result())
+        finally:
+            results.put(finished)
+
+    thread = threading.Thread(target=lambda: asyncio.run(run_all()), daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = results.get()
+            if item is finished:
+                break
+            key, result, error = item
+            if error is not None:
+                print(error)
+                progress.update(error=True)
+                yield key, {"error": str(error)}
+                continue
+            progress.update()
+            yield key, result
+            if done_keys is not None:
+                done_keys.add(key)
+    finally:
+        stop.set()
+        if done_keys is not None:
+            done_keys.close()
+    progress.report()
+
+
+def run_jobs_async(fn, payloads, payload_arg_key_fn=None, **options):
+    """Run every job through iter_jobs_async and return {key: result}."""
+    return dict(iter_jobs_async(fn, payloads, payload_arg_key_fn, **options))
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+Durable work queue for review campaigns spread over several processes or
+machines, kept in one SQLite database on a disk they share. By default the
+database is in WAL mode, which only works for processes on one host; workers
+on several machines sharing it over NFS or SMB must all run with
+FUZZER_SQLITE_JOURNAL=DELETE (see results.JOURNAL_MODE), which also applies to
+the campaign's results database.
+
+A campaign is seeded once with jobs: commits (review.py review --queue) or
+functions (review.py tree --queue). Workers (review.py worker) claim a few
+jobs at a time under a lease that runs out after `lease` seconds unless renewed
+by a heartbeat. A job whose lease ran out, because its worker died or hung, is
+claimable again. A job is only marked done by the worker holding its lease,
+after its results have been written, so no job is lost; results are written
+idempotently, so the rare job finished by two workers (the first one's lease
+having expired) is still stored once.
+
+    python workqueue.py status campaign.sqlite3
+    python workqueue.py retry campaign.sqlite3      # requeue failed jobs
+"""
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from results import JOURNAL_MODE
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS campaign (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    payload TEXT,
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    lease_expires REAL,
+    updated_at REAL,
+    error TEXT,
+    UNIQUE (kind, key)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_expires);
+"""
+
+STATES = ("queued", "leased", "done", "failed")
+
+DEFAULT_LEASE = 600
+DEFAULT_MAX_ATTEMPTS = 3
+
+def worker_name():
+    """An id for this process that is unique across machines sharing a queue."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+class WorkQueue:
+    """
+    The queue in one database file. Every state change is a short IMMEDIATE
+    transaction, so any number of processes can share the file; within a
+    process, any number of threads can share a WorkQueue.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.execute(f"PRAGMA journal_mode={JOURNAL_MODE}")
+        self._conn.execute("PRAGMA synchronous=NORMAL" if JOURNAL_MODE == "WAL" else "PRAGMA synchronous=FULL")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def _transaction(self, fn):
+        """Run fn(connection) in an IMMEDIATE transaction and return its result."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def _read(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def set_info(self, **values):
+        """Store campaign settings (results database, run id, tree options...) for the workers."""
+        self._transaction(lambda conn: conn.executemany(
+            "INSERT OR REPLACE INTO campaign (name, value) VALUES (?, ?)",
+            [(name, json.dumps(value)) for name, value in values.items()]
+        ))
+
+    def info(self):
+        return {name: json.loads(value) for name, value in self._read("SELECT name, value FROM campaign")}
+
+    def seed(self, kind, items):
+        """
+        Add (key, payload) jobs of a kind. Keys already in the queue are left
+        as they are, so seeding again only adds what is new. Returns the
+        number of jobs added.
+        """
+        now = time.time()
+        rows = [(kind, key, json.dumps(payload), now) for key, payload in items]
+        def insert(conn):
+            before = conn.total_changes
+            conn.executemany("INSERT OR IGNORE INTO jobs (kind, key, payload, updated_at) VALUES (?, ?, ?, ?)", rows)
+            return conn.total_changes - before
+        return self._transaction(insert)
+
+    def claim(self, owner, count, lease=DEFAULT_LEASE):
+        """
+        Lease up to `count` jobs to owner: queued ones first, then ones whose
+        lease has expired. Returns a list of (id, kind, key, payload).
+        """
+        def take(conn):
+            now = time.time()
+            rows = conn.execute(
+                "SELECT id, kind, key, payload FROM jobs "
+                "WHERE state = 'queued' OR (state = 'leased' AND lease_expires < ?) "
+                "ORDER BY state DESC, id LIMIT ?", (now, count)
+            ).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET state = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1, "
+                "updated_at = ? WHERE id = ?", [(owner, now + lease, now, row[0]) for row in rows]
+            )
+            return [(job_id, kind, key, json.loads(payload) if payload else None) for job_id, kind, key, payload in rows]
+        return self._transaction(take)
+
+    def heartbeat(self, owner, job_ids, lease=DEFAULT_LEASE):
+        """Renew owner's leases on job_ids. Returns the ids whose lease owner no longer holds."""
+        def renew(conn):
+            now = time.time()
+            lost = []
+            for job_id in job_ids:
+                cursor = conn.execute(
+                    "UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE id = ? AND owner = ? AND state = 'leased'",
+                    (now + lease, now, job_id, owner)
+                )
+                if cursor.rowcount == 0:
+                    lost.append(job_id)
+            return lost
+        return self._transaction(renew)
+
+    def complete(self, owner, job_ids):
+        """Mark jobs done if owner still holds their lease. Returns the ids it did not hold."""
+        def finish(conn):
+            now = time.time()
+            lost = []
+            for job_id in job_ids:
+                cursor = conn.execute(
+                    "UPDATE jobs SET state = 'done', owner = NULL, lease_expires = NULL, error = NULL, updated_at = ? "
+                    "WHERE id = ? AND owner = ? AND state = 'leased'", (now, job_id, owner)
+                )
+                if cursor.rowcount == 0:
+                    lost.append(job_id)
+            return lost
+        return self._transaction(finish)
+
+    def fail(self, owner, job_id, error, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """Give a job back after an error: queued again, or failed once it has had max_attempts."""
+        self._transaction(lambda conn: conn.execute(
+            "UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+            "owner = NULL, lease_expires = NULL, error = ?, updated_at = ? WHERE id = ? AND owner = ?",
+            (max_attempts, str(error), time.time(), job_id, owner)
+        ))
+
+    def retry_failed(self):
+        """Queue every failed job again, with fresh attempts. Returns how many."""
+        return self._transaction(lambda conn: conn.execute(
+            "UPDATE jobs SET state = 'queued', attempts = 0, updated_at = ? WHERE state = 'failed'", (time.time(),)
+        ).rowcount)
+
+    def counts(self):
+        """{state: number of jobs}, with expired leases counted as "expired"."""
+        counts = dict.fromkeys(STATES, 0)
+        counts["expired"] = 0
+        for state, expired, number in self._read(
+            "SELECT state, state = 'leased' AND lease_expires < ?, COUNT(*) FROM jobs GROUP BY 1, 2", (time.time(),)
+        ):
+            counts["expired" if expired else state] += number
+        return counts
+
+    def unfinished(self):
+        """Number of jobs that are queued or leased (expired or not)."""
+        return self._read("SELECT COUNT(*) FROM jobs WHERE state IN ('queued', 'leased')")[0][0]
+
+    def failed(self, limit=None):
+        """(kind, key, attempts, error) of failed jobs, oldest first."""
+        return self._read("SELECT kind, key, attempts, error FROM jobs WHERE state = 'failed' ORDER BY id LIMIT ?",
+                          (-1 if limit is None else limit,))
+
+    def close(self):
+        self._conn.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect a review campaign's work queue")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for name, help in (("status", "Job counts per state, and the campaign settings"),
+                       ("retry", "Queue failed jobs again")):
+        command = sub.add_parser(name, help=help)
+        command.add_argument("queue", help="Queue database")
+    args = parser.parse_args()
+
+    work_queue = WorkQueue(args.queue)
+    if args.command == "status":
+        for name, value in sorted(work_queue.info().items()):
+            print(f"{name}: {value}")
+        counts = work_queue.counts()
+        print(" | ".join(f"{state}: {number}" for state, number in counts.items()))
+        for kind, key, attempts, error in work_queue.failed(20):
+            print(f"failed {kind} {key} after {attempts} attempt(s): {error}")
+    elif args.command == "retry":
+        print(f"Requeued {work_queue.retry_failed()} failed job(s)")
+    work_queue.close()
+
+if __name__ == "__main__":
+    main()